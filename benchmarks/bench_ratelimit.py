@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Coordination overhead of the rate limit backends per request.
+
+The rate is set high enough to never wait, so the numbers show the cost of
+the backend itself: lock + state update.
+
+Usage:
+
+    python benchmarks/bench_ratelimit.py --requests 100000 --processes 1 4 16
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vk_requests.ratelimit import MemoryBackend, FileLockBackend  # noqa
+
+
+RATE = 1e9
+
+
+def run_requests(backend, requests_num):
+    started_at = time.time()
+    for _ in range(requests_num):
+        backend.reserve('token', RATE)
+    return time.time() - started_at
+
+
+def worker(path, requests_num, queue):
+    queue.put(run_requests(FileLockBackend(path), requests_num))
+
+
+def bench_processes(path, processes_num, requests_num):
+    """Run the requests in the processes sharing the file backend
+
+    :return: float: mean wall time per request in microseconds
+    """
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker,
+                                         args=(path, requests_num, queue))
+                 for _ in range(processes_num)]
+    started_at = time.time()
+    for p in processes:
+        p.start()
+    for _ in processes:
+        queue.get()
+    elapsed = time.time() - started_at
+    for p in processes:
+        p.join()
+    return elapsed / (requests_num * processes_num) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=100000,
+                        help='requests per process')
+    parser.add_argument('--processes', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    elapsed = run_requests(MemoryBackend(), args.requests)
+    print('%-28s %8.2f us/request' % ('MemoryBackend',
+                                     elapsed / args.requests * 1e6))
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'ratelimit')
+    for processes_num in args.processes:
+        overhead = bench_processes(path, processes_num, args.requests)
+        print('%-28s %8.2f us/request' % (
+            'FileLockBackend x%d procs' % processes_num, overhead))
+    os.unlink(path)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
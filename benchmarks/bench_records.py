@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Memory per item and decode time of the compact response mode compared to
+the dict mode.
+
+The response emulates users.get with 30 fields, nested objects included.
+Memory is the size of the decoded tree measured by tracemalloc (python 3).
+
+Usage:
+
+    python benchmarks/bench_records.py --items 10000 --repeat 5
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vk_requests import records  # noqa
+from vk_requests.session import loads_json  # noqa
+
+
+def get_user(user_id):
+    user = {
+        'id': user_id, 'first_name': 'Name%d' % user_id,
+        'last_name': 'Surname%d' % user_id, 'is_closed': False,
+        'can_access_closed': True, 'sex': 1, 'bdate': '1.1.1990',
+        'domain': 'id%d' % user_id, 'city': {'id': 1, 'title': 'Moscow'},
+        'country': {'id': 1, 'title': 'Russia'},
+        'photo_50': 'https://sun.userapi.com/%d_50.jpg' % user_id,
+        'photo_100': 'https://sun.userapi.com/%d_100.jpg' % user_id,
+        'online': 0, 'verified': 0, 'followers_count': user_id * 3,
+        'status': 'Status of user %d' % user_id,
+        'last_seen': {'time': 1546300800 + user_id, 'platform': 7},
+        'counters': {'friends': 10, 'photos': 5, 'videos': 0},
+        'has_mobile': 1, 'relation': 0,
+    }
+    for i in range(10):
+        user['field_%d' % i] = i
+    return user
+
+
+def get_body(items_num):
+    return json.dumps({'response': [get_user(i) for i in
+                                    range(items_num)]}).encode('utf-8')
+
+
+def bench(decode, body, repeat):
+    """
+    :return: tuple of (best decode time in ms, bytes per item)
+    """
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        decode(body)
+        timings.append(time.perf_counter() - started_at)
+
+    gc.collect()
+    tracemalloc.start()
+    response = decode(body)['response']
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return min(timings) * 1e3, float(size) / len(response)
+
+
+def read_fields(response):
+    for user in response:
+        user['id'], user['first_name'], user['city']['title']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    body = get_body(args.items)
+    print('%d items, %d bytes' % (args.items, len(body)))
+    for name, decode in (('dict', loads_json), ('compact', records.loads)):
+        elapsed, item_size = bench(decode, body, args.repeat)
+        response = decode(body)['response']
+        started_at = time.perf_counter()
+        read_fields(response)
+        read_time = (time.perf_counter() - started_at) * 1e3
+        print('%-10s decode %8.2f ms  %8.0f bytes/item  read 3 fields '
+              '%6.2f ms' % (name, elapsed, item_size, read_time))
+
+
+if __name__ == '__main__':
+    main()
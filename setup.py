@@ -8,7 +8,9 @@ PY_VERSION = sys.version_info.major, sys.version_info.minor
 install_requires = [
     'six>=1.13.0',
     'requests>=2.8.1',
-    'beautifulsoup4>=4.4.1']
+    'beautifulsoup4>=4.4.1',
+    # concurrent.futures backport (uploads, downloads, long poll handlers)
+    'futures; python_version<"3"']
 
 
 with open('README.md') as f:
@@ -27,12 +29,17 @@ setup(
     long_description=readme,
     install_requires=install_requires,
     extras_require={
-        'streaming:python_version>="3.4"': ['websockets']
+        'streaming:python_version>="3.5"': ['websockets'],
+        'parquet': ['pyarrow'],
     },
     classifiers=[
         'Intended Audience :: Developers',
+        # Streaming API requires python 3.5+
+        'Framework :: AsyncIO',
 
+        'Programming Language :: Python :: 2',
         'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
@@ -21,7 +21,8 @@ if PY_VERSION < (3, 4):
 def create_api(app_id=None, login=None, password=None, phone_number=None,
                scope='offline', api_version='5.92', http_params=None,
                interactive=False, service_token=None, client_secret=None,
-               two_fa_supported=False, two_fa_force_sms=False):
+               two_fa_supported=False, two_fa_force_sms=False,
+               transport=None):
     """Factory method to explicitly create API with app_id, login, password
     and phone_number parameters.
 
@@ -44,6 +45,8 @@ def create_api(app_id=None, login=None, password=None, phone_number=None,
     more info: https://vk.com/dev/auth_direct
     :param two_fa_force_sms: bool: force SMS two-factor authentication for Direct Authorization
     if two_fa_supported is True, more info: https://vk.com/dev/auth_direct
+    :param transport: vk_requests.transport.Transport instance, e.g. to
+    record or replay the requests
     :return: api instance
     :rtype : vk_requests.api.API
     """
@@ -57,7 +60,8 @@ def create_api(app_id=None, login=None, password=None, phone_number=None,
                         interactive=interactive,
                         client_secret=client_secret,
                         two_fa_supported = two_fa_supported,
-                        two_fa_force_sms=two_fa_force_sms)
+                        two_fa_force_sms=two_fa_force_sms,
+                        transport=transport)
     return API(session=session, http_params=http_params)
 
 
@@ -6,38 +6,60 @@ logger = logging.getLogger('vk-requests')
 
 
 class API(object):
-    def __init__(self, session, http_params=None):
+    def __init__(self, session, http_params=None, priority=None,
+                 deadline=None, response_mode=None):
         """
 
         :param session: vk_requests.session.VKSession instance
         :param http_params: dict: requests HTTP parameters
+        :param priority: str: default priority class of the requests, it's
+        used by the session scheduler, see vk_requests.scheduler
+        :param deadline: float: default time budget of a call in seconds,
+        it bounds all the retries, waits and re-authorization of the call
+        :param response_mode: str: default response mode, 'compact' to
+        decode the responses into compact objects, see vk_requests.records
         """
         self._session = session
         self._http_params = http_params
         if http_params is None:
             self._http_params = dict(timeout=10)
+        self._call_options = {'priority': priority, 'deadline': deadline,
+                              'response_mode': response_mode}
 
     @property
     def version(self):
         return self._session.api_version
 
+    @property
+    def session(self):
+        return self._session
+
     def __getattr__(self, method_name):
         return Request(session=self._session,
                        method_name=method_name,
-                       http_params=self._http_params)
+                       http_params=self._http_params,
+                       call_options=self._call_options)
 
 
 class Request(object):
-    __slots__ = ('_session', 'http_params', '_method_name', '_method_args')
+    __slots__ = ('_session', 'http_params', '_method_name', '_method_args',
+                 '_default_options', '_call_options')
+
+    # Call arguments which are handled by the library and not sent to vk
+    CALL_OPTIONS = ('priority', 'execute_mode', 'return_raw', 'deadline',
+                    'response_mode')
 
-    def __init__(self, session, method_name, http_params):
+    def __init__(self, session, method_name, http_params, call_options=None):
         """
         :param session: vk_requests.session.VKSession instance
         :param method_name: str: method name
+        :param call_options: dict: default values of CALL_OPTIONS
         """
         self._session = session
         self._method_name = method_name
         self._method_args = None  # will be set with __call__ execution
+        self._default_options = call_options or {}
+        self._call_options = self._default_options
         self.http_params = http_params
 
     @property
@@ -56,13 +78,26 @@ class Request(object):
     def method_args(self, val):
         raise AttributeError('method_args is immutable')
 
+    @property
+    def call_options(self):
+        return self._call_options
+
+    def get_option(self, name, default=None):
+        value = self._call_options.get(name)
+        return default if value is None else value
+
     def __getattr__(self, method_name):
         new_method = '.'.join([self._method_name, method_name])
         return Request(session=self._session,
                        method_name=new_method,
-                       http_params=self.http_params)
+                       http_params=self.http_params,
+                       call_options=self._default_options)
 
     def __call__(self, **method_args):
+        self._call_options = dict(self._default_options)
+        for option in self.CALL_OPTIONS:
+            if option in method_args:
+                self._call_options[option] = method_args.pop(option)
         self._method_args = method_args
         return self._session.make_request(request=self)
 
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Durable checkpoints for stream, long poll and pagination consumers.
+
+Consumers acknowledge the position (event id, long poll ts, offset) after
+the data is processed. Positions are saved in batches, after restart the
+consumer resumes from the last saved one, so the delivery is at-least-once.
+
+Example:
+
+>>> store = FileCheckpointStore('/var/lib/my_bot/checkpoints.json')
+>>> checkpoint = Checkpointer(store, key='longpoll:123')
+>>> longpoll = BotsLongPoll(api, group_id=123, checkpoint=checkpoint)
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger('vk-requests')
+
+# Atomic rename over the existing file (os.rename doesn't replace existing
+# file on Windows)
+replace = getattr(os, 'replace', os.rename)
+
+
+class CheckpointStore(object):
+    """Checkpoint store interface"""
+
+    def load(self, key):
+        """Get saved position
+
+        :param key: str: checkpoint key
+        :return: saved value or None
+        """
+        raise NotImplementedError
+
+    def save(self, key, value):
+        """Durably save the position
+
+        :param key: str: checkpoint key
+        :param value: json serializable value
+        """
+        raise NotImplementedError
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    """Non-durable store, useful for testing"""
+
+    def __init__(self):
+        self._data = {}
+
+    def load(self, key):
+        return self._data.get(key)
+
+    def save(self, key, value):
+        self._data[key] = value
+
+
+class FileCheckpointStore(CheckpointStore):
+    """JSON file store. The file is replaced atomically: data is written to
+    a temporary file which is fsync'd and renamed over the old one, so the
+    file is never left half-written"""
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self._lock = threading.Lock()
+        self._data = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(path=%s)' % (self.__class__.__name__, self.path)
+
+    def _read(self):
+        if self._data is None:
+            try:
+                with open(self.path) as fd:
+                    self._data = json.load(fd)
+            except (IOError, OSError):
+                self._data = {}
+        return self._data
+
+    def load(self, key):
+        with self._lock:
+            return self._read().get(key)
+
+    def save(self, key, value):
+        with self._lock:
+            data = dict(self._read())
+            data[key] = value
+            self._write(data)
+            self._data = data
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        fsync_dir(directory)
+
+
+def fsync_dir(directory):
+    """Make the rename durable (no-op on the systems without directory fds)
+    """
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except (IOError, OSError):  # pragma: no cover
+        return
+    try:
+        os.fsync(dir_fd)
+    except (IOError, OSError):  # pragma: no cover
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class Checkpointer(object):
+    """Keeps the last acknowledged position of one consumer and saves it in
+    batches to keep the I/O cheap"""
+
+    def __init__(self, store, key, flush_every=100, flush_interval=5.0):
+        """
+
+        :param store: CheckpointStore instance
+        :param key: str: consumer key, e.g. 'longpoll:<group_id>'
+        :param flush_every: int: save after this number of acks
+        :param flush_interval: float: save if the last save was more than
+        this number of seconds ago
+        """
+        self.store = store
+        self.key = key
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._position = store.load(key)
+        self._saved_position = self._position
+        self._pending = 0
+        self._flushed_at = time.time()
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(key=%s, position=%s)' % (
+            self.__class__.__name__, self.key, self._position)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    @property
+    def position(self):
+        """Last acknowledged position, the saved one just after start"""
+        return self._position
+
+    def ack(self, position):
+        """Acknowledge the position, all the data before it is processed
+
+        :param position: json serializable value
+        """
+        with self._lock:
+            self._position = position
+            self._pending += 1
+            flush_needed = (
+                self._pending >= self.flush_every or
+                time.time() - self._flushed_at >= self.flush_interval)
+        if flush_needed:
+            self.flush()
+
+    def flush(self):
+        """Save the last acknowledged position"""
+        with self._lock:
+            position = self._position
+            self._pending = 0
+            self._flushed_at = time.time()
+            if position == self._saved_position:
+                return
+            self.store.save(self.key, position)
+            self._saved_position = position
+        logger.debug('Checkpoint %s is saved: %s', self.key, position)
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import threading
+import time
+
+from vk_requests.exceptions import VkCircuitOpenError, \
+    INTERNAL_SERVER_ERROR, SERVICE_UNAVAILABLE
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.utils import get_token_id
+
+
+logger = logging.getLogger('vk-requests')
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Gauge values of the states
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class _Circuit(object):
+    __slots__ = ('state', 'failures', 'opened_at', 'probes')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = collections.deque()  # failure times
+        self.opened_at = None
+        self.probes = 0  # half-open requests in flight
+
+
+class CircuitBreaker(object):
+    """Per-method circuit breaker.
+
+    The circuit of a method opens after failure_threshold failures within
+    window seconds. While it's open the requests fail fast with
+    VkCircuitOpenError instead of waiting for the timeout. After
+    reset_timeout the circuit becomes half-open and lets
+    half_open_max_calls probe requests through: a successful probe closes
+    the circuit, a failed one opens it again.
+
+    Failures are transport errors (timeouts, connection and HTTP errors)
+    and API errors with failure_codes. Other API errors (e.g. access denied)
+    mean the method works, they don't count. Neither do the errors raised
+    on the client side, e.g. deadline errors.
+
+    Example:
+
+    >>> breaker = CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    >>> session = VKSession(service_token='...', circuit_breaker=breaker)
+    >>> breaker.states()
+    """
+
+    DEFAULT_FAILURE_CODES = (INTERNAL_SERVER_ERROR, SERVICE_UNAVAILABLE)
+
+    def __init__(self, failure_threshold=5, window=60.0, reset_timeout=30.0,
+                 half_open_max_calls=1, per_token=False, failure_codes=None,
+                 metrics=None):
+        """
+
+        :param failure_threshold: int: number of failures opening the circuit
+        :param window: float: seconds the failures are counted within
+        :param reset_timeout: float: seconds the circuit stays open
+        :param half_open_max_calls: int: max number of concurrent probe
+        requests of a half-open circuit
+        :param per_token: bool: separate circuits per access token
+        :param failure_codes: iterable of API error codes counted as failures
+        :param metrics: vk_requests.metrics.MetricsRegistry instance
+        """
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.per_token = per_token
+        self.failure_codes = frozenset(
+            self.DEFAULT_FAILURE_CODES if failure_codes is None
+            else failure_codes)
+        self.metrics = metrics or MetricsRegistry()
+
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(failure_threshold=%s, reset_timeout=%s)' % (
+            self.__class__.__name__, self.failure_threshold,
+            self.reset_timeout)
+
+    def get_key(self, access_token, method_name):
+        """Circuit key of the request
+
+        :param access_token: str or None
+        :param method_name: str
+        :return: str: method name, prefixed with token id if per_token is set
+        """
+        if self.per_token:
+            return '%s.%s' % (get_token_id(access_token), method_name)
+        return method_name
+
+    def is_failure(self, vk_error):
+        """Check if the API error means the method is failing
+
+        :param vk_error: vk_requests.exceptions.VkAPIError instance
+        :return: bool
+        """
+        return vk_error.code in self.failure_codes
+
+    def acquire(self, key):
+        """Let the request through or fail fast. Every acquired request must
+        be followed by the record or release call
+
+        :param key: str: see get_key
+        :raise VkCircuitOpenError: if the circuit is open
+        """
+        with self._lock:
+            circuit = self._get_circuit(key)
+            if circuit.state == OPEN:
+                retry_after = \
+                    circuit.opened_at + self.reset_timeout - time.time()
+                if retry_after > 0:
+                    self._reject(key, retry_after)
+                circuit.probes = 0
+                self._set_state(key, circuit, HALF_OPEN)
+
+            if circuit.state == HALF_OPEN:
+                if circuit.probes >= self.half_open_max_calls:
+                    self._reject(key, 0)
+                circuit.probes += 1
+
+    def _reject(self, key, retry_after):
+        self.metrics.counter('circuit.%s.rejected' % key).inc()
+        raise VkCircuitOpenError(key, retry_after)
+
+    def release(self, key):
+        """Release the acquired request which has no result, e.g. it has
+        failed on the client side. The probe slot of a half-open circuit is
+        freed, the state is not changed
+
+        :param key: str: see get_key
+        """
+        with self._lock:
+            circuit = self._get_circuit(key)
+            if circuit.state == HALF_OPEN:
+                circuit.probes = max(0, circuit.probes - 1)
+
+    def record(self, key, success):
+        """Record the result of the request
+
+        :param key: str: see get_key
+        :param success: bool: False if the request is failed
+        """
+        with self._lock:
+            circuit = self._get_circuit(key)
+            now = time.time()
+            if circuit.state == HALF_OPEN:
+                circuit.probes = max(0, circuit.probes - 1)
+                if success:
+                    circuit.failures.clear()
+                    self._set_state(key, circuit, CLOSED)
+                else:
+                    self._open(key, circuit, now)
+                return
+
+            if success:
+                return
+            failures = circuit.failures
+            failures.append(now)
+            while failures and failures[0] <= now - self.window:
+                failures.popleft()
+            if circuit.state == CLOSED and \
+                    len(failures) >= self.failure_threshold:
+                self._open(key, circuit, now)
+
+    def _open(self, key, circuit, now):
+        circuit.opened_at = now
+        circuit.failures.clear()
+        self.metrics.counter('circuit.%s.opened' % key).inc()
+        self._set_state(key, circuit, OPEN)
+
+    def _get_circuit(self, key):
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = _Circuit()
+        return circuit
+
+    def _set_state(self, key, circuit, state):
+        if circuit.state != state:
+            logger.info('Circuit breaker of %s: %s -> %s',
+                        key, circuit.state, state)
+        circuit.state = state
+        self.metrics.gauge('circuit.%s.state' % key).set(_STATE_VALUES[state])
+
+    def state(self, key):
+        """Current state of the circuit: 'closed', 'open' or 'half_open'"""
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit.state if circuit is not None else CLOSED
+
+    def states(self):
+        """States of all known circuits
+
+        :return: dict: {key: state}
+        """
+        with self._lock:
+            return {key: circuit.state
+                    for key, circuit in self._circuits.items()}
+
+    def reset(self, key=None):
+        """Close the circuit (all circuits if key is not given)"""
+        with self._lock:
+            keys = [key] if key is not None else list(self._circuits)
+            for key in keys:
+                circuit = self._get_circuit(key)
+                circuit.failures.clear()
+                circuit.probes = 0
+                self._set_state(key, circuit, CLOSED)
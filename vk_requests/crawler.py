@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""Multi-process crawler: the input is split into shards which are
+processed by a pool of worker processes, every worker has own session and
+token(s).
+
+Example:
+
+>>> def fetch_wall(api, owner_id):
+>>>     return api.wall.get(owner_id=owner_id, count=100)['items']
+
+>>> crawler = Crawler(fetch_wall, tokens=['token1', 'token2'], processes=2)
+>>> for result in crawler.run(owner_ids):
+>>>     print(result.item, result.ok, result.result or result.error)
+>>> crawler.stats()
+
+The task function must be picklable (defined at the module level). It gets
+vk_requests.api.API instance and an input item.
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from vk_requests.api import API
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.session import VKSession
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class CrawlResult(object):
+    __slots__ = ('item', 'result', 'error')
+
+    def __init__(self, item, result=None, error=None):
+        """
+        :param item: input item
+        :param result: value returned by the task
+        :param error: str: error representation if the task is failed
+        (exceptions are not sent between processes as is, not all of them
+        can be pickled)
+        """
+        self.item = item
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(item=%s, ok=%s)' % (
+            self.__class__.__name__, self.item, self.ok)
+
+
+# State of a worker process, see _init_worker
+_worker = {}
+
+
+def _init_worker(session_params, api_params):
+    # Tokens are sent with the shards, so a worker started by the pool in
+    # place of a dead or recycled one doesn't wait for them
+    _worker['session_params'] = session_params
+    _worker['api_params'] = api_params
+    # index of the tokens -> list of API instances
+    _worker['apis'] = {}
+    logger.debug('Crawler worker %s is started', os.getpid())
+
+
+def _get_apis(tokens_index, tokens):
+    apis = _worker['apis'].get(tokens_index)
+    if apis is None:
+        apis = _worker['apis'][tokens_index] = [
+            API(session=VKSession(service_token=token,
+                                  **_worker['session_params']),
+                **_worker['api_params'])
+            for token in tokens]
+    return apis
+
+
+def _run_shard(task, tokens_index, tokens, shard):
+    """Process the shard in a worker process, the errors are returned in
+    the results
+
+    :return: tuple of (tokens index, list of CrawlResult, shard stats dict)
+    """
+    started_at = time.time()
+    try:
+        apis = _get_apis(tokens_index, tokens)
+    except Exception as err:
+        error = 'Failed to create the session: %r' % err
+        results = [CrawlResult(item, error=error) for item in shard]
+        apis = []
+    else:
+        next_api = itertools.cycle(apis)
+        results = []
+        for item in shard:
+            try:
+                results.append(
+                    CrawlResult(item, result=task(next(next_api), item)))
+            except Exception as err:
+                results.append(CrawlResult(item, error=repr(err)))
+    stats = {
+        'pid': os.getpid(),
+        'time': time.time() - started_at,
+        'metrics': _merge_snapshots(
+            api.session.metrics.snapshot()
+            for apis in _worker['apis'].values() for api in apis),
+    }
+    return tokens_index, results, stats
+
+
+def _merge_snapshots(snapshots):
+    """Sum counters of the session metrics snapshots"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, value in snapshot.items():
+            if isinstance(value, (int, float)):
+                merged[name] = merged.get(name, 0) + value
+    return merged
+
+
+def split_shards(items, shard_size):
+    """Split the items into lists of shard_size items
+
+    :param items: iterable
+    :param shard_size: int
+    :return: generator of lists
+    """
+    items = iter(items)
+    while True:
+        shard = list(itertools.islice(items, shard_size))
+        if not shard:
+            return
+        yield shard
+
+
+class Crawler(object):
+    """Run the task over the input items in a pool of worker processes"""
+
+    # Seconds between the checks of the failed shards
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, task, tokens=None, processes=None, shard_size=100,
+                 session_params=None, api_params=None,
+                 max_shards_per_worker=None):
+        """
+
+        :param task: picklable callable(api, item) -> result
+        :param tokens: list of service or user access tokens, they're
+        distributed between the workers, every worker rotates own tokens.
+        If there are fewer tokens than processes, workers share the tokens
+        :param processes: int: number of worker processes, cpu count by
+        default
+        :param shard_size: int: items per shard, results of a shard are sent
+        back to the parent process in one message
+        :param session_params: dict: extra VKSession parameters
+        :param api_params: dict: extra API parameters (e.g. http_params)
+        :param max_shards_per_worker: int: worker process is replaced with a
+        new one after this number of shards (frees the memory of leaky
+        tasks), workers live as long as the pool by default
+        """
+        self.task = task
+        self.tokens = list(tokens or [None])
+        self.processes = processes or multiprocessing.cpu_count()
+        self.shard_size = shard_size
+        self.session_params = dict(session_params or {})
+        self.api_params = dict(api_params or {})
+        self.max_shards_per_worker = max_shards_per_worker
+        self.metrics = MetricsRegistry()
+        self._workers = {}
+        self._started_at = None
+        self._finished_at = None
+
+        if len(self.tokens) < self.processes:
+            logger.warning('%s tokens are shared by %s processes, use '
+                           'cross-process rate limiting to stay within the '
+                           'token limits', len(self.tokens), self.processes)
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(task=%s, processes=%s)' % (
+            self.__class__.__name__, self.task, self.processes)
+
+    def get_worker_tokens(self):
+        """Tokens of every worker process, every list is used by one
+        shard at a time
+
+        :return: list of lists
+        """
+        if len(self.tokens) >= self.processes:
+            return [self.tokens[i::self.processes]
+                    for i in range(self.processes)]
+        return [[self.tokens[i % len(self.tokens)]]
+                for i in range(self.processes)]
+
+    def run(self, items):
+        """Process the items
+
+        Items are read lazily: a shard is sent to the pool when a token
+        list is free, so at most one shard per process is in flight.
+
+        :param items: iterable of input items (ids, owner_ids, etc)
+        :return: generator of CrawlResult in the order of completion
+        """
+        worker_tokens = self.get_worker_tokens()
+        free_tokens = list(range(len(worker_tokens)))
+        done = queue.Queue()
+
+        self._started_at = time.time()
+        self._finished_at = None
+        pool = multiprocessing.Pool(
+            processes=self.processes, initializer=_init_worker,
+            initargs=(self.session_params, self.api_params),
+            maxtasksperchild=self.max_shards_per_worker)
+        try:
+            shards = split_shards(items, self.shard_size)
+            # tokens index -> AsyncResult of the shard
+            pending = {}
+            exhausted = False
+            while True:
+                while free_tokens and not exhausted:
+                    shard = next(shards, None)
+                    if shard is None:
+                        exhausted = True
+                        break
+                    tokens_index = free_tokens.pop()
+                    pending[tokens_index] = pool.apply_async(
+                        _run_shard, (self.task, tokens_index,
+                                     worker_tokens[tokens_index], shard),
+                        callback=done.put)
+                if not pending:
+                    break
+                try:
+                    tokens_index, results, stats = done.get(
+                        timeout=self.POLL_INTERVAL)
+                except queue.Empty:
+                    # The callback isn't called if the shard is failed
+                    # (e.g. the results can't be pickled), get() raises
+                    # its error
+                    for async_result in pending.values():
+                        if async_result.ready() and \
+                                not async_result.successful():
+                            async_result.get()
+                    continue
+                del pending[tokens_index]
+                free_tokens.append(tokens_index)
+                self._on_shard(results, stats)
+                for result in results:
+                    yield result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self._finished_at = time.time()
+
+    def _on_shard(self, results, stats):
+        errors = sum(1 for result in results if not result.ok)
+        self.metrics.counter('crawler.shards').inc()
+        self.metrics.counter('crawler.items').inc(len(results))
+        self.metrics.counter('crawler.errors').inc(errors)
+        self.metrics.histogram('crawler.shard_time').observe(stats['time'])
+        # Session metrics are cumulative per worker, keep the last snapshot
+        self._workers[stats['pid']] = stats['metrics']
+
+    def stats(self):
+        """Aggregated throughput stats and session metrics of the workers
+
+        :return: dict
+        """
+        metrics = self.metrics.snapshot()
+        items = metrics.get('crawler.items', 0)
+        finished_at = self._finished_at or time.time()
+        elapsed = finished_at - self._started_at if self._started_at else 0
+        return {
+            'items': items,
+            'errors': metrics.get('crawler.errors', 0),
+            'items_per_sec': items / elapsed if elapsed else 0.0,
+            'workers': len(self._workers),
+            'session_metrics': _merge_snapshots(self._workers.values()),
+            'metrics': metrics,
+        }
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Bulk media downloader for API results (photos, wall posts, docs)
+
+Media urls are extracted from the items, every url is downloaded once,
+bodies are streamed to disk and the partial downloads are resumed on the
+next run.
+
+Example:
+
+>>> downloader = Downloader(max_workers=8)
+>>> items = paginate(api.photos.getAll, owner_id=1)
+>>> results = downloader.download(extract_media_urls(items), '/data/photos')
+>>> downloader.stats()['bytes_per_sec']
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from six.moves.urllib.parse import urlparse
+
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.utils import SharedPoolSessions
+
+
+logger = logging.getLogger('vk-requests')
+
+
+# Photo size types from the largest to the smallest,
+# see https://vk.com/dev/photo_sizes
+DEFAULT_SIZE_PREFERENCE = ('w', 'z', 'y', 'x', 'r', 'q', 'p', 'o', 'm', 's')
+
+# Legacy photo objects (api version < 5.77) have the url per width
+_LEGACY_PHOTO_KEYS = ('photo_2560', 'photo_1280', 'photo_807', 'photo_604',
+                      'photo_130', 'photo_75')
+
+# Attachment types which media is downloaded
+MEDIA_ATTACHMENT_TYPES = ('photo', 'doc')
+
+PART_SUFFIX = '.part'
+
+
+def get_photo_url(photo, size_preference=DEFAULT_SIZE_PREFERENCE):
+    """Get the url of the preferred size of the photo
+
+    :param photo: dict: photo object
+    :param size_preference: sequence of size types, the first available
+    one is chosen
+    :return: str or None
+    """
+    sizes = {size.get('type'): size.get('url') or size.get('src')
+             for size in photo.get('sizes') or ()}
+    for size_type in size_preference:
+        if sizes.get(size_type):
+            return sizes[size_type]
+    for key in _LEGACY_PHOTO_KEYS:
+        if photo.get(key):
+            return photo[key]
+    return None
+
+
+def extract_media_urls(items, size_preference=DEFAULT_SIZE_PREFERENCE):
+    """Get media urls from API result items: photos, docs and wall posts
+    (including attachments of the reposted ones)
+
+    :param items: iterable of photo, doc or post objects
+    :param size_preference: sequence of photo size types
+    :return: generator of urls
+    """
+    for item in items:
+        for url in _extract_item_urls(item, size_preference):
+            yield url
+
+
+def _extract_item_urls(item, size_preference, item_type=None):
+    if item_type in (None, 'photo') and (
+            'sizes' in item or
+            any(key in item for key in _LEGACY_PHOTO_KEYS)):
+        url = get_photo_url(item, size_preference)
+        if url:
+            yield url
+        return
+
+    if item_type is None and ('attachments' in item or
+                              'copy_history' in item):
+        for attachment in item.get('attachments') or ():
+            attachment_type = attachment.get('type')
+            # Links, audios, market items etc. have urls of web pages
+            if attachment_type not in MEDIA_ATTACHMENT_TYPES:
+                continue
+            media = attachment.get(attachment_type)
+            if isinstance(media, dict):
+                for url in _extract_item_urls(media, size_preference,
+                                              attachment_type):
+                    yield url
+        for post in item.get('copy_history') or ():
+            for url in _extract_item_urls(post, size_preference):
+                yield url
+        return
+
+    # Document, the items of docs.get have the extension
+    if item_type == 'doc' or (item_type is None and 'ext' in item):
+        if item.get('url'):
+            yield item['url']
+
+
+class DownloadResult(object):
+    __slots__ = ('url', 'path', 'size', 'skipped', 'error')
+
+    def __init__(self, url, path, size=0, skipped=False, error=None):
+        """
+        :param url: str: media url
+        :param path: str: file path
+        :param size: int: number of bytes downloaded by this run
+        :param skipped: bool: the file existed already
+        :param error: exception if the download is failed
+        """
+        self.url = url
+        self.path = path
+        self.size = size
+        self.skipped = skipped
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(url=%s, ok=%s)' % (
+            self.__class__.__name__, self.url, self.ok)
+
+
+class Downloader(object):
+    """Concurrent media downloader.
+
+    Files are written to '<name>.part' and renamed when they're complete,
+    so existing files are skipped and '.part' files are resumed with the
+    Range header.
+    """
+
+    def __init__(self, max_workers=8, chunk_size=64 * 1024, http_params=None,
+                 max_pending=None):
+        """
+
+        :param max_workers: int: number of parallel downloads, it's also the
+        connection pool size
+        :param chunk_size: int: size of the chunks written to disk
+        :param http_params: dict: requests http parameters of the downloads
+        :param max_pending: int: max number of the urls waiting for a worker,
+        reading of the urls is paused when it's reached
+        (max_workers * 4 by default)
+        """
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.http_params = dict(http_params or {'timeout': 60})
+        self.max_pending = max_pending or max_workers * 4
+        self.metrics = MetricsRegistry()
+        self.http_sessions = SharedPoolSessions(pool_size=max_workers)
+
+        self._started_at = None
+
+    def get_filename(self, url):
+        """File name of the url. It's stable between the runs, so the
+        downloaded files can be found again
+
+        :param url: str
+        :return: str
+        """
+        ext = os.path.splitext(urlparse(url).path)[1][:10]
+        return hashlib.sha1(url.encode('utf-8')).hexdigest() + ext
+
+    def download(self, urls, directory):
+        """Download the urls to the directory, duplicated urls are
+        downloaded once
+
+        :param urls: iterable of urls, e.g. extract_media_urls(items)
+        :param directory: str: target directory, created if needed
+        :return: list of DownloadResult, one per unique url
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if self._started_at is None:
+            self._started_at = time.time()
+
+        seen = set()
+        futures = []
+        pending = threading.BoundedSemaphore(self.max_pending)
+
+        def download(url, path):
+            try:
+                return self._download(url, path)
+            finally:
+                pending.release()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for url in urls:
+                if url in seen:
+                    self.metrics.counter('download.duplicates').inc()
+                    continue
+                seen.add(url)
+                path = os.path.join(directory, self.get_filename(url))
+                pending.acquire()
+                futures.append(executor.submit(download, url, path))
+        return [future.result() for future in futures]
+
+    def _download(self, url, path):
+        if os.path.exists(path):
+            self.metrics.counter('download.skipped').inc()
+            return DownloadResult(url, path, skipped=True)
+
+        try:
+            size = self._fetch(url, path)
+        except Exception as err:
+            logger.warning('Download of %s failed: %r', url, err)
+            self.metrics.counter('download.errors').inc()
+            return DownloadResult(url, path, error=err)
+        return DownloadResult(url, path, size=size)
+
+    def _fetch(self, url, path):
+        """Stream the url body to the file, resume the partial download
+
+        :return: int: number of bytes downloaded
+        """
+        part_path = path + PART_SUFFIX
+        offset = os.path.getsize(part_path) \
+            if os.path.exists(part_path) else 0
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+
+        started_at = time.time()
+        response = self.http_sessions.session.get(
+            url, headers=headers, stream=True, **self.http_params)
+        try:
+            if offset and response.status_code == 416:
+                # Range not satisfiable: the part is complete already
+                os.rename(part_path, path)
+                return 0
+            response.raise_for_status()
+
+            if offset and response.status_code == 206:
+                self.metrics.counter('download.resumed').inc()
+                mode = 'ab'
+            else:
+                # Server ignored the range, download from the beginning
+                mode = 'wb'
+
+            size = 0
+            with open(part_path, mode) as fd:
+                for chunk in response.iter_content(self.chunk_size):
+                    fd.write(chunk)
+                    size += len(chunk)
+                    self.metrics.counter('download.bytes').inc(len(chunk))
+        finally:
+            response.close()
+
+        os.rename(part_path, path)
+        self.metrics.counter('download.files').inc()
+        self.metrics.histogram('download.time').observe(
+            time.time() - started_at)
+        return size
+
+    def close(self):
+        self.http_sessions.close()
+
+    def stats(self):
+        """Download throughput stats
+
+        :return: dict
+        """
+        metrics = self.metrics.snapshot()
+        downloaded = metrics.get('download.bytes', 0)
+        elapsed = time.time() - self._started_at if self._started_at else 0
+        return {
+            'files': metrics.get('download.files', 0),
+            'bytes': downloaded,
+            'bytes_per_sec': downloaded / elapsed if elapsed else 0.0,
+            'skipped': metrics.get('download.skipped', 0),
+            'duplicates': metrics.get('download.duplicates', 0),
+            'errors': metrics.get('download.errors', 0),
+            'metrics': metrics,
+        }
@@ -2,12 +2,19 @@
 
 # API Error Codes
 AUTHORIZATION_FAILED = 5        # Invalid access token
+TOO_MANY_REQUESTS = 6           # Too many requests per second
 PERMISSION_IS_DENIED = 7
+FLOOD_CONTROL = 9
+INTERNAL_SERVER_ERROR = 10
 CAPTCHA_IS_NEEDED = 14
 ACCESS_DENIED = 15              # No access to call this method
 USER_IS_DELETED_OR_BANNED = 18  # User deactivated
+RATE_LIMIT_REACHED = 29         # Daily limit of the method is reached
+SERVICE_UNAVAILABLE = 30
 INVALID_USER_ID = 113
 
+RATE_LIMIT_ERRORS = (TOO_MANY_REQUESTS, FLOOD_CONTROL, RATE_LIMIT_REACHED)
+
 
 class VkException(Exception):
     pass
@@ -27,6 +34,43 @@ class VkPageWarningsError(VkParseError):
     pass
 
 
+class VkLongPollError(VkException):
+    """Raised when long poll server returns unknown error"""
+    pass
+
+
+class VkReplayError(VkException):
+    """Raised when the replayed request is not found in the cassette"""
+    pass
+
+
+class VkCircuitOpenError(VkException):
+    """Raised without sending the request when the circuit breaker of the
+    method is open"""
+
+    def __init__(self, method_name, retry_after):
+        super(VkCircuitOpenError, self).__init__(
+            'Circuit breaker of %s is open, retry after %.1f sec'
+            % (method_name, retry_after))
+        self.method_name = method_name
+        self.retry_after = retry_after
+
+
+class VkDeadlineExceeded(VkException):
+    """Raised when the time budget of the call (deadline call option) is
+    used up"""
+
+    def __init__(self, deadline, phase=None):
+        """
+        :param deadline: float: time budget of the call in seconds
+        :param phase: str: phase of the call, e.g. 'auth', 'wait', 'send'
+        """
+        super(VkDeadlineExceeded, self).__init__(
+            'Deadline of %.1f sec is exceeded (%s)' % (deadline, phase))
+        self.deadline = deadline
+        self.phase = phase
+
+
 class VkAPIError(VkException):
     __slots__ = ['error', 'code', 'message', 'request_params', 'redirect_uri']
 
@@ -55,6 +99,9 @@ class VkAPIError(VkException):
     def is_user_deleted_or_banned(self):
         return self.code == USER_IS_DELETED_OR_BANNED
 
+    def is_rate_limited(self):
+        return self.code in RATE_LIMIT_ERRORS
+
     @property
     def captcha_sid(self):
         return self.error_data.get('captcha_sid')
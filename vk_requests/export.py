@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Streaming export of paginated results to files.
+
+Items are written page by page as they arrive, so the memory use doesn't
+depend on the number of items. The output is fsync'd periodically and the
+export position (method offset and the output size) is checkpointed after
+every sync: the restarted export discards the output written after the
+last checkpoint and resumes from its offset, so every item is written
+exactly once.
+
+Example:
+
+>>> paginator = Paginator(api.wall.get, {'owner_id': 1})
+>>> checkpoint = Checkpointer(FileCheckpointStore('export.json'),
+>>>                           key='wall:1')
+>>> export(paginator, NDJSONWriter('wall_1.jsonl.gz'), checkpoint=checkpoint)
+
+ParquetWriter writes columnar files (requires pyarrow).
+"""
+import collections
+import gzip
+import json
+import logging
+import os
+import re
+import time
+
+from vk_requests.checkpoint import fsync_dir, replace
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class ExportWriter(object):
+    """Export output interface"""
+
+    def open(self, position=None):
+        """Open the output
+
+        :param position: position returned by sync() of the interrupted
+        export, the output written after it is discarded. New output is
+        started if it's None
+        """
+        raise NotImplementedError
+
+    def write(self, items):
+        """
+        :param items: list of items (dicts)
+        """
+        raise NotImplementedError
+
+    def sync(self):
+        """Durably save the written items
+
+        :return: json serializable position of the output
+        """
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class NDJSONWriter(ExportWriter):
+    """Newline delimited JSON file, one item per line. Gzipped if the path
+    ends with .gz: every sync finishes a gzip member, so the file is always
+    readable up to the last sync"""
+
+    def __init__(self, path, compression=None):
+        """
+        :param path: str: file path
+        :param compression: 'gzip' or None, detected by the path if it's
+        not given
+        """
+        self.path = path
+        if compression is None and path.endswith('.gz'):
+            compression = 'gzip'
+        if compression not in (None, 'gzip'):
+            raise ValueError('Unsupported compression %r' % compression)
+        self.compression = compression
+        self._file = None
+        self._stream = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(path=%s)' % (self.__class__.__name__, self.path)
+
+    def open(self, position=None):
+        if position is None:
+            self._file = open(self.path, 'wb')
+            return
+        # The items written before the checkpoint would be lost
+        if not os.path.exists(self.path):
+            raise ValueError("Can't resume the export: %s is missing, remove "
+                             "the checkpoint to export from the start"
+                             % self.path)
+        if os.path.getsize(self.path) < position:
+            raise ValueError("Can't resume the export: %s is shorter than "
+                             "the checkpointed %s bytes" % (self.path,
+                                                            position))
+        self._file = open(self.path, 'r+b')
+        self._file.truncate(position)
+        self._file.seek(position)
+
+    def write(self, items):
+        data = b''.join(json.dumps(item, ensure_ascii=False).encode('utf-8')
+                        + b'\n' for item in items)
+        if self._stream is None:
+            if self.compression == 'gzip':
+                self._stream = gzip.GzipFile(fileobj=self._file, mode='wb',
+                                             mtime=0)
+            else:
+                self._stream = self._file
+        self._stream.write(data)
+
+    def sync(self):
+        if self._stream is not None and self._stream is not self._file:
+            # Finish the gzip member, the file object stays open
+            self._stream.close()
+        self._stream = None
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return self._file.tell()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+class ParquetWriter(ExportWriter):
+    """Columnar output: a directory of parquet files with one row group of
+    up to row_group_size items each. Nested values (dicts, lists) are stored
+    as JSON strings, so the items don't have to share the schema"""
+
+    PART_NAME = 'part-%05d.parquet'
+    PART_NAME_RE = re.compile(r'^part-(\d+)\.parquet$')
+
+    def __init__(self, directory, row_group_size=10000,
+                 compression='snappy'):
+        """
+        :param directory: str: output directory
+        :param row_group_size: int: max number of items kept in memory and
+        written as one row group
+        :param compression: str: parquet compression codec
+        """
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.parts = 0
+        self._rows = []
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(directory=%s)' % (self.__class__.__name__, self.directory)
+
+    def open(self, position=None):
+        try:
+            import pyarrow  # noqa
+        except ImportError:
+            raise ImportError('pyarrow is required for parquet export, '
+                              'install it with pip install pyarrow')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.parts = position or 0
+        # Drop the parts written after the position
+        for name in os.listdir(self.directory):
+            match = self.PART_NAME_RE.match(name)
+            if match and int(match.group(1)) >= self.parts:
+                os.unlink(os.path.join(self.directory, name))
+
+    def write(self, items):
+        for item in items:
+            self._rows.append({
+                key: json.dumps(value, ensure_ascii=False)
+                if isinstance(value, (dict, list)) else value
+                for key, value in item.items()})
+            if len(self._rows) >= self.row_group_size:
+                self._write_part()
+
+    def _write_part(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        # Columns are built from the keys of all the rows, the items of
+        # the same method can have different keys
+        table = pyarrow.Table.from_pydict(_to_columns(self._rows))
+        path = os.path.join(self.directory, self.PART_NAME % self.parts)
+        tmp_path = path + '.tmp'
+        pyarrow.parquet.write_table(table, tmp_path,
+                                    compression=self.compression)
+        with open(tmp_path, 'rb') as fd:
+            os.fsync(fd.fileno())
+        replace(tmp_path, path)
+        self.parts += 1
+        self._rows = []
+
+    def sync(self):
+        if self._rows:
+            self._write_part()
+        fsync_dir(self.directory)
+        return self.parts
+
+    def close(self):
+        self.sync()
+
+
+def _to_columns(rows):
+    """
+    :param rows: list of dicts
+    :return: OrderedDict: {key: list of values}, None for the missing keys
+    """
+    keys = collections.OrderedDict((key, None)
+                                   for row in rows for key in row)
+    return collections.OrderedDict(
+        (key, [row.get(key) for row in rows]) for key in keys)
+
+
+def export(paginator, writer, checkpoint=None, sync_every=10000,
+           sync_interval=10.0):
+    """Write all items of the paginator to the writer
+
+    :param paginator: vk_requests.pagination.Paginator instance without
+    checkpoint, the export checkpoints it itself
+    :param writer: ExportWriter instance
+    :param checkpoint: vk_requests.checkpoint.Checkpointer instance, the
+    export resumes from its position
+    :param sync_every: int: sync the output after this number of items
+    :param sync_interval: float: sync the output if the last sync was more
+    than this number of seconds ago
+    :return: int: number of items written by this run
+    """
+    if paginator.checkpoint is not None:
+        raise ValueError('Paginator checkpoint is not synced with the output, '
+                         'pass the checkpoint to export instead')
+    position = checkpoint.position if checkpoint is not None else None
+    if position is not None:
+        start_offset = paginator.offset
+        paginator.offset = position['offset']
+        if paginator.limit is not None:
+            # Items exported before the interruption count towards the limit
+            paginator.limit = max(
+                paginator.limit - (paginator.offset - start_offset), 0)
+        logger.info('Export is resumed from offset %s', paginator.offset)
+    writer.open(position['output'] if position is not None else None)
+
+    written = pending = 0
+    synced_at = time.time()
+    try:
+        for page in paginator.iter_pages():
+            writer.write(page.items)
+            written += len(page.items)
+            pending += len(page.items)
+            if pending >= sync_every or \
+                    time.time() - synced_at >= sync_interval:
+                _sync(paginator, writer, checkpoint)
+                pending, synced_at = 0, time.time()
+        _sync(paginator, writer, checkpoint)
+    finally:
+        writer.close()
+    return written
+
+
+def _sync(paginator, writer, checkpoint):
+    output_position = writer.sync()
+    if checkpoint is not None:
+        checkpoint.ack({'offset': paginator.offset, 'output': output_position})
+        checkpoint.flush()
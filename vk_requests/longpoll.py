@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+"""Bots Long Poll and User Long Poll clients
+
+Docs: https://vk.com/dev/bots_longpoll, https://vk.com/dev/using_longpoll
+
+Example:
+
+>>> api = vk_requests.create_api(service_token='{GROUP_TOKEN}')
+>>> longpoll = BotsLongPoll(api, group_id=1)
+
+>>> @longpoll.on('message_new')
+>>> def handle_message(update):
+>>>     print(update['object'])
+
+>>> longpoll.run(workers=4)
+"""
+import collections
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from vk_requests.exceptions import VkLongPollError
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.utils import VerboseHTTPSession
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class LongPoll(object):
+    """Base Long Poll client. Subclasses define how to get the server and
+    how to get the type of an update"""
+
+    # Long Poll errors, see 'failed' field of the response
+    FAILED_TS_OUTDATED = 1
+    FAILED_KEY_EXPIRED = 2
+    FAILED_INFO_LOST = 3
+
+    # Handlers registered for this type get all the updates
+    ALL_UPDATES = '*'
+
+    def __init__(self, api, wait=25, http_params=None, checkpoint=None,
+                 retry_delay=1.0, max_retry_delay=60.0):
+        """
+
+        :param api: vk_requests.api.API instance
+        :param wait: int: max seconds to wait for updates per request (<= 90)
+        :param http_params: dict: extra requests http parameters
+        :param checkpoint: vk_requests.checkpoint.Checkpointer instance, ts
+        is acknowledged when all the updates received with it are processed,
+        polling resumes from the saved ts
+        :param retry_delay: float: delay before the request after a network
+        error or 5xx response, it's doubled for every next error in a row
+        :param max_retry_delay: float: max delay between the retries
+        """
+        self.api = api
+        self.wait = wait
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._errors_in_row = 0
+        self.http_params = dict(http_params or {})
+        # Request hangs for 'wait' seconds on the server side
+        self.http_params.setdefault('timeout', wait + 10)
+
+        self.server = None
+        self.key = None
+        self.checkpoint = checkpoint
+        self.ts = checkpoint.position if checkpoint is not None else None
+
+        self.metrics = MetricsRegistry()
+        self._handlers = collections.defaultdict(list)
+        self._buffer = collections.deque()
+        self._stopped = threading.Event()
+        self._http_session = None
+        self._started_at = None
+
+        # Batches of updates (one per poll) which are not processed yet
+        self._batches = collections.deque()
+        self._batches_lock = threading.Lock()
+        self._last_batch = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(server=%s, ts=%s)' % (
+            self.__class__.__name__, self.server, self.ts)
+
+    @property
+    def http_session(self):
+        """Keep-alive HTTP session used for polling, the connection is
+        reused between the requests"""
+        if self._http_session is None:
+            session = VerboseHTTPSession()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._http_session = session
+        return self._http_session
+
+    def get_server(self):
+        """Get long poll server parameters
+
+        :return: dict with 'server', 'key' and 'ts' keys
+        """
+        raise NotImplementedError
+
+    def get_poll_params(self):
+        """Get long poll request parameters
+
+        :return: tuple of (url, params dict)
+        """
+        raise NotImplementedError
+
+    def get_update_type(self, update):
+        raise NotImplementedError
+
+    def update_server(self, update_ts=True):
+        """(Re)load server and key, and optionally ts
+
+        :param update_ts: bool: False to keep current ts (e.g. only the key
+        is expired)
+        """
+        params = self.get_server()
+        self.server = params['server']
+        self.key = params['key']
+        if update_ts or self.ts is None:
+            self.ts = params['ts']
+        self.metrics.counter('longpoll.server_updates').inc()
+
+    def poll(self):
+        """Do one long poll request
+
+        :return: list of updates
+        """
+        started_at = time.time()
+        if self._started_at is None:
+            self._started_at = started_at
+        try:
+            if self.server is None:
+                # Keep ts restored from the checkpoint
+                self.update_server(update_ts=self.ts is None)
+            url, params = self.get_poll_params()
+            response = self.http_session.get(url, params=params,
+                                             **self.http_params)
+            response.raise_for_status()
+            payload = response.json()
+        except requests.HTTPError as err:
+            status_code = getattr(err.response, 'status_code', None)
+            if status_code is not None and status_code < 500:
+                raise
+            self._on_network_error(err)
+            return []
+        except (requests.ConnectionError, requests.Timeout) as err:
+            self._on_network_error(err)
+            return []
+        self._errors_in_row = 0
+        self.metrics.counter('longpoll.polls').inc()
+        self.metrics.histogram('longpoll.poll_time').observe(
+            time.time() - started_at)
+
+        failed = payload.get('failed')
+        if failed is not None:
+            self.metrics.counter('longpoll.failed.%s' % failed).inc()
+            logger.info('Long poll request failed with code %s', failed)
+            if failed == self.FAILED_TS_OUTDATED:
+                self.ts = payload['ts']
+            elif failed == self.FAILED_KEY_EXPIRED:
+                self.update_server(update_ts=False)
+            elif failed == self.FAILED_INFO_LOST:
+                self.update_server()
+            else:
+                raise VkLongPollError('Long poll error: %s' % payload)
+            return []
+
+        self.ts = payload['ts']
+        updates = payload.get('updates', [])
+        self.metrics.counter('longpoll.updates').inc(len(updates))
+        return updates
+
+    def _on_network_error(self, err):
+        """Back off and get the server again, ts is kept, so no updates
+        are lost"""
+        self._errors_in_row += 1
+        delay = min(self.retry_delay * 2 ** (self._errors_in_row - 1),
+                    self.max_retry_delay)
+        self.metrics.counter('longpoll.network_errors').inc()
+        logger.warning('Long poll request failed (%s in a row): %r, retry in '
+                       '%.1f sec', self._errors_in_row, err, delay)
+        self.server = None
+        # Interrupted by stop()
+        self._stopped.wait(delay)
+
+    def stop(self):
+        """Stop iteration after the current long poll request"""
+        self._stopped.set()
+
+    def _complete(self, batch):
+        """Mark one update of the batch as processed and acknowledge ts of
+        the batches processed completely (in the order they were received)
+        """
+        if batch is None:
+            return
+        with self._batches_lock:
+            batch.remaining -= 1
+            while self._batches and self._batches[0].remaining <= 0:
+                done = self._batches.popleft()
+                if self.checkpoint is not None:
+                    self.checkpoint.ack(done.ts)
+
+    def _flush_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.flush()
+
+    @property
+    def is_stopped(self):
+        return self._stopped.is_set()
+
+    def _next_update(self, stop_exception):
+        """Get the next update
+
+        :return: tuple of (update, received_at, batch)
+        """
+        while not self._buffer:
+            if self.is_stopped:
+                self._flush_checkpoint()
+                raise stop_exception()
+            received_at = time.time()
+            updates = self.poll()
+            # 1 for the poll itself, it's completed right after buffering
+            batch = _Batch(ts=self.ts, remaining=len(updates) + 1)
+            with self._batches_lock:
+                self._batches.append(batch)
+            self._buffer.extend(
+                (update, received_at, batch) for update in updates)
+            self._complete(batch)
+        return self._buffer.popleft()
+
+    def _next_iterated_update(self, stop_exception):
+        # Caller asks for the next update, so the previous one is processed
+        last_batch, self._last_batch = self._last_batch, None
+        self._complete(last_batch)
+        update, _, self._last_batch = self._next_update(stop_exception)
+        return update
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """Get the next update, the iteration is infinite until stop()"""
+        return self._next_iterated_update(StopIteration)
+
+    next = __next__  # Python 2
+
+    def __aiter__(self):
+        """Async iterator, long poll requests are done in the loop executor,
+        the buffered updates are returned without switching threads
+
+        >>> async for update in longpoll:
+        >>>     print(update)
+        """
+        return self
+
+    def __anext__(self):
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        if self._buffer:
+            future = loop.create_future()
+            future.set_result(self._next_iterated_update(StopAsyncIteration))
+            return future
+
+        return loop.run_in_executor(None, self._next_iterated_update,
+                                    StopAsyncIteration)
+
+    def on(self, update_type=ALL_UPDATES):
+        """Handler decorator
+
+        :param update_type: type of the updates (e.g 'message_new' for bots
+        long poll or 4 for user long poll), all updates if not given
+        """
+        def decorator(fn):
+            self._handlers[update_type].append(fn)
+            return fn
+        return decorator
+
+    def dispatch(self, update, received_at=None):
+        """Call the handlers of the update
+
+        :param update: update data
+        :param received_at: float: time when the update has been received
+        """
+        update_type = self.get_update_type(update)
+        started_at = time.time()
+        if received_at is not None:
+            self.metrics.histogram('longpoll.lag').observe(
+                started_at - received_at)
+        handlers = self._handlers.get(update_type, []) + \
+            self._handlers.get(self.ALL_UPDATES, [])
+        for handler in handlers:
+            try:
+                handler(update)
+            except Exception:
+                self.metrics.counter('longpoll.handler_errors').inc()
+                logger.exception('Long poll handler %r failed', handler)
+        self.metrics.counter('longpoll.dispatched.%s' % update_type).inc()
+        self.metrics.histogram('longpoll.handler_time').observe(
+            time.time() - started_at)
+
+    def run(self, workers=4, max_pending=None):
+        """Poll the updates and dispatch them to the handlers in the worker
+        pool until stop() is called
+
+        :param workers: int: number of worker threads
+        :param max_pending: int: max number of the updates waiting for a
+        worker, polling is paused when it's reached (workers * 10 by default)
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        pending = threading.BoundedSemaphore(max_pending or workers * 10)
+
+        def dispatch(update, received_at, batch):
+            try:
+                try:
+                    self.dispatch(update, received_at)
+                except Exception:
+                    # Malformed update is skipped, it must not stop the
+                    # checkpoint of the next ones
+                    self.metrics.counter('longpoll.dispatch_errors').inc()
+                    logger.exception('Long poll update %r is skipped', update)
+                self._complete(batch)
+            finally:
+                pending.release()
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while True:
+                try:
+                    update, received_at, batch = self._next_update(
+                        StopIteration)
+                except StopIteration:
+                    break
+                pending.acquire()
+                executor.submit(dispatch, update, received_at, batch)
+        finally:
+            executor.shutdown(wait=True)
+            self._flush_checkpoint()
+
+    def stats(self):
+        """Throughput and lag stats
+
+        :return: dict
+        """
+        metrics = self.metrics.snapshot()
+        updates = metrics.get('longpoll.updates', 0)
+        elapsed = time.time() - self._started_at if self._started_at else 0
+        return {
+            'updates': updates,
+            'updates_per_sec': updates / elapsed if elapsed else 0.0,
+            'buffered': len(self._buffer),
+            'lag': metrics.get('longpoll.lag'),
+            'metrics': metrics,
+        }
+
+
+class _Batch(object):
+    __slots__ = ('ts', 'remaining')
+
+    def __init__(self, ts, remaining):
+        self.ts = ts
+        self.remaining = remaining
+
+
+class BotsLongPoll(LongPoll):
+    """Bots Long Poll API client, requires group access token
+    Docs: https://vk.com/dev/bots_longpoll
+    """
+
+    def __init__(self, api, group_id, wait=25, http_params=None,
+                 checkpoint=None, **kwargs):
+        super(BotsLongPoll, self).__init__(api, wait=wait,
+                                           http_params=http_params,
+                                           checkpoint=checkpoint, **kwargs)
+        self.group_id = group_id
+
+    def get_server(self):
+        return self.api.groups.getLongPollServer(group_id=self.group_id)
+
+    def get_poll_params(self):
+        params = {'act': 'a_check', 'key': self.key, 'ts': self.ts,
+                  'wait': self.wait}
+        return self.server, params
+
+    def get_update_type(self, update):
+        return update.get('type')
+
+
+class UserLongPoll(LongPoll):
+    """User Long Poll API client, requires user access token
+    Docs: https://vk.com/dev/using_longpoll
+    """
+
+    # Additional answer options, see 'mode' parameter in docs:
+    # attachments (2) + extended events set (8) + extra fields (64)
+    DEFAULT_MODE = 2 | 8 | 64
+    VERSION = 3
+
+    def __init__(self, api, wait=25, mode=DEFAULT_MODE, http_params=None,
+                 checkpoint=None, **kwargs):
+        super(UserLongPoll, self).__init__(api, wait=wait,
+                                           http_params=http_params,
+                                           checkpoint=checkpoint, **kwargs)
+        self.mode = mode
+
+    def get_server(self):
+        return self.api.messages.getLongPollServer(lp_version=self.VERSION)
+
+    def get_poll_params(self):
+        params = {'act': 'a_check', 'key': self.key, 'ts': self.ts,
+                  'wait': self.wait, 'mode': self.mode,
+                  'version': self.VERSION}
+        return 'https://%s' % self.server, params
+
+    def get_update_type(self, update):
+        # Update is a list, the first item is the event code
+        return update[0]
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Lightweight thread-safe metrics used by the library internals.
+
+Metrics are kept in memory only, use MetricsRegistry.snapshot() to export
+them to your monitoring system.
+"""
+import threading
+
+
+class Counter(object):
+    """Monotonically increasing counter"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, value=1):
+        with self._lock:
+            self._value += value
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Gauge(object):
+    """Value which can go up and down"""
+
+    def __init__(self, value=0):
+        self._value = value
+
+    def set(self, value):
+        self._value = value
+
+    @property
+    def value(self):
+        return self._value
+
+    def snapshot(self):
+        return self._value
+
+
+class Histogram(object):
+    """Distribution of observed values (e.g. durations in seconds).
+
+    Values are counted in cumulative buckets, min/max/sum are tracked as is.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self._lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets or self.DEFAULT_BUCKETS))
+        self._bucket_counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self._bucket_counts[i] += 1
+                    break
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def snapshot(self):
+        with self._lock:
+            buckets, total = {}, 0
+            for bound, count in zip(self.buckets, self._bucket_counts):
+                total += count
+                buckets[bound] = total
+            return {'count': self.count, 'sum': self.sum, 'min': self.min,
+                    'max': self.max, 'mean': self.mean, 'buckets': buckets}
+
+
+class MetricsRegistry(object):
+    """Named metrics container
+
+    Example:
+
+    >>> metrics = MetricsRegistry()
+    >>> metrics.counter('requests.sent').inc()
+    >>> metrics.snapshot()
+    {'requests.sent': 1}
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, name, cls, *args):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = cls(*args)
+        if not isinstance(metric, cls):
+            raise ValueError('Metric %r is already registered as %s'
+                             % (name, metric.__class__.__name__))
+        return metric
+
+    def counter(self, name):
+        return self._get_or_create(name, Counter)
+
+    def gauge(self, name):
+        return self._get_or_create(name, Gauge)
+
+    def histogram(self, name, buckets=None):
+        return self._get_or_create(name, Histogram, buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def snapshot(self, prefix=None):
+        """Get current values of the metrics
+
+        :param prefix: str: return only metrics which names start with it
+        :return: dict: {name: value}
+        """
+        with self._lock:
+            metrics = list(self._metrics.items())
+        return {name: metric.snapshot() for name, metric in metrics
+                if prefix is None or name.startswith(prefix)}
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""Pagination over the methods which return {'count': N, 'items': [...]}
+
+Example:
+
+>>> api = vk_requests.create_api(...)
+>>> for member_id in paginate(api.groups.getMembers, group_id=1):
+>>>     print(member_id)
+
+Server-side mode fetches up to 25 pages per HTTP request with a generated
+'execute' script (requires user token, service token can't call execute):
+
+>>> paginate(api.groups.getMembers, group_id=1, mode='execute')
+"""
+import logging
+
+from vk_requests.api import Request
+from vk_requests.exceptions import VkAPIError
+from vk_requests.utils import stringify_values
+from vk_requests.vkscript import ScriptCache
+
+
+logger = logging.getLogger('vk-requests')
+
+
+# Max 'count' value accepted by the methods
+MAX_PAGE_SIZES = {
+    'board.getComments': 100,
+    'board.getTopics': 100,
+    'friends.get': 5000,
+    'groups.get': 1000,
+    'groups.getMembers': 1000,
+    'likes.getList': 1000,
+    'newsfeed.search': 200,
+    'photos.get': 1000,
+    'photos.getAll': 200,
+    'users.getFollowers': 1000,
+    'users.getSubscriptions': 200,
+    'users.search': 1000,
+    'video.get': 200,
+    'wall.get': 100,
+    'wall.getComments': 100,
+    'wall.search': 100,
+}
+DEFAULT_PAGE_SIZE = 100
+
+# VK allows up to 25 API calls per 'execute' request
+MAX_EXECUTE_CALLS = 25
+
+CLIENT_MODE = 'client'
+EXECUTE_MODE = 'execute'
+
+# Arguments of the paginated method are passed to 'execute' with the prefix
+# to avoid clashes with 'execute' own arguments
+EXECUTE_ARG_PREFIX = 'p_'
+
+_EXECUTE_SCRIPT_TEMPLATE = (
+    'var offset=parseInt(Args.offset);'
+    'var count=parseInt(Args.count);'
+    'var pages=parseInt(Args.pages);'
+    'var result=[];var i=0;var more=true;'
+    'while(i<pages&&more){'
+    'var r=API.%(method)s({%(args)s"offset":offset+i*count,"count":count});'
+    'result.push(r);i=i+1;'
+    'if(!r){more=false;}'
+    'else if(r.items.length==0||offset+i*count>=r.count){more=false;}'
+    '}'
+    'return result;'
+)
+_execute_scripts = ScriptCache(maxsize=256)
+
+
+def get_page_size(method_name):
+    return MAX_PAGE_SIZES.get(method_name, DEFAULT_PAGE_SIZE)
+
+
+def get_execute_script(method_name, arg_names):
+    """Get VKScript code fetching pages of the method. Argument values are
+    not a part of the code, so the code is built once per method and set of
+    argument names
+
+    :param method_name: str: paginated method name, e.g 'wall.get'
+    :param arg_names: iterable of the method argument names
+    :return: str
+    """
+    arg_names = tuple(sorted(arg_names))
+
+    def build():
+        args = ''.join('"%s":Args.%s%s,' % (name, EXECUTE_ARG_PREFIX, name)
+                       for name in arg_names)
+        return _EXECUTE_SCRIPT_TEMPLATE % {'method': method_name,
+                                           'args': args}
+    return _execute_scripts.get((method_name, arg_names), build)
+
+
+class Page(object):
+    __slots__ = ('offset', 'items', 'count', 'size')
+
+    def __init__(self, offset, items, count, size):
+        """
+        :param offset: int: offset of the first item of the page
+        :param items: list
+        :param count: int: total number of the items reported by vk
+        :param size: int: requested page size
+        """
+        self.offset = offset
+        self.items = items
+        self.count = count
+        self.size = size
+
+    @property
+    def next_offset(self):
+        return self.offset + self.size
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(offset=%s, items=%s, count=%s)' % (
+            self.__class__.__name__, self.offset, len(self.items), self.count)
+
+
+class Paginator(object):
+    """Iterate over all items of a paginated method"""
+
+    def __init__(self, method, method_args=None, page_size=None, offset=0,
+                 limit=None, mode=CLIENT_MODE, pages_per_call=MAX_EXECUTE_CALLS,
+                 max_retries=3, checkpoint=None):
+        """
+
+        :param method: vk_requests.api.Request instance, e.g api.wall.get
+        :param method_args: dict: method arguments except offset and count
+        :param page_size: int: items per page, max allowed by the method if
+        not given
+        :param offset: int: offset to start from (e.g. to resume the export)
+        :param limit: int: max number of items to fetch from the offset
+        :param mode: str: 'client' - one HTTP request per page,
+        'execute' - up to pages_per_call pages per HTTP request
+        :param pages_per_call: int: pages per 'execute' request
+        :param max_retries: int: max number of retries of a failed page in
+        'execute' mode
+        :param checkpoint: vk_requests.checkpoint.Checkpointer instance, the
+        offset of the next page is acknowledged when the page is processed,
+        pagination resumes from the saved offset if it's past the offset
+        argument. The items between them count towards the limit, so the
+        resumed pagination stops where the first run would stop
+        """
+        if mode not in (CLIENT_MODE, EXECUTE_MODE):
+            raise ValueError('Unknown pagination mode %r' % mode)
+        if not 0 < pages_per_call <= MAX_EXECUTE_CALLS:
+            raise ValueError('pages_per_call must be in range 1..%d'
+                             % MAX_EXECUTE_CALLS)
+
+        self.method = method
+        self.method_args = dict(method_args or {})
+        for name in ('offset', 'count'):
+            if name in self.method_args:
+                raise ValueError("'%s' is set by the paginator" % name)
+        self.page_size = page_size or get_page_size(method.method_name)
+        self.checkpoint = checkpoint
+        self.offset = offset
+        self.limit = limit
+        if checkpoint is not None and checkpoint.position is not None and \
+                checkpoint.position > offset:
+            # Items are counted by offsets, skipped (deleted) ones too
+            self.offset = checkpoint.position
+            if limit is not None:
+                self.limit = max(limit - (self.offset - offset), 0)
+            logger.info('Pagination is resumed from offset %s', self.offset)
+        self.mode = mode
+        self.pages_per_call = pages_per_call
+        self.max_retries = max_retries
+
+        self.total_count = None
+        self.fetched = 0
+        self.calls = 0
+
+    def __iter__(self):
+        for page in self.iter_pages():
+            for item in page.items:
+                yield item
+
+    def iter_pages(self):
+        """Iterate over the pages. Paginator.offset points to the next page
+        to fetch, so it's safe to save it after the page is processed
+
+        :return: generator of Page
+        """
+        fetch = self._fetch_client if self.mode == CLIENT_MODE \
+            else self._fetch_execute
+        while not self._is_done():
+            pages = fetch()
+            for page in pages:
+                if self.limit is not None:
+                    page.items = page.items[:self.limit - self.fetched]
+                self.total_count = page.count
+                self.fetched += len(page.items)
+                self.offset = page.next_offset
+                if page.items:
+                    yield page
+                if self.checkpoint is not None:
+                    self.checkpoint.ack(self.offset)
+            if not pages or not pages[-1].items:
+                break
+        if self.checkpoint is not None:
+            self.checkpoint.flush()
+
+    def _is_done(self):
+        if self.limit is not None and self.fetched >= self.limit:
+            return True
+        return self.total_count is not None and self.offset >= self.total_count
+
+    def _get_count(self):
+        if self.limit is None:
+            return self.page_size
+        return min(self.page_size, self.limit - self.fetched)
+
+    def _fetch_client(self):
+        method_args = dict(self.method_args, offset=self.offset,
+                           count=self._get_count())
+        self.calls += 1
+        response = self.method(**method_args)
+        return [Page(self.offset, response['items'], response['count'],
+                     method_args['count'])]
+
+    def _fetch_execute(self):
+        count = self._get_count()
+        pages_num = self.pages_per_call
+        if self.limit is not None:
+            left = self.limit - self.fetched
+            pages_num = min(pages_num, (left + count - 1) // count)
+
+        method_args = stringify_values(self.method_args)
+        execute_args = {EXECUTE_ARG_PREFIX + name: value
+                        for name, value in method_args.items()}
+        execute_args.update(
+            code=get_execute_script(self.method.method_name, method_args),
+            offset=self.offset, count=count, pages=pages_num)
+
+        for attempt in range(self.max_retries + 1):
+            self.calls += 1
+            payload = self._execute(execute_args)
+            pages = self._parse_execute_response(payload, count)
+            if pages:
+                return pages
+
+            # The very first page of the call is failed, retry it
+            errors = payload.get('execute_errors') or [{}]
+            logger.warning('Page fetching failed at offset %s (attempt %s): '
+                           '%s', self.offset, attempt + 1, errors[0])
+        raise VkAPIError(errors[0])
+
+    def _execute(self, execute_args):
+        execute = Request(session=self.method._session,
+                          method_name='execute',
+                          http_params=self.method.http_params,
+                          call_options=self.method.call_options)
+        return execute(execute_mode='raw', **execute_args)
+
+    def _parse_execute_response(self, payload, count):
+        """Get successfully fetched pages. Fetching stops at the first
+        failed call, next request resumes from its offset
+
+        :param payload: dict: execute response with optional execute_errors
+        :param count: int: page size
+        :return: list of Page
+        """
+        pages = []
+        offset = self.offset
+        for response in payload.get('response') or ():
+            if not response:
+                break
+            pages.append(
+                Page(offset, response['items'], response['count'], count))
+            offset += count
+        return pages
+
+
+def paginate(method, page_size=None, offset=0, limit=None, mode=CLIENT_MODE,
+             checkpoint=None, **method_args):
+    """Iterate over all items of a paginated method
+
+    :param method: vk_requests.api.Request instance, e.g api.wall.get
+    :param page_size: int: items per page
+    :param offset: int: offset to start from
+    :param limit: int: max number of items to fetch
+    :param mode: str: 'client' or 'execute'
+    :param checkpoint: vk_requests.checkpoint.Checkpointer instance
+    :param method_args: method arguments
+    :return: vk_requests.pagination.Paginator instance (iterable of items)
+    """
+    return Paginator(method, method_args=method_args, page_size=page_size,
+                     offset=offset, limit=limit, mode=mode,
+                     checkpoint=checkpoint)
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""Rate limiters. Session rate limiter interface:
+
+* get_key(access_token, method_name) - rate key of the request
+* acquire(key) - wait for the send slot, returns the send time
+* on_response(key, sent_at, latency, throttled) - response feedback
+"""
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows
+    fcntl = None
+
+from vk_requests.exceptions import VkDeadlineExceeded
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.utils import get_token_id
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class _RateState(object):
+    __slots__ = ('rate', 'next_slot_at', 'decreased_at', 'latency', 'samples')
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot_at = 0.0
+        self.decreased_at = 0.0
+        self.latency = None  # moving average
+        self.samples = 0
+
+
+class AdaptiveRateLimiter(object):
+    """Adaptive (AIMD) rate limiter with per (token, method) rates.
+
+    Requests of a key are paced at the current rate of the key. The rate
+    grows additively on every successful response and is cut
+    multiplicatively when VK reports a rate limit error (6, 9 or 29) or the
+    response latency spikes. The errors of the requests which had been sent
+    before the last cut don't cut the rate again, so a burst of errors
+    causes one decrease.
+
+    Example:
+
+    >>> limiter = AdaptiveRateLimiter(initial_rate=3, max_rate=20)
+    >>> session = VKSession(service_token='...', rate_limiter=limiter)
+    >>> limiter.rates()
+    """
+
+    def __init__(self, initial_rate=3.0, min_rate=0.2, max_rate=20.0,
+                 increase=0.1, decrease_factor=0.5, latency_spike_factor=4.0,
+                 latency_min_samples=10, metrics=None):
+        """
+
+        :param initial_rate: float: requests per second of a new key
+        :param min_rate: float: the rate is never cut below this value
+        :param max_rate: float: ceiling of the rate
+        :param increase: float: rate increment per successful response
+        :param decrease_factor: float: rate multiplier on an error or
+        latency spike, must be in range (0, 1)
+        :param latency_spike_factor: float: latency higher than the average
+        one multiplied by this factor is a spike, None to disable
+        :param latency_min_samples: int: number of responses needed to
+        detect latency spikes
+        :param metrics: vk_requests.metrics.MetricsRegistry instance
+        """
+        if not 0 < min_rate <= initial_rate <= max_rate:
+            raise ValueError('Rates must satisfy 0 < min_rate <= '
+                             'initial_rate <= max_rate')
+        if not 0 < decrease_factor < 1:
+            raise ValueError('decrease_factor must be in range (0, 1)')
+
+        self.initial_rate = float(initial_rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_spike_factor = latency_spike_factor
+        self.latency_min_samples = latency_min_samples
+        self.metrics = metrics or MetricsRegistry()
+
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(initial_rate=%s, max_rate=%s)' % (
+            self.__class__.__name__, self.initial_rate, self.max_rate)
+
+    @staticmethod
+    def get_key(access_token, method_name):
+        """Rate key of the request. The token is hashed to keep it out of
+        the metric names and logs
+
+        :param access_token: str or None
+        :param method_name: str
+        :return: tuple
+        """
+        return get_token_id(access_token), method_name
+
+    def _get_state(self, key):
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _RateState(self.initial_rate)
+            self._update_gauge(key, state)
+        return state
+
+    def _update_gauge(self, key, state):
+        self.metrics.gauge('ratelimit.%s.%s.rate' % key).set(state.rate)
+
+    def acquire(self, key, deadline=None):
+        """Wait for the send slot of the key
+
+        :param key: tuple: see get_key
+        :param deadline: vk_requests.utils.Deadline instance, the slot is
+        not taken if the wait is longer than its remaining budget
+        :return: float: send time to be passed to on_response
+        :raise VkDeadlineExceeded: if the wait is longer than the budget
+        """
+        with self._lock:
+            state = self._get_state(key)
+            now = time.time()
+            send_at = max(state.next_slot_at, now)
+            if deadline is not None and \
+                    send_at - now >= deadline.remaining():
+                raise VkDeadlineExceeded(deadline.timeout, 'wait')
+            state.next_slot_at = send_at + 1.0 / state.rate
+
+        wait_time = send_at - now
+        if wait_time > 0:
+            self.metrics.histogram('ratelimit.wait_time').observe(wait_time)
+            time.sleep(wait_time)
+        return send_at
+
+    def on_response(self, key, sent_at, latency, throttled=False):
+        """Adjust the rate of the key
+
+        :param key: tuple: see get_key
+        :param sent_at: float: value returned by acquire
+        :param latency: float: response time in seconds
+        :param throttled: bool: VK returned a rate limit error
+        """
+        with self._lock:
+            state = self._get_state(key)
+            spike = self._observe_latency(state, latency)
+            if throttled or spike:
+                if sent_at < state.decreased_at:
+                    # The rate has been cut after the request was sent
+                    return
+                state.rate = max(self.min_rate,
+                                 state.rate * self.decrease_factor)
+                state.decreased_at = time.time()
+                self.metrics.counter('ratelimit.%s.%s.decreased' % key).inc()
+                logger.info('Rate of %s is decreased to %.2f req/s (%s)',
+                            key[1], state.rate,
+                            'rate limit error' if throttled
+                            else 'latency spike')
+            else:
+                state.rate = min(self.max_rate, state.rate + self.increase)
+            self._update_gauge(key, state)
+
+    def _observe_latency(self, state, latency):
+        """Update the moving average latency
+
+        :return: bool: True if the latency is a spike
+        """
+        spike = (self.latency_spike_factor is not None and
+                 state.samples >= self.latency_min_samples and
+                 latency > state.latency * self.latency_spike_factor)
+        if state.latency is None:
+            state.latency = latency
+        else:
+            state.latency += 0.1 * (latency - state.latency)
+        state.samples += 1
+        return spike
+
+    def rate(self, key):
+        """Current rate of the key, requests per second"""
+        with self._lock:
+            state = self._states.get(key)
+            return state.rate if state is not None else self.initial_rate
+
+    def rates(self):
+        """Current rates of all keys
+
+        :return: dict: {(token id, method name): rate}
+        """
+        with self._lock:
+            return {key: state.rate for key, state in self._states.items()}
+
+
+class RateLimitBackend(object):
+    """Storage of the rate limit state. Backends sharing the state between
+    processes (or hosts) make the limits global for all of them.
+
+    The limit is a GCRA (virtual scheduling) token bucket: the only state
+    of a key is the theoretical arrival time (TAT) of the next request.
+    """
+
+    def reserve(self, key, rate, burst=1):
+        """Reserve the send slot of the key
+
+        :param key: str
+        :param rate: float: requests per second
+        :param burst: int: number of requests which can be sent at once
+        :return: float: seconds to wait before sending the request
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def gcra_reserve(tat, now, rate, burst):
+    """Reserve the slot
+
+    :param tat: float: stored theoretical arrival time or None
+    :param now: float: current time
+    :return: tuple of (seconds to wait, new theoretical arrival time)
+    """
+    interval = 1.0 / rate
+    tat = max(tat or 0.0, now)
+    allowed_at = tat - (burst - 1) * interval
+    return max(0.0, allowed_at - now), tat + interval
+
+
+class MemoryBackend(RateLimitBackend):
+    """State is kept in the process memory, the limits are per process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tats = {}
+
+    def reserve(self, key, rate, burst=1):
+        with self._lock:
+            wait_time, self._tats[key] = gcra_reserve(
+                self._tats.get(key), time.time(), rate, burst)
+        return wait_time
+
+
+class FileLockBackend(RateLimitBackend):
+    """State is kept in a memory-mapped file and protected by an exclusive
+    file lock, so all processes of the host using the same file share the
+    limits. No external service is needed.
+
+    The file is a hash table of (key hash, TAT) slots. Slots of the keys
+    which TAT has passed are reused: such bucket is full, the same as a
+    missing one. Available on POSIX systems only (fcntl.flock).
+    """
+
+    SLOTS = 4096
+    _SLOT = struct.Struct('<Qd')
+
+    def __init__(self, path, slots=SLOTS):
+        """
+        :param path: str: state file path, created if it doesn't exist
+        :param slots: int: max number of keys with waiting requests, it sets
+        the size of the new file. The size of an existing file is kept, so
+        all processes use the same table
+        """
+        if fcntl is None:
+            raise RuntimeError('FileLockBackend requires fcntl (POSIX only)')
+        if slots < 1:
+            raise ValueError('slots must be positive')
+        self.path = path
+        self.slots = slots
+        self.size = slots * self._SLOT.size
+        # flock doesn't exclude the threads sharing the file descriptor
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fd = None
+        self._mmap = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(path=%s)' % (self.__class__.__name__, self.path)
+
+    def _open(self):
+        # The lock of a descriptor inherited by fork() is shared with the
+        # parent process, every process opens own one
+        if self._pid == os.getpid():
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            file_size = os.fstat(fd).st_size
+            if file_size >= self._SLOT.size:
+                self.slots = file_size // self._SLOT.size
+                self.size = self.slots * self._SLOT.size
+            else:
+                os.ftruncate(fd, self.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._mmap = mmap.mmap(fd, self.size)
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.sha1(key.encode('utf-8')).digest()
+        # 0 marks empty slots
+        return struct.unpack('<Q', digest[:8])[0] or 1
+
+    def _find_slot(self, key_hash, now):
+        """Find the slot of the key (linear probing). A new key takes the
+        first expired slot of its probe sequence or the empty one ending it
+
+        :return: tuple of (slot offset, stored TAT or None)
+        """
+        start = key_hash % self.slots
+        free_offset = None
+        for i in range(self.slots):
+            offset = ((start + i) % self.slots) * self._SLOT.size
+            slot_hash, tat = self._SLOT.unpack_from(self._mmap, offset)
+            if slot_hash == key_hash:
+                return offset, tat
+            if slot_hash == 0:
+                # End of the probe sequence, the key isn't stored
+                return (offset if free_offset is None else free_offset), None
+            if free_offset is None and tat <= now:
+                free_offset = offset
+        if free_offset is not None:
+            return free_offset, None
+        raise RuntimeError('Rate limit state file %s is full: more than %s '
+                           'keys have waiting requests'
+                           % (self.path, self.slots))
+
+    def reserve(self, key, rate, burst=1):
+        key_hash = self._hash(key)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                offset, tat = self._find_slot(key_hash, now)
+                wait_time, tat = gcra_reserve(tat, now, rate, burst)
+                self._SLOT.pack_into(self._mmap, offset, key_hash, tat)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return wait_time
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._mmap.close()
+                os.close(self._fd)
+            self._pid = self._fd = self._mmap = None
+
+
+class TokenBucketRateLimiter(object):
+    """Fixed rate limiter with pluggable state backend.
+
+    VK limits the requests per token, so the limit is per token by default.
+    With FileLockBackend the limit is shared by all processes of the host:
+
+    >>> backend = FileLockBackend('/tmp/vk-ratelimit')
+    >>> limiter = TokenBucketRateLimiter(rate=20, backend=backend)
+    >>> session = VKSession(service_token='...', rate_limiter=limiter)
+
+    Implement RateLimitBackend.reserve to keep the state in another storage
+    (e.g. Redis script doing the same GCRA update atomically).
+    """
+
+    def __init__(self, rate, burst=1, backend=None, per_method=False,
+                 metrics=None):
+        """
+
+        :param rate: float: requests per second
+        :param burst: int: number of requests which can be sent at once
+        :param backend: RateLimitBackend instance, MemoryBackend by default
+        :param per_method: bool: separate limits per method of a token
+        :param metrics: vk_requests.metrics.MetricsRegistry instance
+        """
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate must be positive and burst >= 1')
+        self.rate = float(rate)
+        self.burst = burst
+        self.backend = backend or MemoryBackend()
+        self.per_method = per_method
+        self.metrics = metrics or MetricsRegistry()
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(rate=%s, backend=%r)' % (
+            self.__class__.__name__, self.rate, self.backend)
+
+    def get_key(self, access_token, method_name):
+        """Rate key of the request
+
+        :param access_token: str or None
+        :param method_name: str
+        :return: str
+        """
+        token_id = get_token_id(access_token)
+        if self.per_method:
+            return '%s:%s' % (token_id, method_name)
+        return token_id
+
+    def acquire(self, key, deadline=None):
+        """Wait for the send slot of the key
+
+        :param key: str: see get_key
+        :param deadline: vk_requests.utils.Deadline instance, bounds the wait
+        :return: float: send time
+        :raise VkDeadlineExceeded: if the wait is longer than the remaining
+        budget, the reserved slot is not released (the backends can't
+        return it), so the rate stays within the limit
+        """
+        wait_time = self.backend.reserve(key, self.rate, self.burst)
+        if deadline is not None and wait_time >= deadline.remaining():
+            raise VkDeadlineExceeded(deadline.timeout, 'wait')
+        if wait_time > 0:
+            self.metrics.histogram('ratelimit.wait_time').observe(wait_time)
+            time.sleep(wait_time)
+        return time.time()
+
+    def on_response(self, key, sent_at, latency, throttled=False):
+        if throttled:
+            self.metrics.counter('ratelimit.throttled').inc()
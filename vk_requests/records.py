@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Compact response objects (response_mode='compact' call option).
+
+JSON objects are decoded straight into instances of __slots__ classes,
+one class per object shape (sequence of keys), so no per-object dict is
+built. Wide items (users with 30 fields, posts with attachments) take
+about half the memory of the dicts, the decode is slower as an object
+hook is called for every object:
+
+>>> users = api.users.get(user_ids=ids, fields=FIELDS,
+>>>                       response_mode='compact')
+>>> users[0].first_name, users[0].city.title
+>>> users[0]['first_name']
+>>> users[0]._asdict()  # plain dict tree
+
+Fields missing in the object raise AttributeError as for any object, use
+getattr(item, 'city', None) for the optional ones. Objects with keys which
+can't be slots (e.g. numeric ones) are decoded into DictRecord with the
+same access, such keys are read by item access only.
+
+Run benchmarks/bench_records.py to compare memory and decode time with
+the dict mode.
+"""
+import json
+import re
+import threading
+from collections import OrderedDict
+
+
+# Objects with other keys (e.g. numeric ones or clashing with the
+# underscore prefixed attributes of Record) are decoded as DictRecord
+FIELD_NAME_RE = re.compile(r'^[A-Za-z][A-Za-z0-9_]*$')
+
+# Max number of cached record classes, the oldest shape is evicted when a
+# new one is added to the full cache
+MAX_SHAPES = 4096
+
+# Wider objects are decoded as DictRecord (python < 3.7 limits the number
+# of the constructor arguments to 255)
+MAX_FIELDS = 255
+
+
+class Record(object):
+    """Base class of the compact objects. Methods and attributes of the
+    class are prefixed with underscore (as in namedtuple), so they don't
+    clash with the fields"""
+
+    __slots__ = ()
+    _fields = ()
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        if isinstance(other, (Record, dict)):
+            return materialize(self) == materialize(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join(
+            '%s=%r' % (name, getattr(self, name)) for name in self._fields)
+
+    def __reduce__(self):
+        # Record classes are created at runtime and can't be imported by
+        # pickle, the instance is rebuilt from its shape
+        return _make_record, (tuple(self._fields),
+                              tuple(getattr(self, name)
+                                    for name in self._fields))
+
+    def _asdict(self):
+        """
+        :return: dict: the object with all nested objects as dicts
+        """
+        return materialize(self)
+
+
+class DictRecord(Record):
+    """Record of the object which shape can't be a slots class, the values
+    are kept in a dict"""
+
+    __slots__ = ('_data',)
+
+    def __init__(self, data):
+        self._data = data
+
+    @property
+    def _fields(self):
+        return tuple(self._data)
+
+    def __getattr__(self, name):
+        # Called only if there is no such attribute of the class
+        if name == '_data':
+            raise AttributeError(name)
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'DictRecord(%r)' % (self._data,)
+
+    def __reduce__(self):
+        return DictRecord, (self._data,)
+
+
+_shapes = OrderedDict()
+_shapes_lock = threading.Lock()
+
+
+def _build_record_class(fields):
+    cls = type('Record', (Record,),
+               {'__slots__': tuple(str(name) for name in fields),
+                '_fields': fields})
+    # Constructor is generated (as in namedtuple) to set the slots without
+    # setattr calls, it's called for every decoded object
+    namespace = {'new': cls.__new__, 'cls': cls}
+    args = ', '.join('_%d' % i for i in range(len(fields)))
+    lines = ['def make(%s):' % args, '    record = new(cls)']
+    for i, name in enumerate(fields):
+        namespace['set_%d' % i] = cls.__dict__[str(name)].__set__
+        lines.append('    set_%d(record, _%d)' % (i, i))
+    lines.append('    return record')
+    exec('\n'.join(lines), namespace)
+    make = namespace['make']
+    make.record_class = cls
+    return make
+
+
+def _get_maker(fields):
+    make = _shapes.get(fields)
+    if make is not None:
+        return make
+    if len(fields) > MAX_FIELDS or len(set(fields)) != len(fields) or \
+            not all(FIELD_NAME_RE.match(name) for name in fields):
+        return None
+    with _shapes_lock:
+        make = _shapes.get(fields)
+        if make is None:
+            while len(_shapes) >= MAX_SHAPES:
+                # Records of the evicted shape keep their class
+                _shapes.popitem(last=False)
+            make = _shapes[fields] = _build_record_class(fields)
+    return make
+
+
+def get_record_class(fields):
+    """Get the record class of the object shape
+
+    :param fields: tuple of str: keys of the object in order
+    :return: Record subclass or None if the shape can't be a slots class
+    (its objects are decoded as DictRecord)
+    """
+    make = _get_maker(fields)
+    return make.record_class if make is not None else None
+
+
+def _make_record(fields, values):
+    make = _get_maker(fields)
+    if make is None:
+        return DictRecord(dict(zip(fields, values)))
+    return make(*values)
+
+
+def _object_pairs_hook(pairs):
+    if not pairs:
+        return {}
+    fields, values = zip(*pairs)
+    make = _get_maker(fields)
+    if make is None:
+        return DictRecord(dict(pairs))
+    return make(*values)
+
+
+def materialize(obj):
+    """Convert the records of the object tree to dicts
+
+    :param obj: decoded object
+    :return: plain dict/list tree
+    """
+    if isinstance(obj, DictRecord):
+        return materialize(obj._data)
+    elif isinstance(obj, Record):
+        return {name: materialize(getattr(obj, name)) for name in obj._fields}
+    elif isinstance(obj, dict):
+        return {key: materialize(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [materialize(item) for item in obj]
+    return obj
+
+
+def loads(content):
+    """Decode the API response body, the 'response' value is decoded into
+    records and the other keys of the payload (e.g. execute_errors) are
+    plain dicts
+
+    :param content: bytes
+    :return: dict
+    """
+    if not isinstance(content, str):
+        content = content.decode('utf-8')
+    payload = json.loads(content, object_pairs_hook=_object_pairs_hook)
+    if not isinstance(payload, Record):
+        return materialize(payload)
+    return {name: payload[name] if name == 'response'
+            else materialize(payload[name])
+            for name in payload._fields}
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import logging
+import threading
+import time
+
+from vk_requests.metrics import MetricsRegistry
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class _Ticket(object):
+    __slots__ = ('priority', 'enqueued_at', 'granted_at')
+
+    def __init__(self, priority, enqueued_at):
+        self.priority = priority
+        self.enqueued_at = enqueued_at
+        self.granted_at = None
+
+
+class PriorityScheduler(object):
+    """Priority-aware request scheduler with weighted fair sharing.
+
+    Requests are queued per priority class. When a slot is available the
+    next request is picked with stride scheduling, so every class gets a
+    share of slots proportional to its weight. A request waiting longer than
+    max_queue_time goes first regardless of its class (starvation
+    protection).
+
+    Slots are bounded by max_concurrency (number of requests in flight)
+    and/or rate_limit (requests per second).
+
+    Example:
+
+    >>> scheduler = PriorityScheduler(rate_limit=3)
+    >>> session = VKSession(service_token='...', scheduler=scheduler)
+    >>> api = API(session=session, priority='low')  # background crawler
+    >>> api.users.get(user_ids=1, priority='high')  # user-facing call
+    """
+
+    DEFAULT_WEIGHTS = {'high': 6, 'normal': 3, 'low': 1}
+
+    def __init__(self, weights=None, default_priority='normal',
+                 max_concurrency=None, rate_limit=None, max_queue_time=10.0,
+                 metrics=None):
+        """
+
+        :param weights: dict: {priority class: positive weight}
+        :param default_priority: str: class of requests without priority
+        :param max_concurrency: int: max number of requests in flight
+        :param rate_limit: float: max number of requests per second
+        :param max_queue_time: float: seconds after which a queued request
+        is served first regardless of its class
+        :param metrics: vk_requests.metrics.MetricsRegistry instance
+        """
+        self.weights = dict(weights or self.DEFAULT_WEIGHTS)
+        if default_priority not in self.weights:
+            raise ValueError('Default priority %r is not in weights %s'
+                             % (default_priority, self.weights))
+        for priority, weight in self.weights.items():
+            if weight <= 0:
+                raise ValueError('Weight of %r must be positive' % priority)
+
+        self.default_priority = default_priority
+        self.max_concurrency = max_concurrency
+        self.max_queue_time = max_queue_time
+        self._interval = 1.0 / rate_limit if rate_limit else 0
+        self.metrics = metrics or MetricsRegistry()
+
+        self._cond = threading.Condition(threading.Lock())
+        self._queues = {priority: [] for priority in self.weights}
+        self._passes = {priority: 0.0 for priority in self.weights}
+        self._vtime = 0.0
+        self._active = 0
+        self._next_slot_at = 0.0
+        self._starving_ticket = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(weights=%s, max_concurrency=%s)' % (
+            self.__class__.__name__, self.weights, self.max_concurrency)
+
+    @contextlib.contextmanager
+    def slot(self, priority=None, deadline=None):
+        """Context manager which holds a slot while the request is running
+
+        :param priority: str: priority class
+        :param deadline: vk_requests.utils.Deadline instance, see acquire
+        """
+        ticket = self.acquire(priority, deadline=deadline)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    def acquire(self, priority=None, deadline=None):
+        """Wait for a slot
+
+        :param priority: str: priority class, default_priority if not given
+        :param deadline: vk_requests.utils.Deadline instance, the wait is
+        bounded by its remaining budget
+        :return: ticket to be passed to release
+        :raise VkDeadlineExceeded: if the budget is used up before the slot
+        is granted, the request leaves the queue
+        """
+        if priority is None:
+            priority = self.default_priority
+        if priority not in self._queues:
+            raise ValueError('Unknown priority %r, expected one of %s'
+                             % (priority, sorted(self._queues)))
+
+        ticket = _Ticket(priority, time.time())
+        with self._cond:
+            queue = self._queues[priority]
+            if not queue:
+                # Idle class doesn't accumulate credit while it's idle
+                self._passes[priority] = max(self._passes[priority],
+                                             self._vtime)
+            queue.append(ticket)
+            self.metrics.gauge('scheduler.%s.queued' % priority).set(
+                len(queue))
+
+            try:
+                while True:
+                    wait_time = self._try_grant(ticket)
+                    if wait_time is None:
+                        break
+                    if deadline is not None:
+                        remaining = deadline.remaining()
+                        if not remaining:
+                            deadline.check('wait')
+                        wait_time = min(wait_time or remaining, remaining)
+                    self._cond.wait(wait_time or None)
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+
+        queue_time = ticket.granted_at - ticket.enqueued_at
+        self.metrics.histogram(
+            'scheduler.%s.queue_time' % priority).observe(queue_time)
+        self.metrics.counter('scheduler.%s.granted' % priority).inc()
+        return ticket
+
+    def _dequeue(self, ticket):
+        """Remove the ticket which isn't granted from its queue.
+        Must be called with the lock held"""
+        queue = self._queues[ticket.priority]
+        if ticket.granted_at is None and ticket in queue:
+            queue.remove(ticket)
+            self.metrics.gauge('scheduler.%s.queued' % ticket.priority).set(
+                len(queue))
+            # The next ticket may go now
+            self._cond.notify_all()
+
+    def release(self, ticket):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def _try_grant(self, ticket):
+        """Grant the slot to the ticket if it's its turn.
+        Must be called with the lock held
+
+        :return: None if the slot is granted, otherwise time to wait in
+        seconds (0 - wait for notification)
+        """
+        if self.max_concurrency and self._active >= self.max_concurrency:
+            return 0
+
+        now = time.time()
+        if self._select(now) is not ticket:
+            return self._time_to_starvation(now)
+
+        if self._next_slot_at > now:
+            return self._next_slot_at - now
+
+        priority = ticket.priority
+        queue = self._queues[priority]
+        queue.pop(0)
+        self.metrics.gauge('scheduler.%s.queued' % priority).set(len(queue))
+
+        self._vtime = self._passes[priority]
+        self._passes[priority] += 1.0 / self.weights[priority]
+        self._next_slot_at = max(self._next_slot_at, now) + self._interval
+        self._active += 1
+        ticket.granted_at = now
+
+        # Other queued requests may be able to go now
+        self._cond.notify_all()
+        return None
+
+    def _select(self, now):
+        """Pick the ticket which goes next"""
+        heads = [queue[0] for queue in self._queues.values() if queue]
+        if not heads:  # pragma: no cover
+            return None
+
+        starving = [ticket for ticket in heads
+                    if now - ticket.enqueued_at >= self.max_queue_time]
+        if starving:
+            ticket = min(starving, key=lambda t: t.enqueued_at)
+            if ticket is not self._starving_ticket:
+                self._starving_ticket = ticket
+                self.metrics.counter(
+                    'scheduler.%s.starvation_promoted' % ticket.priority).inc()
+            return ticket
+
+        return min(heads, key=lambda t: (self._passes[t.priority],
+                                         -self.weights[t.priority]))
+
+    def _time_to_starvation(self, now):
+        """Seconds until the next queued request becomes starving, the
+        choice of the next request may change at that moment"""
+        waits = [queue[0].enqueued_at + self.max_queue_time - now
+                 for queue in self._queues.values() if queue]
+        waits = [w for w in waits if w > 0]
+        return min(waits) if waits else 0
+
+    def stats(self):
+        """Current state of the scheduler
+
+        :return: dict
+        """
+        with self._cond:
+            return {
+                'active': self._active,
+                'queued': {priority: len(queue)
+                           for priority, queue in self._queues.items()},
+            }
@@ -1,13 +1,26 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import copy
 import logging
+import threading
+import time
 
+import requests
+import six
 from six.moves import input as raw_input
 
-from vk_requests.exceptions import VkAuthError, VkAPIError, VkParseError
+from vk_requests.exceptions import VkAuthError, VkAPIError, VkParseError, \
+    VkDeadlineExceeded
+from vk_requests import records
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.tracing import NOOP_TRACER
+from vk_requests.vkscript import ExecuteResult
+from vk_requests.transport import HTTPTransport
 from vk_requests.utils import parse_url_query_params, VerboseHTTPSession, \
     parse_form_action_url, stringify_values, parse_masked_phone_number, \
-    check_html_warnings, parse_captcha_html
+    check_html_warnings, parse_captcha_html, SingleFlight, \
+    SharedPoolSessions, get_accept_encoding, AUTO_COMPRESSION, Deadline
 
 try:
     import ujson as json
@@ -18,6 +31,35 @@ except ImportError:
 logger = logging.getLogger('vk-requests')
 
 
+def loads_json(content):
+    """Decode JSON response body. Bytes are decoded directly, without the
+    charset detection and the text copy of requests.Response.text
+
+    :param content: bytes
+    :return: decoded object
+    """
+    try:
+        return json.loads(content)
+    except TypeError:
+        # json module of python < 3.6 accepts text only
+        return json.loads(content.decode('utf-8'))
+
+
+def is_error_payload(content):
+    """Check if the undecoded body is an API error"""
+    return content[:16].lstrip().startswith(b'{"error"')
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+def _is_shared_error(error):
+    """Deadline of the leader is not shared by the deduplicated calls"""
+    return not isinstance(error, VkDeadlineExceeded)
+
+
 class VKSession(object):
     API_URL = 'https://api.vk.com/method/'
     DEFAULT_HTTP_HEADERS = {
@@ -30,13 +72,50 @@ class VKSession(object):
     DIRECT_AUTHORIZE_URL = 'https://oauth.vk.com/token'
     CAPTCHA_URI = 'https://api.vk.com/captcha.php'
 
+    # Methods which names (the part after the dot) start with these prefixes
+    # are considered as read-only and can be de-duplicated
+    READ_METHOD_PREFIXES = ('get', 'search', 'is')
+    # Call options changing the result, the de-duplicated requests must
+    # have the same values of them
+    RESULT_CALL_OPTIONS = ('execute_mode', 'response_mode')
+
     def __init__(self, app_id=None, user_login=None, user_password=None,
                  phone_number=None, scope='offline', api_version=None,
                  interactive=False, service_token=None, client_secret=None,
-                 two_fa_supported=False, two_fa_force_sms=False):
+                 two_fa_supported=False, two_fa_force_sms=False,
+                 http_pool_size=10, deduplicate_requests=False,
+                 scheduler=None, rate_limiter=None, circuit_breaker=None,
+                 transport=None, compression=AUTO_COMPRESSION,
+                 request_compression_threshold=None, tracer=None):
         """IMPORTANT: (app_id + user_login + user_password) and service_token
         are mutually exclusive
 
+        :param http_pool_size: int: max number of kept-alive connections per
+        host in the connection pool shared by all threads
+        :param deduplicate_requests: bool: attach identical concurrent read
+        requests (same method, args and token) to the one being in flight
+        instead of sending duplicates
+        :param scheduler: vk_requests.scheduler.PriorityScheduler instance,
+        it decides which of the concurrent requests is sent next
+        :param rate_limiter: vk_requests.ratelimit.AdaptiveRateLimiter
+        instance, it paces requests per token and method and adapts the
+        rates to the responses
+        :param circuit_breaker: vk_requests.circuitbreaker.CircuitBreaker
+        instance, requests of the failing methods fail fast with
+        VkCircuitOpenError
+        :param transport: vk_requests.transport.Transport instance which
+        sends API requests, e.g. RecordingTransport or ReplayTransport,
+        HTTPTransport over the session connection pool by default
+        :param compression: response compression: 'auto' - all the encodings
+        supported by urllib3 (gzip, deflate, br and zstd if brotli and
+        zstandard packages are installed), list of encodings or None to
+        disable it
+        :param request_compression_threshold: int: gzip request bodies
+        bigger than this number of bytes (e.g. large 'execute' payloads),
+        None to disable it. Applies to the default transport only
+        :param tracer: vk_requests.tracing.Tracer or OpenTelemetry tracer,
+        every API call is traced as a tree of spans of its phases
+        (auth, rate limit wait, encode, send, decode, retries)
         """
         self.app_id = app_id
         self._login = user_login
@@ -46,13 +125,40 @@ class VKSession(object):
         self.scope = scope
         self.interactive = interactive
         self._access_token = None
+        # Token acquisition is single-flight: concurrent callers wait for the
+        # one running login flow instead of starting their own
+        self._token_flight = SingleFlight(share_error=_is_shared_error)
+        self._token_lock = threading.Lock()
+        # Deadline of the call which is getting the token in this thread
+        self._local = threading.local()
         self._api_version = api_version
         self._client_secret = client_secret
         self._two_fa_supported = two_fa_supported
         self._two_fa_force_sms = two_fa_force_sms
 
-        # requests.Session subclass instance
-        self._http_session = None
+        # Concurrency model: every thread gets its own requests.Session
+        # (cookies and headers are not shared), while all of them send
+        # requests through one thread-safe connection pool (adapter).
+        # Auth flows run in their own short-lived session, see
+        # create_auth_session
+        headers = dict(self.DEFAULT_HTTP_HEADERS)
+        headers['Accept-Encoding'] = get_accept_encoding(compression)
+        self._http_sessions = SharedPoolSessions(
+            pool_size=http_pool_size, headers=headers)
+        self.transport = transport or HTTPTransport(
+            self._http_sessions,
+            compression_threshold=request_compression_threshold)
+
+        self._deduplicate_requests = deduplicate_requests
+        # Every caller gets own copy of the result to be safe against
+        # mutations made by other callers
+        self._request_flight = SingleFlight(copy_result=copy.deepcopy,
+                                            share_error=_is_shared_error)
+        self.metrics = MetricsRegistry()
+        self.scheduler = scheduler
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.tracer = tracer or NOOP_TRACER
 
         # Some API methods get args (e.g. user id) from access token.
         # If we define user login, we need get access token now.
@@ -61,15 +167,34 @@ class VKSession(object):
 
     @property
     def http_session(self):
-        """HTTP Session property
+        """HTTP Session property. The session is bound to the current thread,
+        the underlying connection pool is shared between threads.
 
         :return: vk_requests.utils.VerboseHTTPSession instance
         """
-        if self._http_session is None:
-            session = VerboseHTTPSession()
-            session.headers.update(self.DEFAULT_HTTP_HEADERS)
-            self._http_session = session
-        return self._http_session
+        return self._http_sessions.session
+
+    @property
+    def http_adapter(self):
+        """Connection pool shared by the API sessions of all threads
+
+        :return: requests.adapters.HTTPAdapter instance
+        """
+        return self._http_sessions.adapter
+
+    def create_auth_session(self):
+        """Create isolated HTTP session for auth flows. Login cookies stay
+        in this session and closing it doesn't affect API requests
+
+        :return: vk_requests.utils.VerboseHTTPSession instance
+        """
+        session = VerboseHTTPSession()
+        session.deadline = getattr(self._local, 'deadline', None)
+        return session
+
+    def close(self):
+        """Close the shared connection pool"""
+        self._http_sessions.close()
 
     @property
     def api_version(self):
@@ -341,9 +466,35 @@ class VKSession(object):
 
     @property
     def access_token(self):
-        if self._access_token is None:
-            self._access_token = self._get_access_token()
-        return self._access_token
+        token = self._access_token
+        if token is None:
+            # The wait for the token is bounded by the deadline of the call
+            token, _ = self._token_flight.do_until(
+                getattr(self._local, 'deadline', None), 'access_token',
+                self._fill_access_token)
+        return token
+
+    def _fill_access_token(self):
+        # The token might have been set by the flight which has just finished
+        token = self._access_token
+        if token is None:
+            token = self._access_token = self._get_access_token()
+        return token
+
+    def _drop_access_token(self, token):
+        """Drop the token if it's still the current one.
+
+        Threads which got an 'incorrect token' error for the same token drop
+        it only once, the token that is already renewed stays untouched.
+
+        :param token: str: access token used for the failed request
+        :return: bool: True if the token has been dropped
+        """
+        with self._token_lock:
+            if self._access_token is not None and self._access_token == token:
+                self._access_token = None
+                return True
+            return False
 
     def _get_access_token(self):
         """Get access token using app_id, login and password OR service token
@@ -361,7 +512,10 @@ class VKSession(object):
                    '*' * len(self._password) if self._password else 'None'))
 
         logger.info("Getting access token for user '%s'" % self._login)
-        with self.http_session as s:
+        flow = 'direct' if self._client_secret else 'implicit'
+        with self.tracer.start_as_current_span(
+                'vk.auth', attributes={'vk.auth.flow': flow}), \
+                self.create_auth_session() as s:
             if self._client_secret:
                 url_query_params = self.do_direct_authorization(session=s)
             else:
@@ -393,7 +547,11 @@ class VKSession(object):
         """Force to get new access token
 
         """
-        self._access_token = self._get_access_token()
+        self._token_flight.do('access_token', self._renew_access_token)
+
+    def _renew_access_token(self):
+        token = self._access_token = self._get_access_token()
+        return token
 
     def make_request(self, request, captcha_response=None):
         """Make api request helper function
@@ -402,19 +560,125 @@ class VKSession(object):
         :param captcha_response: None or dict, e.g {'sid': <sid>, 'key': <key>}
         :return: dict: json decoded http response
         """
-        logger.debug('Prepare API Method request %r', request)
-        response = self._send_api_request(request=request,
-                                          captcha_response=captcha_response)
-        response.raise_for_status()
-        response_or_error = json.loads(response.text)
-        logger.debug('response: %s', response_or_error)
-
-        if 'error' in response_or_error:
-            error_data = response_or_error['error']
-            vk_error = VkAPIError(error_data)
+        deadline = None
+        if request.get_option('deadline') is not None:
+            deadline = Deadline(request.get_option('deadline'))
+        with self.tracer.start_as_current_span(
+                'vk.request',
+                attributes={'vk.method': request.method_name}) as span:
+            if captcha_response is None and self.is_deduplicated(request):
+                key = self._get_request_key(request)
+                result, shared = self._request_flight.do_until(
+                    deadline, key, self._make_request, request,
+                    deadline=deadline)
+                if shared:
+                    span.set_attribute('vk.deduplicated', True)
+                    self.metrics.counter('requests.collapsed').inc()
+                return result
+            return self._make_request(request,
+                                      captcha_response=captcha_response,
+                                      deadline=deadline)
+
+    def is_deduplicated(self, request):
+        """Check if the request can be attached to the identical in-flight
+        one
 
+        :param request: vk_requests.api.Request instance
+        :return: bool
+        """
+        if not self._deduplicate_requests or request.get_option('return_raw'):
+            return False
+        method_name = request.method_name.rsplit('.', 1)[-1]
+        return method_name.startswith(self.READ_METHOD_PREFIXES)
+
+    def _get_request_key(self, request):
+        method_args = stringify_values(request.method_args or {})
+        normalized_args = tuple(sorted(
+            (key, str(value)) for key, value in method_args.items()))
+        options = tuple(request.get_option(name)
+                        for name in self.RESULT_CALL_OPTIONS)
+        return (request.method_name, normalized_args, options,
+                self.api_version, self._access_token)
+
+    def _make_request(self, request, captcha_response=None, deadline=None):
+        """
+        :param deadline: vk_requests.utils.Deadline instance, time budget
+        shared by all the attempts of the call
+        """
+        logger.debug('Prepare API Method request %r', request)
+        access_token = None
+        if self.is_token_required() or self._service_token:
+            access_token = self._get_call_token(deadline)
+        if deadline is not None:
+            deadline.check('auth')
+        rate_key = sent_at = circuit_key = None
+        circuit_recorded = False
+        try:
+            with self._schedule(request, deadline):
+                if self.rate_limiter is not None:
+                    rate_key = self.rate_limiter.get_key(access_token,
+                                                         request.method_name)
+                    with self.tracer.start_as_current_span(
+                            'vk.ratelimit.wait'):
+                        sent_at = self.rate_limiter.acquire(
+                            rate_key, deadline=deadline)
+                if deadline is not None:
+                    deadline.check('wait')
+                # Fails fast if the circuit of the method is open. It's
+                # passed after the local waits, they don't hold the probes
+                # of a half-open circuit
+                circuit_key = self._acquire_circuit(request, access_token)
+                started_at = time.time()
+                response = self._send_api_request(
+                    request=request,
+                    captcha_response=captcha_response,
+                    access_token=access_token,
+                    deadline=deadline)
+            latency = time.time() - started_at
+            response.raise_for_status()
+            content = response.content
+            return_raw = request.get_option('return_raw')
+            if return_raw and not is_error_payload(content):
+                # Body is passed to the caller undecoded
+                response_or_error = None
+            else:
+                compact = request.get_option('response_mode') == 'compact' \
+                    and not is_error_payload(content)
+                with self.tracer.start_as_current_span(
+                        'vk.decode', attributes={'vk.response.size':
+                                                 len(content)}):
+                    if compact:
+                        response_or_error = records.loads(content)
+                    else:
+                        response_or_error = loads_json(content)
+                logger.debug('response: %s', response_or_error)
+
+            vk_error = None
+            if response_or_error is not None and 'error' in response_or_error:
+                vk_error = VkAPIError(response_or_error['error'])
+            self._record_circuit(circuit_key, vk_error=vk_error)
+            circuit_recorded = True
+        except requests.RequestException:
+            # Transport and HTTP errors
+            self._record_circuit(circuit_key, failed=True)
+            circuit_recorded = True
+            raise
+        finally:
+            if not circuit_recorded:
+                # Deadline, decoding errors and interruptions don't tell
+                # anything about the method
+                self._release_circuit(circuit_key)
+
+        if rate_key is not None:
+            self.rate_limiter.on_response(
+                rate_key, sent_at, latency,
+                throttled=vk_error is not None and vk_error.is_rate_limited())
+
+        if vk_error is not None:
             if vk_error.is_captcha_needed():
-                captcha_key = self.get_captcha_key(vk_error.captcha_img_url)
+                with self.tracer.start_as_current_span('vk.captcha'):
+                    captcha_key = self.get_captcha_key(
+                        vk_error.captcha_img_url)
                 if not captcha_key:
                     raise vk_error
 
@@ -423,17 +687,35 @@ class VKSession(object):
                     'sid': vk_error.captcha_sid,
                     'key': captcha_key,
                 }
-                return self.make_request(
-                    request, captcha_response=captcha_response)
+                with self._retry_span('captcha'):
+                    return self._make_request(
+                        request, captcha_response=captcha_response,
+                        deadline=deadline)
 
             elif vk_error.is_access_token_incorrect():
-                logger.info(
-                    'Authorization failed. Access token will be dropped')
-                self._access_token = None
-                return self.make_request(request)
+                if access_token is None:
+                    raise vk_error
+                if self._drop_access_token(access_token):
+                    logger.info(
+                        'Authorization failed. Access token will be dropped')
+                with self._retry_span('access_token'):
+                    return self._make_request(request, deadline=deadline)
 
             else:
                 raise vk_error
+        elif response_or_error is None:
+            if return_raw == 'memoryview':
+                return memoryview(content)
+            return content
+        elif request.get_option('execute_mode') == 'raw':
+            # Whole payload with both 'response' and 'execute_errors' keys
+            return response_or_error
+        elif request.get_option('execute_mode') == 'partial' and \
+                'response' in response_or_error:
+            # Results of the succeeded sub-calls with the errors of the
+            # failed ones
+            return ExecuteResult(response_or_error['response'],
+                                 response_or_error.get('execute_errors'))
         elif 'execute_errors' in response_or_error:
             # can take place while running .execute vk method
             # See more: https://vk.com/dev/execute
@@ -441,25 +723,95 @@ class VKSession(object):
         elif 'response' in response_or_error:
             return response_or_error['response']
 
-    def _send_api_request(self, request, captcha_response=None):
+    def _schedule(self, request, deadline=None):
+        """Get the scheduler slot for the request
+
+        :param request: vk_requests.api.Request instance
+        :param deadline: vk_requests.utils.Deadline instance, bounds the
+        wait for the slot
+        :return: context manager
+        """
+        if self.scheduler is None:
+            return _null_context()
+        return self.scheduler.slot(request.get_option('priority'),
+                                   deadline=deadline)
+
+    def _get_call_token(self, deadline):
+        """Get access token, auth requests are bounded by the deadline of
+        the call"""
+        if deadline is None or self._access_token is not None:
+            return self.access_token
+        self._local.deadline = deadline
+        try:
+            return self.access_token
+        finally:
+            self._local.deadline = None
+
+    def _retry_span(self, reason):
+        return self.tracer.start_as_current_span(
+            'vk.retry', attributes={'vk.retry.reason': reason})
+
+    def _acquire_circuit(self, request, access_token):
+        """Pass the circuit breaker
+
+        :return: circuit key or None if there is no circuit breaker
+        :raise VkCircuitOpenError: if the circuit of the method is open
+        """
+        if self.circuit_breaker is None:
+            return None
+        key = self.circuit_breaker.get_key(access_token, request.method_name)
+        self.circuit_breaker.acquire(key)
+        return key
+
+    def _release_circuit(self, key):
+        """Release the circuit breaker without the request result
+
+        :param key: circuit key returned by _acquire_circuit
+        """
+        if key is not None:
+            self.circuit_breaker.release(key)
+
+    def _record_circuit(self, key, vk_error=None, failed=False):
+        """Record the request result in the circuit breaker
+
+        :param key: circuit key returned by _acquire_circuit
+        :param vk_error: VkAPIError instance if API returned an error
+        :param failed: bool: the request is failed on the transport level
+        """
+        if key is None:
+            return
+        if vk_error is not None:
+            failed = self.circuit_breaker.is_failure(vk_error)
+        self.circuit_breaker.record(key, success=not failed)
+
+    def _send_api_request(self, request, captcha_response=None,
+                          access_token=None, deadline=None):
         """Prepare and send HTTP API request
 
         :param request: vk_requests.api.Request instance
         :param captcha_response: None or dict 
+        :param access_token: str: token to send, the current one is used
+        if it's not given
+        :param deadline: vk_requests.utils.Deadline instance, HTTP timeout
+        is limited by its remaining budget
         :return: HTTP response
         """
         url = self.API_URL + request.method_name
 
-        # Prepare request arguments
-        method_kwargs = {'v': self.api_version}
+        with self.tracer.start_as_current_span('vk.encode'):
+            # Prepare request arguments
+            method_kwargs = {'v': self.api_version}
 
-        # Shape up the request data
-        for values in (request.method_args,):
-            method_kwargs.update(stringify_values(values))
+            # Shape up the request data
+            for values in (request.method_args,):
+                method_kwargs.update(stringify_values(values))
 
-        if self.is_token_required() or self._service_token:
+        if access_token is None and (self.is_token_required() or
+                                     self._service_token):
             # Auth api call if access_token hadn't been gotten earlier
-            method_kwargs['access_token'] = self.access_token
+            access_token = self.access_token
+        if access_token is not None:
+            method_kwargs['access_token'] = access_token
 
         if captcha_response:
             method_kwargs['captcha_sid'] = captcha_response['sid']
@@ -468,8 +820,19 @@ class VKSession(object):
         http_params = dict(url=url,
                            data=method_kwargs,
                            **request.http_params)
+        if deadline is not None:
+            http_params['timeout'] = deadline.clamp_timeout(
+                http_params.get('timeout'), 'send')
         logger.debug('send_api_request:http_params: %s', http_params)
-        response = self.http_session.post(**http_params)
+        with self.tracer.start_as_current_span('vk.send') as span:
+            try:
+                response = self.transport.request('POST', **http_params)
+            except requests.Timeout as err:
+                if deadline is not None and deadline.expired():
+                    six.raise_from(
+                        VkDeadlineExceeded(deadline.timeout, 'send'), err)
+                raise
+            span.set_attribute('http.status_code', response.status_code)
         return response
 
     def __repr__(self):  # pragma: no cover
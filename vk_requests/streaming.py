@@ -1,28 +1,322 @@
 # -*- coding: utf-8 -*-
 import sys
 
-if sys.version_info <= (3, 4):
-    raise RuntimeError('Streaming API requires python version >= 3.4')
+if sys.version_info < (3, 5):
+    raise RuntimeError('Streaming API requires python version >= 3.5')
 
-import requests
 import websockets
 import asyncio
+import calendar
+import collections
+import json
 import logging
+import threading
+import time
+
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.transport import HTTPTransport
 
 
 logger = logging.getLogger(__name__)
 
+# Events per month of the Streaming API tiers (streaming.getSettings)
+MONTHLY_LIMITS = {
+    'tier_1': 500000,
+    'tier_2': 1000000,
+    'tier_3': 2000000,
+    'tier_4': 4000000,
+    'tier_5': 8000000,
+    'tier_6': 16000000,
+    'unlimited': None,
+}
+
+LAG_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+def parse_event(message):
+    """Get the event of a stream message
+
+    :param message: str: websocket message
+    :return: event dict or None for service messages
+    """
+    try:
+        event = json.loads(message)['event']
+    except (ValueError, KeyError, TypeError):
+        return None
+    return event if isinstance(event, dict) else None
+
+
+def get_message_size(message):
+    """Size of a websocket message in bytes
+
+    :param message: str (text frame) or bytes (binary frame)
+    :return: int
+    """
+    if isinstance(message, str):
+        return len(message.encode('utf-8'))
+    return len(message)
+
+
+def get_month_bounds(now):
+    """Start and end of the calendar month (UTC)
+
+    :param now: float: unixtime
+    :return: tuple of unixtimes
+    """
+    year, month = time.gmtime(now)[:2]
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    end = calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+    return start, end
+
+
+class _RateMeter(object):
+    """Events and bytes per second over the last window seconds"""
+
+    def __init__(self, window):
+        self.window = window
+        self._buckets = collections.deque()  # [second, events, bytes]
+
+    def add(self, size, now, events=1):
+        second = int(now)
+        if self._buckets and self._buckets[-1][0] == second:
+            bucket = self._buckets[-1]
+            bucket[1] += events
+            bucket[2] += size
+        else:
+            self._buckets.append([second, events, size])
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] < now - self.window:
+            self._buckets.popleft()
+
+    def rates(self, now, started_at):
+        """
+        :return: tuple of (events per second, bytes per second)
+        """
+        self._expire(now)
+        period = min(self.window, now - started_at)
+        if period <= 0:
+            return 0.0, 0.0
+        events = sum(bucket[1] for bucket in self._buckets)
+        size = sum(bucket[2] for bucket in self._buckets)
+        return events / period, size / period
+
+
+class StreamStats(object):
+    """Throughput, lag and processing time of a stream.
+
+    Lag is the time between the event creation (creation_time) and its
+    receiving, rates are measured over the last window seconds.
+    """
+
+    def __init__(self, window=60.0, metrics=None):
+        """
+        :param window: float: period of the rates in seconds
+        :param metrics: vk_requests.metrics.MetricsRegistry instance
+        """
+        self.window = window
+        self.metrics = metrics or MetricsRegistry()
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self._rate = _RateMeter(window)
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(events=%s)' % (self.__class__.__name__,
+                                  self.metrics.counter('stream.events').value)
+
+    def on_message(self, size, event=None, now=None):
+        """
+        :param size: int: message size in bytes
+        :param event: dict: parsed event, None for service messages,
+        they're counted in bytes only
+        :param now: float: receiving time
+        """
+        now = now or time.time()
+        with self._lock:
+            self._rate.add(size, now, events=0 if event is None else 1)
+        self.metrics.counter('stream.bytes').inc(size)
+        if event is None:
+            return
+        self.metrics.counter('stream.events').inc()
+        for tag in event.get('tags') or ():
+            self.metrics.counter('stream.tags.%s' % tag).inc()
+        creation_time = event.get('creation_time')
+        if creation_time:
+            lag = max(now - creation_time, 0.0)
+            self.metrics.histogram('stream.lag', LAG_BUCKETS).observe(lag)
+            self.metrics.gauge('stream.lag.last').set(lag)
+
+    def on_processed(self, seconds):
+        """
+        :param seconds: float: consumer processing time of a message
+        """
+        self.metrics.histogram('stream.process_time').observe(seconds)
+
+    def on_ping(self, rtt):
+        """
+        :param rtt: float: websocket ping round trip time in seconds
+        """
+        self.metrics.gauge('stream.ping_rtt').set(rtt)
+
+    def rates(self, now=None):
+        """
+        :return: tuple of (events per second, bytes per second)
+        """
+        with self._lock:
+            return self._rate.rates(now or time.time(), self.started_at)
+
+    def snapshot(self):
+        """
+        :return: dict
+        """
+        metrics = self.metrics.snapshot()
+        events_per_sec, bytes_per_sec = self.rates()
+        tags_prefix = 'stream.tags.'
+        return {
+            'events': metrics.get('stream.events', 0),
+            'bytes': metrics.get('stream.bytes', 0),
+            'events_per_sec': events_per_sec,
+            'bytes_per_sec': bytes_per_sec,
+            'tags': {name[len(tags_prefix):]: value
+                     for name, value in metrics.items()
+                     if name.startswith(tags_prefix)},
+            'lag': metrics.get('stream.lag'),
+            'last_lag': metrics.get('stream.lag.last'),
+            'process_time': metrics.get('stream.process_time'),
+            'ping_rtt': metrics.get('stream.ping_rtt'),
+        }
+
+    def forecast_quota(self, monthly_limit, used, now=None):
+        """Predict when the monthly limit is reached at the current rate
+
+        :param monthly_limit: int: events per month, None if unlimited
+        :param used: int: events used in the current month
+        :param now: float: unixtime
+        :return: dict
+        """
+        now = now or time.time()
+        events_per_sec = self.rates(now)[0]
+        forecast = {'monthly_limit': monthly_limit, 'used': used,
+                    'left': None, 'events_per_sec': events_per_sec,
+                    'exhausted_at': None, 'will_exceed': False}
+        if monthly_limit is None:
+            return forecast
+
+        left = max(monthly_limit - used, 0)
+        forecast['left'] = left
+        if not left:
+            forecast['exhausted_at'] = now
+        elif events_per_sec:
+            forecast['exhausted_at'] = now + left / events_per_sec
+        if forecast['exhausted_at'] is not None:
+            month_end = get_month_bounds(now)[1]
+            forecast['will_exceed'] = forecast['exhausted_at'] < month_end
+        return forecast
+
 
 class Stream(object):
-    """Stream representation"""
+    """Stream representation. Messages can be consumed in the caller's
+    event loop:
+
+    >>> async with api.get_stream() as stream:
+    >>>     async for payload in stream:
+    >>>         print(payload)
 
-    def __init__(self, conn_url):
+    Iteration stops when the server closes the stream. A message is
+    acknowledged in the checkpoint when the next one is requested, i.e.
+    when the loop body has processed it.
+    """
+
+    EXTRA_HEADERS = {
+        'Connection': 'upgrade',
+        'Upgrade': 'websocket',
+        'Sec-Websocket-Version': 13,
+    }
+
+    def __init__(self, conn_url, checkpoint=None, transport=None,
+                 stats_window=60.0):
+        """
+        :param conn_url: str: websocket connection url
+        :param checkpoint: vk_requests.checkpoint.Checkpointer instance,
+        event_id of an event is acknowledged when the consumer has processed
+        it. Streaming API doesn't replay missed events, the last processed
+        event_id is available after restart as checkpoint.position
+        :param transport: vk_requests.transport.Transport instance which
+        opens the websocket connection
+        :param stats_window: float: period of the rates in the stats
+        """
         self._conn_url = conn_url
         self._consumer_fn = None
+        self.checkpoint = checkpoint
+        self.transport = transport or HTTPTransport()
+        self.stats = StreamStats(window=stats_window)
+        self._ws = None
+        self._unacked = None
+        self._returned_at = None
+        self._stats_callbacks = []
+        self._reporters = []
 
     def __repr__(self):
         return '%s(conn_url=%s)' % (self.__class__.__name__, self._conn_url)
 
+    async def connect(self):
+        """Open the websocket connection
+
+        :return: websocket connection
+        """
+        ws = await self.transport.connect(
+            self._conn_url, extra_headers=self.EXTRA_HEADERS)
+        if ws is None:
+            raise RuntimeError("Couldn't connect to the '%s'" % self._conn_url)
+        return ws
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._returned_at is not None:
+            self.stats.on_processed(time.time() - self._returned_at)
+            self._returned_at = None
+        self._ack_processed()
+        if self._ws is None:
+            self._ws = await self.connect()
+            self._start_reporters()
+        try:
+            message = await self._ws.recv()
+        except websockets.ConnectionClosedOK:
+            logger.info('Stream is closed by the server')
+            await self.close()
+            raise StopAsyncIteration
+        event = parse_event(message)
+        self.stats.on_message(get_message_size(message), event)
+        # Measured by websockets keepalive pings
+        latency = getattr(self._ws, 'latency', None)
+        if latency:
+            self.stats.on_ping(latency)
+        self._unacked = event
+        self._returned_at = time.time()
+        return message
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        """Close the connection and save the checkpoint. The message being
+        processed is not acknowledged"""
+        ws, self._ws = self._ws, None
+        self._unacked = self._returned_at = None
+        self._stop_reporters()
+        try:
+            if ws is not None:
+                await ws.close()
+        finally:
+            if self.checkpoint is not None:
+                self.checkpoint.flush()
+
     def consumer(self, fn):
         """Consumer decorator
 
@@ -34,8 +328,7 @@ class Stream(object):
         >>> stream = api.get_stream()
 
         >>> @stream.consumer
-        >>> @asyncio.coroutine
-        >>> def handle_event(payload):
+        >>> async def handle_event(payload):
         >>>     print(payload)
 
         """
@@ -45,58 +338,293 @@ class Stream(object):
         if not any([asyncio.iscoroutine(fn), asyncio.iscoroutinefunction(fn)]):
             raise ValueError('Consumer function must be a coroutine')
         self._consumer_fn = fn
+        return fn
+
+    def on_stats(self, fn=None, interval=60.0):
+        """Call fn(stats snapshot) every interval seconds while the stream
+        is connected. Can be used as a decorator
+
+        :param fn: function or coroutine function
+        :param interval: float: seconds
+        """
+        if fn is None:
+            return lambda fn: self.on_stats(fn, interval=interval)
+        self._stats_callbacks.append((fn, interval))
+        return fn
+
+    def _start_reporters(self):
+        self._reporters = [asyncio.ensure_future(self._report(fn, interval))
+                           for fn, interval in self._stats_callbacks]
+
+    def _stop_reporters(self):
+        for reporter in self._reporters:
+            reporter.cancel()
+        self._reporters = []
+
+    async def _report(self, fn, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                result = fn(self.stats.snapshot())
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                logger.exception('Stream stats callback %s failed', fn)
+
+    def _ack_processed(self):
+        event, self._unacked = self._unacked, None
+        if event is not None:
+            self._ack_event(event)
+
+    def _ack_event(self, event):
+        # Service messages don't have event id
+        if self.checkpoint is not None and event and 'event_id' in event:
+            self.checkpoint.ack(event['event_id'])
+
+    async def run(self, consumer=None):
+        """Consume the stream in the running event loop until the server
+        closes it. The connection is closed when the task is cancelled
+
+        :param consumer: coroutine function fn(payload), the one set by
+        the consumer decorator by default
+        """
+        consumer = consumer or self._consumer_fn
+        if consumer is None:
+            raise ValueError('Consumer function is not defined yet')
+        try:
+            async for message in self:
+                await consumer(message)
+        finally:
+            await self.close()
 
     def consume(self, timeout=None, loop=None):
-        """Start consuming the stream
+        """Start consuming the stream, blocks until the stream is closed.
+        Use run() inside a running event loop
 
         :param timeout: int: if it's given then it stops consumer after given
         number of seconds
+        :param loop: event loop to run the consumer in, a new one is created
+        (and closed at the end) by default
         """
         if self._consumer_fn is None:
             raise ValueError('Consumer function is not defined yet')
 
         logger.info('Start consuming the stream')
+        own_loop = loop is None
+        if own_loop:
+            loop = asyncio.new_event_loop()
+        try:
+            if timeout:
+                logger.info('Running task with timeout %s sec', timeout)
+            loop.run_until_complete(
+                asyncio.wait_for(self.run(), timeout=timeout or None))
+        except asyncio.TimeoutError:
+            logger.info('Timeout is reached, the stream is closed')
+        except KeyboardInterrupt:
+            logger.info('Stopping the consumer')
+        finally:
+            if own_loop:
+                loop.close()
 
-        @asyncio.coroutine
-        def worker(conn_url):
-            extra_headers = {
-                'Connection': 'upgrade',
-                'Upgrade': 'websocket',
-                'Sec-Websocket-Version': 13,
-            }
 
-            ws = yield from websockets.connect(
-                conn_url, extra_headers=extra_headers)
+# Marks the end of a stream in the StreamGroup queue
+_STREAM_END = object()
 
-            if ws is None:
-                raise RuntimeError("Couldn't connect to the '%s'" % conn_url)
 
-            try:
-                while True:
-                    message = yield from ws.recv()
-                    yield from self._consumer_fn(message)
-            finally:
-                yield from ws.close()
+class StreamGroup(object):
+    """Consume several streams (e.g. of different apps) concurrently in one
+    event loop. Messages of all the streams go to one consumer tagged with
+    the name of their stream.
 
-        if loop is None:
-            loop = asyncio.new_event_loop()
+    Example:
+
+    >>> group = StreamGroup({'app1': api1.get_stream(),
+    >>>                      'app2': api2.get_stream()})
+
+    >>> @group.consumer
+    >>> async def handle_event(source, payload):
+    >>>     print(source, payload)
+
+    >>> group.consume()
+    >>> group.stats()  # per-stream health and throughput
+
+    Broken connections are reopened with exponential backoff, a stream
+    closed by the server normally is reopened after reconnect_delay unless
+    reconnect_on_close is False.
+    """
+
+    def __init__(self, streams, queue_size=1000, reconnect_delay=1.0,
+                 max_reconnect_delay=60.0, reconnect_on_close=True):
+        """
+        :param streams: dict {name: Stream} or list of Stream instances
+        (named by their index)
+        :param queue_size: int: max number of received messages waiting
+        for the consumer, receiving is paused when the queue is full
+        :param reconnect_delay: float: delay before the first reconnect
+        :param max_reconnect_delay: float: max delay between reconnects
+        :param reconnect_on_close: bool: reopen the streams closed by the
+        server normally, otherwise the stream is stopped
+        """
+        if not isinstance(streams, dict):
+            streams = {str(i): stream for i, stream in enumerate(streams)}
+        if not streams:
+            raise ValueError('No streams to consume')
+        self.streams = streams
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.reconnect_on_close = reconnect_on_close
+        self.metrics = MetricsRegistry()
+        self._consumer_fn = None
+        self._started_at = None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(streams=%s)' % (self.__class__.__name__,
+                                   sorted(self.streams))
+
+    def consumer(self, fn):
+        """Consumer decorator
+
+        :param fn: coroutine function fn(source, payload), where source is
+        the name of the stream
+        """
+        if self._consumer_fn is not None:
+            raise ValueError('Consumer function is already defined for this '
+                             'StreamGroup instance')
+        if not asyncio.iscoroutinefunction(fn):
+            raise ValueError('Consumer function must be a coroutine')
+        self._consumer_fn = fn
+        return fn
+
+    async def run(self):
+        """Consume the streams until the task is cancelled or, if
+        reconnect_on_close is False, all of them are closed by the server
+        """
+        if self._consumer_fn is None:
+            raise ValueError('Consumer function is not defined yet')
 
-        asyncio.set_event_loop(loop)
+        self._started_at = time.time()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        readers = [asyncio.ensure_future(self._read(name, stream, queue))
+                   for name, stream in self.streams.items()]
+        active = len(readers)
         try:
-            task = worker(conn_url=self._conn_url)
-            if timeout:
-                logger.info('Running task with timeout %s sec', timeout)
-                loop.run_until_complete(
-                    asyncio.wait_for(task, timeout=timeout))
+            while active:
+                name, message, event = await queue.get()
+                if message is _STREAM_END:
+                    active -= 1
+                    continue
+                started_at = time.time()
+                await self._consumer_fn(name, message)
+                stream = self.streams[name]
+                stream.stats.on_processed(time.time() - started_at)
+                stream._ack_event(event)
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+            for stream in self.streams.values():
+                if stream.checkpoint is not None:
+                    stream.checkpoint.flush()
+
+    async def _read(self, name, stream, queue):
+        """Receive the messages of the stream into the queue until the
+        stream is stopped"""
+        try:
+            await self._read_with_reconnects(name, stream, queue)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.metrics.counter('stream.%s.errors' % name).inc()
+            logger.exception('Stream %s is stopped', name)
+        await queue.put((name, _STREAM_END, None))
+
+    async def _read_with_reconnects(self, name, stream, queue):
+        delay = self.reconnect_delay
+        connected = self.metrics.gauge('stream.%s.connected' % name)
+        while True:
+            failed = True
+            try:
+                ws = await stream.connect()
+            except (OSError, RuntimeError,
+                    websockets.WebSocketException) as err:
+                # RuntimeError: the transport returned no connection
+                logger.warning('Stream %s connection failed: %r', name, err)
             else:
-                loop.run_until_complete(task)
+                connected.set(1)
+                stream._start_reporters()
+                delay = self.reconnect_delay
+                try:
+                    await self._receive(name, stream, ws, queue)
+                except websockets.ConnectionClosedOK:
+                    logger.info('Stream %s is closed by the server', name)
+                    if not self.reconnect_on_close:
+                        return
+                    failed = False
+                except (OSError, websockets.WebSocketException) as err:
+                    logger.warning('Stream %s is broken: %r', name, err)
+                finally:
+                    connected.set(0)
+                    stream._stop_reporters()
+                    await ws.close()
+            if failed:
+                self.metrics.counter('stream.%s.errors' % name).inc()
+            await asyncio.sleep(delay)
+            if failed:
+                delay = min(delay * 2, self.max_reconnect_delay)
+            self.metrics.counter('stream.%s.reconnects' % name).inc()
+
+    async def _receive(self, name, stream, ws, queue):
+        messages = self.metrics.counter('stream.%s.messages' % name)
+        received_bytes = self.metrics.counter('stream.%s.bytes' % name)
+        received_at = self.metrics.gauge('stream.%s.last_message_at' % name)
+        while True:
+            message = await ws.recv()
+            messages.inc()
+            size = get_message_size(message)
+            received_bytes.inc(size)
+            received_at.set(time.time())
+            event = parse_event(message)
+            stream.stats.on_message(size, event)
+            await queue.put((name, message, event))
+
+    def consume(self, timeout=None):
+        """Run the group in a new event loop until the streams are closed
+
+        :param timeout: float: stop after this number of seconds
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(
+                asyncio.wait_for(self.run(), timeout=timeout))
         except asyncio.TimeoutError:
-            logger.info('Timeout is reached. Closing the loop')
-            loop.close()
-        except KeyboardInterrupt:
-            logger.info('Closing the loop')
+            logger.info('Timeout is reached, streams are closed')
+        finally:
             loop.close()
 
+    def stats(self):
+        """Health and throughput of every stream
+
+        :return: dict {name: stats dict}
+        """
+        elapsed = time.time() - self._started_at if self._started_at else 0
+        stats = {}
+        for name in self.streams:
+            prefix = 'stream.%s.' % name
+            metrics = {key[len(prefix):]: value for key, value
+                       in self.metrics.snapshot(prefix=prefix).items()}
+            messages = metrics.get('messages', 0)
+            stats[name] = {
+                'connected': bool(metrics.get('connected')),
+                'messages': messages,
+                'bytes': metrics.get('bytes', 0),
+                'errors': metrics.get('errors', 0),
+                'reconnects': metrics.get('reconnects', 0),
+                'messages_per_sec': messages / elapsed if elapsed else 0.0,
+                'last_message_at': metrics.get('last_message_at'),
+            }
+        return stats
+
 
 class StreamingAPI(object):
     """VK Streaming API implementation
@@ -106,12 +634,19 @@ class StreamingAPI(object):
     REQUEST_URL = 'https://{endpoint}/rules?key={key}'
     STREAM_URL = 'wss://{endpoint}/stream?key={key}'
 
-    def __init__(self, service_token):
+    def __init__(self, service_token, transport=None):
+        """
+        :param service_token: str
+        :param transport: vk_requests.transport.Transport instance, e.g. to
+        record or replay the stream
+        """
         if not service_token:
             raise ValueError('service_token is required')
         import vk_requests
 
-        self.api = vk_requests.create_api(service_token=service_token)
+        self.transport = transport or HTTPTransport()
+        self.api = vk_requests.create_api(service_token=service_token,
+                                          transport=self.transport)
         self._params = self.api.streaming.getServerUrl()
 
     def add_rule(self, value, tag):
@@ -121,28 +656,33 @@ class StreamingAPI(object):
         :param tag: str
         :return: dict of a json response
         """
-        resp = requests.post(url=self.REQUEST_URL.format(**self._params),
-                             json={'rule': {'value': value, 'tag': tag}})
+        resp = self.transport.request(
+            'POST', url=self.REQUEST_URL.format(**self._params),
+            json={'rule': {'value': value, 'tag': tag}})
         return resp.json()
 
     def get_rules(self):
-        resp = requests.get(url=self.REQUEST_URL.format(**self._params))
+        resp = self.transport.request(
+            'GET', url=self.REQUEST_URL.format(**self._params))
         return resp.json()
 
     def remove_rule(self, tag):
         """Remove a rule by tag
 
         """
-        resp = requests.delete(url=self.REQUEST_URL.format(**self._params),
-                               json={'tag': tag})
+        resp = self.transport.request(
+            'DELETE', url=self.REQUEST_URL.format(**self._params),
+            json={'tag': tag})
         return resp.json()
 
-    def get_stream(self):
+    def get_stream(self, checkpoint=None):
         """Factory method to get a stream object
 
+        :param checkpoint: vk_requests.checkpoint.Checkpointer instance
         :return Stream instance
         """
-        return Stream(conn_url=self.STREAM_URL.format(**self._params))
+        return Stream(conn_url=self.STREAM_URL.format(**self._params),
+                      checkpoint=checkpoint, transport=self.transport)
 
     def get_settings(self):
         """Get settings object with monthly limit info
@@ -150,3 +690,38 @@ class StreamingAPI(object):
         """
         return self.api.streaming.getSettings()
 
+    def get_monthly_limit(self):
+        """
+        :return: int: events per month or None if it's unlimited
+        """
+        limit = self.get_settings()['monthly_limit']
+        if isinstance(limit, int):
+            return limit
+        if limit not in MONTHLY_LIMITS:
+            raise ValueError('Unknown monthly limit %r' % limit)
+        return MONTHLY_LIMITS[limit]
+
+    def get_monthly_usage(self, stats_type='prepared', now=None):
+        """Number of events in the current month (UTC) by
+        streaming.getStats
+
+        :param stats_type: str: 'prepared' or 'received'
+        :param now: float: unixtime
+        :return: int
+        """
+        month_start = get_month_bounds(now or time.time())[0]
+        response = self.api.streaming.getStats(
+            type=stats_type, interval='24h', start_time=month_start)
+        return sum(point['value'] for item in response
+                   for point in item['stats'])
+
+    def get_quota_forecast(self, stream_stats):
+        """Predict when the monthly limit is reached at the current rate
+        of the stream
+
+        :param stream_stats: StreamStats instance, e.g. stream.stats
+        :return: dict, see StreamStats.forecast_quota
+        """
+        return stream_stats.forecast_quota(self.get_monthly_limit(),
+                                           self.get_monthly_usage())
+
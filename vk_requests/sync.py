@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""Incremental sync of walls and news feeds: only the items which are newer
+than the ones seen by the previous sync are fetched.
+
+The newest seen item (id and date) per wall is kept in SyncIndex, which is
+saved to a checkpoint store:
+
+>>> index = SyncIndex(FileCheckpointStore('sync_index.json'))
+>>> wall_sync = WallSync(api.wall.get, index, initial_limit=1000)
+>>> with index:
+>>>     for owner_id, post in wall_sync.sync_all(owner_ids):
+>>>         save(owner_id, post)
+
+The index entry of a wall is updated when all its new items are consumed,
+so an interrupted sync fetches them again (at-least-once delivery).
+"""
+import logging
+
+from vk_requests.pagination import Paginator
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class SyncIndex(object):
+    """Newest seen item per key. Kept in memory and saved to the store as
+    one value every flush_every updates"""
+
+    def __init__(self, store, key='sync_index', flush_every=100):
+        """
+        :param store: vk_requests.checkpoint.CheckpointStore instance
+        :param key: str: store key of the index
+        :param flush_every: int: save after this number of updates
+        """
+        self.store = store
+        self.key = key
+        self.flush_every = flush_every
+        self._entries = dict(store.load(key) or {})
+        self._pending = 0
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(key=%s, entries=%s)' % (
+            self.__class__.__name__, self.key, len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def get(self, key):
+        """
+        :param key: wall owner id or feed key
+        :return: dict {'id': item id, 'date': unixtime} or None, 'id' of
+        a feed is the list of the newest item keys
+        """
+        return self._entries.get(str(key))
+
+    def update(self, key, item_id, date):
+        self._entries[str(key)] = {'id': item_id, 'date': date}
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self.store.save(self.key, self._entries)
+        self._pending = 0
+
+
+class WallSync(object):
+    """Fetch new posts of walls. Walls are read from the newest posts until
+    a page with an already seen post, the rest of the page is still
+    checked, so posts shown slightly out of order are not missed. Pinned
+    posts don't stop the sync and are yielded only if they're new."""
+
+    def __init__(self, method, index, page_size=100, initial_limit=None,
+                 method_args=None):
+        """
+        :param method: vk_requests.api.Request instance, e.g. api.wall.get
+        :param index: SyncIndex instance
+        :param page_size: int: posts per request
+        :param initial_limit: int: max number of posts fetched from a wall
+        which isn't in the index yet, the whole wall if it's None
+        :param method_args: dict: extra method arguments (e.g. filter)
+        """
+        self.method = method
+        self.index = index
+        self.page_size = page_size
+        self.initial_limit = initial_limit
+        self.method_args = dict(method_args or {})
+        self.calls = 0
+
+    def sync(self, owner_id):
+        """Iterate over the new posts of the wall, the newest first
+
+        :param owner_id: int: wall owner id
+        :return: generator of post dicts
+        """
+        last = self.index.get(owner_id)
+        last_id = last['id'] if last is not None else None
+        paginator = Paginator(
+            self.method, dict(self.method_args, owner_id=owner_id),
+            page_size=self.page_size,
+            limit=self.initial_limit if last is None else None)
+
+        newest = last
+        fetched_ids = set()
+        new_items = 0
+        try:
+            for page in paginator.iter_pages():
+                seen_reached = False
+                for item in page.items:
+                    # New posts shift the offsets while paging, skip the
+                    # posts of the previous page
+                    if item['id'] in fetched_ids:
+                        continue
+                    fetched_ids.add(item['id'])
+                    if last_id is not None and item['id'] <= last_id:
+                        if not item.get('is_pinned'):
+                            seen_reached = True
+                        continue
+                    if newest is None or item['id'] > newest['id']:
+                        newest = {'id': item['id'], 'date': item['date']}
+                    new_items += 1
+                    yield item
+                if seen_reached:
+                    break
+        finally:
+            self.calls += paginator.calls
+
+        if newest is not last:
+            self.index.update(owner_id, newest['id'], newest['date'])
+        logger.debug('Wall %s is synced: %s new posts', owner_id, new_items)
+
+    def sync_all(self, owner_ids):
+        """Sync the walls one by one
+
+        :param owner_ids: iterable of wall owner ids
+        :return: generator of (owner_id, post) tuples
+        """
+        for owner_id in owner_ids:
+            for item in self.sync(owner_id):
+                yield owner_id, item
+
+
+def get_feed_item_key(item):
+    """Key of the news feed item: its type, source and own id. Items
+    without an id (e.g. 'photo' and 'friend' ones) are identified by the
+    ids of the objects they hold
+
+    :param item: newsfeed.get item dict
+    :return: str
+    """
+    item_id = item.get('post_id', item.get('id'))
+    if item_id is None:
+        for value in item.values():
+            if isinstance(value, dict) and \
+                    isinstance(value.get('items'), list):
+                item_id = ','.join(
+                    str(obj.get('id', obj.get('user_id')))
+                    for obj in value['items'] if isinstance(obj, dict))
+                break
+    return '%s:%s:%s' % (item.get('type'), item.get('source_id'), item_id)
+
+
+class FeedSync(object):
+    """Fetch new items of the news feed (newsfeed.get, user token only).
+    The feed is filtered by the server with start_time, so only the new
+    items are transferred. start_time is the date of the newest seen items
+    (items of the same second may come later), their keys are kept in the
+    index to skip them"""
+
+    def __init__(self, method, index, key='newsfeed', page_size=100,
+                 method_args=None):
+        """
+        :param method: vk_requests.api.Request instance, e.g.
+        api.newsfeed.get
+        :param index: SyncIndex instance
+        :param key: str: index key of the feed
+        :param page_size: int: items per request
+        :param method_args: dict: extra method arguments (e.g. filters)
+        """
+        self.method = method
+        self.index = index
+        self.key = key
+        self.page_size = page_size
+        self.method_args = dict(method_args or {})
+        self.calls = 0
+
+    def sync(self):
+        """Iterate over the new feed items, the newest first
+
+        :return: generator of item dicts
+        """
+        last = self.index.get(self.key)
+        method_args = dict(self.method_args, count=self.page_size)
+        newest_date, seen_keys = None, frozenset()
+        if last is not None:
+            method_args['start_time'] = newest_date = last['date']
+            # Keys of the items of the newest date
+            seen_keys = frozenset(last['id'] or ())
+
+        newest_keys = set(seen_keys)
+        fetched_keys = set()
+        while True:
+            self.calls += 1
+            response = self.method(**method_args)
+            for item in response['items']:
+                key = get_feed_item_key(item)
+                if key in fetched_keys or key in seen_keys:
+                    continue
+                fetched_keys.add(key)
+                if newest_date is None or item['date'] > newest_date:
+                    newest_date = item['date']
+                    newest_keys = set([key])
+                elif item['date'] == newest_date:
+                    newest_keys.add(key)
+                yield item
+            next_from = response.get('next_from')
+            if not next_from or not response['items']:
+                break
+            method_args['start_from'] = next_from
+
+        if newest_date is not None and (last is None or
+                                        newest_date != last['date'] or
+                                        newest_keys != seen_keys):
+            self.index.update(self.key, sorted(newest_keys), newest_date)
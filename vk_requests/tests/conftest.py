@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+import sys
+
+# Streaming API and the async long poll iteration use async/await syntax
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore += ['test_streaming.py', 'test_longpoll.py']
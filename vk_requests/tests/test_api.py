@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 
+import pytest
 import six
 
 import vk_requests
@@ -18,7 +19,7 @@ except ImportError:
 
 def fake_request(return_text_value='{}'):
     http_resp_mock = mock.Mock()
-    http_resp_mock.configure_mock(text=return_text_value)
+    http_resp_mock.configure_mock(content=return_text_value.encode('utf-8'))
     return mock.patch('vk_requests.utils.VerboseHTTPSession.request',
                       return_value=http_resp_mock)
 
@@ -56,7 +57,7 @@ class VkApiTest(unittest.TestCase):
 
         """
         http_resp_mock = mock.Mock()
-        http_resp_mock.configure_mock(text='{}')
+        http_resp_mock.configure_mock(content=b'{}')
         mock_request.return_value = http_resp_mock
 
         # Expect default version to being passed
@@ -213,7 +214,7 @@ class VkApiMethodsLiveTest(unittest.TestCase):
 
 def test_customize_http_params():
     http_resp_mock = mock.Mock()
-    http_resp_mock.configure_mock(text='{}')
+    http_resp_mock.configure_mock(content=b'{}')
     with fake_request() as req:
         api = vk_requests.create_api(
             http_params={'timeout': 15, 'verify': False})
@@ -222,3 +223,52 @@ def test_customize_http_params():
 
         assert params['verify'] is False
         assert params['timeout'] == 15
+
+
+def test_execute_raw_mode():
+    payload = '{"response": [1, false], "execute_errors": [' \
+              '{"method": "users.get", "error_code": 10, ' \
+              '"error_msg": "Internal server error"}]}'
+    with fake_request(return_text_value=payload) as req:
+        api = vk_requests.create_api()
+        with pytest.raises(VkAPIError):
+            api.execute(code='return 1;')
+
+        resp = api.execute(code='return 1;', execute_mode='raw')
+        assert resp['response'] == [1, False]
+        assert resp['execute_errors'][0]['error_code'] == 10
+
+        url_data, params = tuple(req.call_args_list[-1])
+        assert 'execute_mode' not in params['data']
+
+
+def test_execute_partial_mode():
+    payload = '{"response": [1, false], "execute_errors": [' \
+              '{"method": "users.get", "error_code": 10, ' \
+              '"error_msg": "Internal server error"}]}'
+    with fake_request(return_text_value=payload):
+        api = vk_requests.create_api()
+        result = api.execute(code='return 1;', execute_mode='partial')
+        assert result[0] == 1
+        assert result.failed == [1]
+        assert result.get_error(1).code == 10
+
+
+def test_return_raw():
+    payload = '{"response": [{"id": 1}]}'
+    with fake_request(return_text_value=payload) as req:
+        api = vk_requests.create_api()
+        resp = api.users.get(user_ids=1, return_raw=True)
+        assert resp == payload.encode('utf-8')
+
+        resp = api.users.get(user_ids=1, return_raw='memoryview')
+        assert isinstance(resp, memoryview)
+        assert resp.tobytes() == payload.encode('utf-8')
+
+        url_data, params = tuple(req.call_args_list[-1])
+        assert 'return_raw' not in params['data']
+
+    error = '{"error": {"error_code": 10, "error_msg": "Internal error"}}'
+    with fake_request(return_text_value=error):
+        with pytest.raises(VkAPIError):
+            api.users.get(user_ids=1, return_raw=True)
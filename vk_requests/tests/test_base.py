@@ -1,7 +1,17 @@
 # coding=utf8
+import time
 import unittest
 import os.path as op
+
+import requests
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from vk_requests.exceptions import VkPageWarningsError
+from vk_requests.longpoll import BotsLongPoll
 import vk_requests.utils as utils
 
 
@@ -14,6 +24,99 @@ def get_fixture(filename):
         return fd.read()
 
 
+def make_response(payload):
+    response = mock.Mock()
+    response.json.return_value = payload
+    return response
+
+
+class FakeLongPollServer(object):
+    """Long poll server and getLongPollServer method emulation, responses
+    are payloads, exceptions to raise or HTTP error status codes"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.servers_given = 0
+
+    def make_request(self, request, captcha_response=None):
+        assert request.method_name in ('groups.getLongPollServer',
+                                       'messages.getLongPollServer')
+        self.servers_given += 1
+        return {'server': 'im.vk.com/lp', 'key': 'key%s' % self.servers_given,
+                'ts': '100'}
+
+    def get(self, url, params=None, **kwargs):
+        self.requests.append((url, dict(params)))
+        if not self.responses:
+            # Emulate waiting for the new updates
+            time.sleep(0.01)
+            return make_response({'ts': params['ts'], 'updates': []})
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(response, int):
+            error_response = mock.Mock(status_code=response)
+            error_response.raise_for_status.side_effect = \
+                requests.HTTPError(response=error_response)
+            return error_response
+        return make_response(response)
+
+
+def get_longpoll(api, responses, cls=BotsLongPoll, **kwargs):
+    fake_server = FakeLongPollServer(responses)
+    api._session.make_request = fake_server.make_request
+    if cls is BotsLongPoll:
+        kwargs.setdefault('group_id', 1)
+    longpoll = cls(api, **kwargs)
+    longpoll.http_session.get = fake_server.get
+    return longpoll, fake_server
+
+
+def message(text):
+    return {'type': 'message_new', 'object': {'text': text}}
+
+
+class FakePaginatedVK(object):
+    """Emulates paginated methods and 'execute' pagination script"""
+
+    def __init__(self, total, fail_offsets=()):
+        self.items = list(range(total))
+        self.fail_offsets = set(fail_offsets)
+        self.requests = []
+
+    def get_page(self, offset, count):
+        return {'count': len(self.items),
+                'items': self.items[offset:offset + count]}
+
+    def make_request(self, request, captcha_response=None):
+        args = request.method_args
+        self.requests.append((request.method_name, dict(args),
+                              dict(request.call_options)))
+        if request.method_name != 'execute':
+            return self.get_page(args['offset'], args['count'])
+
+        assert request.call_options['execute_mode'] == 'raw'
+        offset, count = int(args['offset']), int(args['count'])
+        response, errors = [], []
+        for i in range(int(args['pages'])):
+            page_offset = offset + i * count
+            if page_offset in self.fail_offsets:
+                self.fail_offsets.discard(page_offset)
+                response.append(False)
+                errors.append({'method': 'wall.get', 'error_code': 10,
+                               'error_msg': 'Internal server error'})
+                break
+            page = self.get_page(page_offset, count)
+            response.append(page)
+            if not page['items'] or page_offset + count >= page['count']:
+                break
+        payload = {'response': response}
+        if errors:
+            payload['execute_errors'] = errors
+        return payload
+
+
 class UtilsTestCase(unittest.TestCase):
     def test_stringify(self):
         self.assertEqual(
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.checkpoint import FileCheckpointStore, \
+    MemoryCheckpointStore, Checkpointer
+from vk_requests.longpoll import UserLongPoll
+from vk_requests.pagination import paginate
+from vk_requests.tests.test_base import get_longpoll, message, \
+    FakePaginatedVK
+
+
+@pytest.fixture
+def api():
+    return API(session=VKSession())
+
+
+def test_file_store(tmpdir):
+    path = str(tmpdir.join('checkpoints.json'))
+    store = FileCheckpointStore(path)
+    assert store.load('stream') is None
+
+    store.save('stream', {'post_id': 1})
+    store.save('longpoll', '100')
+    with open(path) as fd:
+        assert json.load(fd) == {'stream': {'post_id': 1}, 'longpoll': '100'}
+    # No temporary files are left
+    assert os.listdir(str(tmpdir)) == ['checkpoints.json']
+
+    assert FileCheckpointStore(path).load('longpoll') == '100'
+
+
+def test_checkpointer_batches_writes():
+    store = MemoryCheckpointStore()
+    store.save = mock.Mock(wraps=store.save)
+    checkpoint = Checkpointer(store, key='offset', flush_every=3,
+                              flush_interval=60)
+    assert checkpoint.position is None
+
+    for offset in (100, 200):
+        checkpoint.ack(offset)
+    assert store.save.call_count == 0
+    assert checkpoint.position == 200
+
+    checkpoint.ack(300)
+    assert store.save.call_count == 1
+    assert store.load('offset') == 300
+
+    # Nothing changed since the last save
+    checkpoint.flush()
+    assert store.save.call_count == 1
+
+    with checkpoint:
+        checkpoint.ack(400)
+    assert store.load('offset') == 400
+    assert Checkpointer(store, key='offset').position == 400
+
+
+def test_longpoll_resumes_from_checkpoint(api):
+    store = MemoryCheckpointStore()
+    store.save('longpoll', '90')
+    checkpoint = Checkpointer(store, key='longpoll', flush_every=1)
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [message('a'), message('b')]},
+        {'ts': '102', 'updates': [message('c')]},
+    ], checkpoint=checkpoint)
+
+    updates = iter(longpoll)
+    next(updates)
+    assert server.requests[0][1]['ts'] == '90'
+    # The update 'a' is returned but not processed yet
+    assert store.load('longpoll') == '90'
+
+    next(updates)
+    assert store.load('longpoll') == '90'
+
+    next(updates)
+    # Both updates of the first batch are processed
+    assert store.load('longpoll') == '101'
+
+    longpoll.stop()
+    with pytest.raises(StopIteration):
+        next(updates)
+    assert store.load('longpoll') == '102'
+
+
+def test_longpoll_run_acks_processed_batches(api):
+    store = MemoryCheckpointStore()
+    checkpoint = Checkpointer(store, key='longpoll')
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [message('a'), message('b')]},
+        {'ts': '102', 'updates': [message('c')]},
+    ], checkpoint=checkpoint)
+    processed = []
+
+    @longpoll.on('message_new')
+    def handle_message(update):
+        processed.append(update)
+        if len(processed) == 3:
+            longpoll.stop()
+
+    longpoll.run(workers=2)
+    assert store.load('longpoll') == '102'
+
+
+def test_longpoll_run_skips_malformed_updates(api):
+    store = MemoryCheckpointStore()
+    checkpoint = Checkpointer(store, key='longpoll')
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [[4, 'a'], []]},
+        {'ts': '102', 'updates': [[4, 'b']]},
+    ], cls=UserLongPoll, checkpoint=checkpoint)
+    processed = []
+
+    @longpoll.on(4)
+    def handle_message(update):
+        processed.append(update)
+        if len(processed) == 2:
+            longpoll.stop()
+
+    longpoll.run(workers=1)
+    assert store.load('longpoll') == '102'
+    assert longpoll.stats()['metrics']['longpoll.dispatch_errors'] == 1
+
+
+def test_paginator_resumes_from_checkpoint(api):
+    store = MemoryCheckpointStore()
+    checkpoint = Checkpointer(store, key='wall', flush_every=1)
+    fake_vk = FakePaginatedVK(total=250)
+
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        pages = paginate(api.wall.get, owner_id=1,
+                         checkpoint=checkpoint).iter_pages()
+        next(pages)
+        next(pages)
+        # The second page is not processed yet
+        assert store.load('wall') == 100
+
+        # Restart
+        items = list(paginate(api.wall.get, owner_id=1,
+                              checkpoint=Checkpointer(store, key='wall')))
+    assert items == list(range(100, 250))
+    assert store.load('wall') == 300
+
+
+def test_paginator_checkpoint_with_offset_and_limit(api):
+    store = MemoryCheckpointStore()
+    store.save('wall', 150)
+    fake_vk = FakePaginatedVK(total=1000)
+
+    def get_items(**kwargs):
+        return list(paginate(api.wall.get, owner_id=1, page_size=50,
+                             checkpoint=Checkpointer(store, key='wall'),
+                             **kwargs))
+
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        # Position before the offset is not used
+        assert get_items(offset=500, limit=10) == list(range(500, 510))
+        assert store.load('wall') == 510
+
+        # Resumed pagination stops where the first run would stop
+        store.save('wall', 150)
+        assert get_items(offset=100, limit=100) == list(range(150, 200))
+        assert get_items(offset=100, limit=100) == []
+        assert get_items(limit=100) == []
+
+
+def test_stream_acks_event_id():
+    from vk_requests.streaming import Stream, parse_event
+
+    store = MemoryCheckpointStore()
+    stream = Stream(conn_url='wss://test',
+                    checkpoint=Checkpointer(store, key='stream',
+                                            flush_every=1))
+    event_id = {'post_owner_id': 1, 'post_id': 2}
+    stream._ack_event(parse_event(json.dumps(
+        {'code': 100, 'event': {'event_id': event_id}})))
+    # Service messages are not acknowledged
+    stream._ack_event(parse_event(json.dumps(
+        {'code': 300, 'service_message': {}})))
+    stream._ack_event({'tags': []})
+    assert store.load('stream') == event_id
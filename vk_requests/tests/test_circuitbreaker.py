@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+import requests
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.circuitbreaker import CircuitBreaker, CLOSED, OPEN, \
+    HALF_OPEN
+from vk_requests.exceptions import VkAPIError, VkCircuitOpenError, \
+    VkDeadlineExceeded
+from vk_requests.ratelimit import AdaptiveRateLimiter
+
+
+def fail(breaker, key, times):
+    for _ in range(times):
+        breaker.acquire(key)
+        breaker.record(key, success=False)
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    fail(breaker, 'wall.get', 2)
+    assert breaker.state('wall.get') == CLOSED
+    fail(breaker, 'wall.get', 1)
+    assert breaker.state('wall.get') == OPEN
+
+    with pytest.raises(VkCircuitOpenError) as err:
+        breaker.acquire('wall.get')
+    assert err.value.method_name == 'wall.get'
+    assert err.value.retry_after > 59
+
+    # Other methods aren't affected
+    breaker.acquire('users.get')
+    metrics = breaker.metrics.snapshot()
+    assert metrics['circuit.wall.get.state'] == 2
+    assert metrics['circuit.wall.get.opened'] == 1
+    assert metrics['circuit.wall.get.rejected'] == 1
+
+
+def test_failures_outside_window_expire():
+    breaker = CircuitBreaker(failure_threshold=2, window=0.05)
+    fail(breaker, 'wall.get', 1)
+    time.sleep(0.06)
+    fail(breaker, 'wall.get', 1)
+    assert breaker.state('wall.get') == CLOSED
+
+
+@pytest.mark.parametrize('probe_success, state', [(True, CLOSED),
+                                                  (False, OPEN)])
+def test_half_open_probe(probe_success, state):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    fail(breaker, 'wall.get', 1)
+    time.sleep(0.06)
+
+    breaker.acquire('wall.get')
+    assert breaker.state('wall.get') == HALF_OPEN
+    # Only one probe at a time
+    with pytest.raises(VkCircuitOpenError):
+        breaker.acquire('wall.get')
+
+    breaker.record('wall.get', success=probe_success)
+    assert breaker.state('wall.get') == state
+
+
+def test_release_frees_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    fail(breaker, 'wall.get', 1)
+    breaker.acquire('wall.get')
+    breaker.release('wall.get')
+    assert breaker.state('wall.get') == HALF_OPEN
+    breaker.acquire('wall.get')
+
+
+def test_per_token_circuits():
+    breaker = CircuitBreaker(per_token=True)
+    key_1 = breaker.get_key('token_1', 'wall.get')
+    key_2 = breaker.get_key('token_2', 'wall.get')
+    assert key_1 != key_2
+    assert key_1.endswith('.wall.get')
+    assert 'token_1' not in key_1
+    assert CircuitBreaker().get_key('token_1', 'wall.get') == 'wall.get'
+
+
+def test_reset():
+    breaker = CircuitBreaker(failure_threshold=1)
+    fail(breaker, 'wall.get', 1)
+    breaker.reset()
+    assert breaker.states() == {'wall.get': CLOSED}
+
+
+def test_session_fails_fast():
+    breaker = CircuitBreaker(failure_threshold=2)
+    api = API(session=VKSession(circuit_breaker=breaker))
+    internal_error = mock.Mock(
+        content=b'{"error": {"error_code": 10, "error_msg": "Internal error"}}')
+    access_error = mock.Mock(
+        content=b'{"error": {"error_code": 15, "error_msg": "Access denied"}}')
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=access_error):
+        for _ in range(3):
+            with pytest.raises(VkAPIError):
+                api.wall.get(owner_id=1)
+    assert breaker.state('wall.get') == CLOSED
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=internal_error):
+        with pytest.raises(VkAPIError):
+            api.wall.get(owner_id=1)
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    side_effect=requests.Timeout) as request:
+        with pytest.raises(requests.Timeout):
+            api.wall.get(owner_id=1)
+        assert breaker.state('wall.get') == OPEN
+
+        with pytest.raises(VkCircuitOpenError):
+            api.wall.get(owner_id=1)
+        assert request.call_count == 1
+
+
+def test_half_open_concurrent_requests():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0,
+                             half_open_max_calls=2)
+    fail(breaker, 'wall.get', 1)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            breaker.acquire('wall.get')
+        except VkCircuitOpenError:
+            result = 'rejected'
+        else:
+            result = 'probe'
+        with lock:
+            results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count('probe') == 2
+
+
+def test_local_errors_are_not_failures():
+    breaker = CircuitBreaker(failure_threshold=3)
+    api = API(session=VKSession(
+        circuit_breaker=breaker,
+        rate_limiter=AdaptiveRateLimiter(initial_rate=1)))
+    ok_response = mock.Mock(content=b'{"response": 1}')
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=ok_response) as request:
+        api.users.get(user_ids=1)
+        # Rate limiter doesn't let the requests through within the deadline
+        for _ in range(3):
+            with pytest.raises(VkDeadlineExceeded) as err:
+                api.users.get(user_ids=1, deadline=0.1)
+            assert err.value.phase == 'wait'
+    assert request.call_count == 1
+    assert breaker.state('users.get') == CLOSED
+
+
+def test_interrupted_probe_is_released():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    api = API(session=VKSession(circuit_breaker=breaker))
+    fail(breaker, 'wall.get', 1)
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            api.wall.get(owner_id=1)
+    assert breaker.state('wall.get') == HALF_OPEN
+    breaker.acquire('wall.get')
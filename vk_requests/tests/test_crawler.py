@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from vk_requests.crawler import Crawler, split_shards
+
+
+def double_task(api, item):
+    if item == 13:
+        raise ValueError('Unlucky item')
+    api.session.metrics.counter('test.calls').inc()
+    return api.session._service_token, os.getpid(), item * 2
+
+
+def unpicklable_task(api, item):
+    return lambda: item
+
+
+def test_split_shards():
+    assert list(split_shards(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(split_shards([], 2)) == []
+
+
+@pytest.mark.parametrize('tokens, expected', [
+    (['t1', 't2', 't3', 't4', 't5'], [['t1', 't4'], ['t2', 't5'], ['t3']]),
+    (['t1', 't2'], [['t1'], ['t2'], ['t1']]),
+])
+def test_worker_tokens(tokens, expected):
+    crawler = Crawler(double_task, tokens=tokens, processes=3)
+    assert crawler.get_worker_tokens() == expected
+
+
+def test_run():
+    crawler = Crawler(double_task, tokens=['t1', 't2', 't3'], processes=3,
+                      shard_size=7)
+    results = list(crawler.run(range(100)))
+
+    assert sorted(r.item for r in results) == list(range(100))
+    failed = [r for r in results if not r.ok]
+    assert [r.item for r in failed] == [13]
+    assert 'Unlucky item' in failed[0].error
+
+    ok = [r for r in results if r.ok]
+    assert all(token in ('t1', 't2', 't3') for token, _, _ in
+               (r.result for r in ok))
+    assert all(r.result[2] == r.item * 2 for r in ok)
+    assert os.getpid() not in set(r.result[1] for r in ok)
+
+    stats = crawler.stats()
+    assert stats['items'] == 100
+    assert stats['errors'] == 1
+    assert stats['items_per_sec'] > 0
+    assert stats['metrics']['crawler.shards'] == 15
+    assert stats['session_metrics']['test.calls'] == 99
+
+
+def test_workers_are_replaced():
+    crawler = Crawler(double_task, tokens=['t1', 't2'], processes=2,
+                      shard_size=5, max_shards_per_worker=1)
+    results = list(crawler.run(range(50)))
+    assert sorted(r.item for r in results) == list(range(50))
+    # New workers get the tokens with the shards
+    assert set(r.result[0] for r in results if r.ok) == {'t1', 't2'}
+    assert crawler.stats()['workers'] > 2
+
+
+def test_items_are_read_lazily():
+    consumed = []
+
+    def items():
+        for item in range(100):
+            consumed.append(item)
+            yield item
+
+    crawler = Crawler(double_task, tokens=['t1', 't2'], processes=2,
+                      shard_size=5)
+    results = crawler.run(items())
+    next(results)
+    # A shard per process
+    assert len(consumed) <= 10
+    results.close()
+
+
+def test_failed_shard():
+    crawler = Crawler(unpicklable_task, processes=2, shard_size=5)
+    crawler.POLL_INTERVAL = 0.05
+    with pytest.raises(Exception):
+        list(crawler.run(range(10)))
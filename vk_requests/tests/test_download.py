@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import pytest
+import requests
+
+from vk_requests.download import Downloader, extract_media_urls, \
+    get_photo_url, PART_SUFFIX
+
+
+def photo(*size_types):
+    return {'id': 1, 'sizes': [{'type': t, 'url': 'https://pp.vk.me/%s.jpg' % t}
+                               for t in size_types]}
+
+
+def test_get_photo_url():
+    assert get_photo_url(photo('m', 'x', 's')) == 'https://pp.vk.me/x.jpg'
+    assert get_photo_url(photo('m', 'x'), size_preference=('s', 'm')) == \
+        'https://pp.vk.me/m.jpg'
+    assert get_photo_url({'photo_130': 'a', 'photo_604': 'b'}) == 'b'
+    assert get_photo_url({'sizes': []}) is None
+
+
+def test_extract_media_urls():
+    post = {
+        'id': 1,
+        'attachments': [
+            {'type': 'photo', 'photo': photo('s', 'z')},
+            {'type': 'doc', 'doc': {'url': 'https://vk.com/doc1', 'ext': 'gif'}},
+            {'type': 'link', 'link': {'title': 'no media'}},
+            {'type': 'link', 'link': {'url': 'https://example.com/page',
+                                      'photo': photo('x')}},
+            {'type': 'audio', 'audio': {'url': 'https://vk.com/audio1'}},
+        ],
+        'copy_history': [
+            {'attachments': [{'type': 'photo', 'photo': photo('y')}]},
+        ],
+    }
+    doc = {'url': 'https://vk.com/doc2', 'ext': 'pdf'}
+    urls = list(extract_media_urls([post, photo('w'), doc,
+                                    {'text': 'no media'},
+                                    {'url': 'https://example.com/page'}]))
+    assert urls == ['https://pp.vk.me/z.jpg', 'https://vk.com/doc1',
+                    'https://pp.vk.me/y.jpg', 'https://pp.vk.me/w.jpg',
+                    'https://vk.com/doc2']
+
+
+class FakeResponse(object):
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self, files, support_ranges=True):
+        self.files = files
+        self.support_ranges = support_ranges
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def get(self, url, headers=None, stream=False, **kwargs):
+        with self.lock:
+            self.requests.append((url, headers))
+        if url not in self.files:
+            return FakeResponse(b'', status_code=404)
+        body = self.files[url]
+        range_header = (headers or {}).get('Range')
+        if range_header and self.support_ranges:
+            start = int(range_header[len('bytes='):-1])
+            if start >= len(body):
+                return FakeResponse(b'', status_code=416)
+            return FakeResponse(body[start:], status_code=206)
+        return FakeResponse(body)
+
+
+class FakeSessions(object):
+    def __init__(self, session):
+        self.session = session
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def files():
+    return {'https://pp.vk.me/%d.jpg' % i: os.urandom(1000 + i)
+            for i in range(10)}
+
+
+def get_downloader(files, **kwargs):
+    downloader = Downloader(max_workers=4, chunk_size=100)
+    downloader.http_sessions = FakeSessions(FakeSession(files, **kwargs))
+    return downloader
+
+
+def read(path):
+    with open(path, 'rb') as fd:
+        return fd.read()
+
+
+def test_download(tmpdir, files):
+    downloader = get_downloader(files)
+    urls = sorted(files) * 2 + ['https://pp.vk.me/missing.jpg']
+    results = downloader.download(urls, str(tmpdir.join('media')))
+
+    assert len(results) == 11
+    for result in results[:10]:
+        assert result.ok
+        assert read(result.path) == files[result.url]
+        assert result.path.endswith('.jpg')
+    assert not results[10].ok
+    assert not any(name.endswith(PART_SUFFIX)
+                   for name in os.listdir(str(tmpdir.join('media'))))
+
+    stats = downloader.stats()
+    assert stats['files'] == 10
+    assert stats['bytes'] == sum(len(body) for body in files.values())
+    assert stats['duplicates'] == 10
+    assert stats['errors'] == 1
+    assert stats['bytes_per_sec'] > 0
+
+
+def test_download_skips_existing_files(tmpdir, files):
+    downloader = get_downloader(files)
+    downloader.download(sorted(files), str(tmpdir))
+
+    downloader = get_downloader(files)
+    results = downloader.download(sorted(files), str(tmpdir))
+    assert all(result.skipped for result in results)
+    assert downloader.http_sessions.session.requests == []
+
+
+@pytest.mark.parametrize('support_ranges', [True, False])
+def test_download_resumes_partial_file(tmpdir, files, support_ranges):
+    url = sorted(files)[0]
+    downloader = get_downloader(files, support_ranges=support_ranges)
+    path = str(tmpdir.join(downloader.get_filename(url)))
+    with open(path + PART_SUFFIX, 'wb') as fd:
+        fd.write(files[url][:300])
+
+    result = downloader.download([url], str(tmpdir))[0]
+    assert result.ok
+    assert read(path) == files[url]
+    assert not os.path.exists(path + PART_SUFFIX)
+    assert downloader.http_sessions.session.requests == [
+        (url, {'Range': 'bytes=300-'})]
+    assert result.size == (700 if support_ranges else 1000)
+
+
+def test_download_complete_part_file(tmpdir, files):
+    url = sorted(files)[0]
+    downloader = get_downloader(files)
+    path = str(tmpdir.join(downloader.get_filename(url)))
+    with open(path + PART_SUFFIX, 'wb') as fd:
+        fd.write(files[url])
+
+    result = downloader.download([url], str(tmpdir))[0]
+    assert result.ok
+    assert read(path) == files[url]
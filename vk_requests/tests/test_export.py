@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import os
+
+import pytest
+
+from vk_requests.checkpoint import Checkpointer, FileCheckpointStore, \
+    MemoryCheckpointStore
+from vk_requests.export import export, NDJSONWriter, ParquetWriter, \
+    _to_columns
+from vk_requests.pagination import Paginator
+
+
+class FakeMethod(object):
+    """Paginated method returning {'id': N, 'attachments': [...]} items"""
+
+    method_name = 'wall.get'
+
+    def __init__(self, total, fail_offset=None):
+        self.items = [{'id': i, 'text': u'пост %d' % i,
+                       'attachments': [{'type': 'photo'}]}
+                      for i in range(total)]
+        self.fail_offset = fail_offset
+        self.offsets = []
+
+    def __call__(self, offset, count, **kwargs):
+        if offset == self.fail_offset:
+            raise IOError('Connection reset')
+        self.offsets.append(offset)
+        return {'count': len(self.items),
+                'items': self.items[offset:offset + count]}
+
+
+def read_ndjson(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as fd:
+        return [json.loads(line.decode('utf-8')) for line in fd]
+
+
+@pytest.mark.parametrize('name', ['wall.jsonl', 'wall.jsonl.gz'])
+def test_ndjson_export(tmpdir, name):
+    path = str(tmpdir.join(name))
+    method = FakeMethod(total=250)
+    written = export(Paginator(method, page_size=100), NDJSONWriter(path))
+    assert written == 250
+    assert read_ndjson(path) == method.items
+
+
+@pytest.mark.parametrize('name', ['wall.jsonl', 'wall.jsonl.gz'])
+def test_resume_after_failure(tmpdir, name):
+    path = str(tmpdir.join(name))
+    store = FileCheckpointStore(str(tmpdir.join('checkpoints.json')))
+    method = FakeMethod(total=500, fail_offset=250)
+
+    with pytest.raises(IOError):
+        export(Paginator(method, page_size=50), NDJSONWriter(path),
+               checkpoint=Checkpointer(store, key='wall'), sync_every=100)
+    # Items 200..250 are written, but not checkpointed
+    assert len(read_ndjson(path)) == 250
+    assert store.load('wall')['offset'] == 200
+
+    method.fail_offset = None
+    written = export(Paginator(method, page_size=50), NDJSONWriter(path),
+                     checkpoint=Checkpointer(store, key='wall'),
+                     sync_every=100)
+    assert written == 300
+    assert read_ndjson(path) == method.items
+    assert store.load('wall') == {'offset': 500,
+                                  'output': os.path.getsize(path)}
+
+
+def test_resume_with_limit(tmpdir):
+    path = str(tmpdir.join('wall.jsonl'))
+    store = MemoryCheckpointStore()
+    method = FakeMethod(total=500, fail_offset=250)
+
+    with pytest.raises(IOError):
+        export(Paginator(method, page_size=50, offset=100, limit=300),
+               NDJSONWriter(path), checkpoint=Checkpointer(store, key='wall'),
+               sync_every=100)
+    assert store.load('wall')['offset'] == 200
+
+    method.fail_offset = None
+    written = export(Paginator(method, page_size=50, offset=100, limit=300),
+                     NDJSONWriter(path),
+                     checkpoint=Checkpointer(store, key='wall'),
+                     sync_every=100)
+    assert written == 200
+    assert read_ndjson(path) == method.items[100:400]
+
+
+def test_missing_output_is_not_resumed(tmpdir):
+    path = str(tmpdir.join('wall.jsonl'))
+    store = MemoryCheckpointStore()
+    method = FakeMethod(total=100)
+    export(Paginator(method, page_size=50), NDJSONWriter(path),
+           checkpoint=Checkpointer(store, key='wall'))
+    os.unlink(path)
+    with pytest.raises(ValueError) as err:
+        export(Paginator(method, page_size=50), NDJSONWriter(path),
+               checkpoint=Checkpointer(store, key='wall'))
+    assert 'missing' in str(err.value)
+
+    with open(path, 'wb') as fd:
+        fd.write(b'{}\n')
+    with pytest.raises(ValueError):
+        export(Paginator(method, page_size=50), NDJSONWriter(path),
+               checkpoint=Checkpointer(store, key='wall'))
+
+
+def test_paginator_checkpoint_is_rejected(tmpdir):
+    checkpoint = Checkpointer(MemoryCheckpointStore(), key='wall')
+    paginator = Paginator(FakeMethod(total=10), checkpoint=checkpoint)
+    with pytest.raises(ValueError):
+        export(paginator, NDJSONWriter(str(tmpdir.join('wall.jsonl'))))
+
+
+def test_parquet_export(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    directory = str(tmpdir.join('wall'))
+    store = MemoryCheckpointStore()
+    method = FakeMethod(total=250, fail_offset=200)
+
+    with pytest.raises(IOError):
+        export(Paginator(method, page_size=50),
+               ParquetWriter(directory, row_group_size=60),
+               checkpoint=Checkpointer(store, key='wall'), sync_every=100)
+    method.fail_offset = None
+    export(Paginator(method, page_size=50),
+           ParquetWriter(directory, row_group_size=60),
+           checkpoint=Checkpointer(store, key='wall'), sync_every=100)
+
+    rows = []
+    for name in sorted(os.listdir(directory)):
+        rows.extend(pq.read_table(os.path.join(directory, name)).to_pylist())
+    assert [row['id'] for row in rows] == list(range(250))
+    assert json.loads(rows[0]['attachments']) == [{'type': 'photo'}]
+
+
+def test_parquet_items_with_different_keys(tmpdir):
+    rows = [{'id': 1, 'text': 'a'}, {'id': 2, 'copy_history': '[]'}]
+    assert list(_to_columns(rows).items()) == [
+        ('id', [1, 2]), ('text', ['a', None]), ('copy_history', [None, '[]'])]
+
+    pq = pytest.importorskip('pyarrow.parquet')
+    directory = str(tmpdir.join('wall'))
+    writer = ParquetWriter(directory)
+    writer.open()
+    writer.write([{'id': 1, 'text': 'a'},
+                  {'id': 2, 'copy_history': [{'id': 3}]}])
+    writer.close()
+    rows = pq.read_table(os.path.join(directory, os.listdir(directory)[0]))
+    assert rows.to_pylist() == [
+        {'id': 1, 'text': 'a', 'copy_history': None},
+        {'id': 2, 'text': None, 'copy_history': '[{"id": 3}]'}]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+
+import pytest
+import requests
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkLongPollError
+from vk_requests.longpoll import UserLongPoll
+from vk_requests.tests.test_base import get_longpoll, message
+
+
+@pytest.fixture
+def api():
+    return API(session=VKSession())
+
+
+def test_bots_longpoll_iteration(api):
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [message('a'), message('b')]},
+        {'ts': '102', 'updates': [{'type': 'wall_post_new'}]},
+    ])
+    updates = iter(longpoll)
+    assert next(updates) == message('a')
+    assert next(updates) == message('b')
+    assert next(updates) == {'type': 'wall_post_new'}
+
+    url, params = server.requests[0]
+    assert url == 'im.vk.com/lp'
+    assert params == {'act': 'a_check', 'key': 'key1', 'ts': '100',
+                      'wait': 25}
+    assert server.requests[1][1]['ts'] == '101'
+    assert longpoll.ts == '102'
+    assert longpoll.metrics.snapshot()['longpoll.updates'] == 3
+
+
+def test_longpoll_failed_codes(api):
+    longpoll, server = get_longpoll(api, [
+        {'failed': 1, 'ts': '150'},
+        {'failed': 2},
+        {'failed': 3},
+        {'ts': '201', 'updates': [message('a')]},
+        {'failed': 4},
+    ], cls=UserLongPoll)
+    assert next(iter(longpoll)) == message('a')
+
+    ts_sent = [params['ts'] for _, params in server.requests]
+    keys_sent = [params['key'] for _, params in server.requests]
+    # ts is taken from the error (1), key is renewed keeping ts (2),
+    # both are renewed (3)
+    assert ts_sent == ['100', '150', '150', '100']
+    assert keys_sent == ['key1', 'key1', 'key2', 'key3']
+    assert server.requests[0][0] == 'https://im.vk.com/lp'
+
+    with pytest.raises(VkLongPollError):
+        longpoll.poll()
+
+
+def test_longpoll_stop(api):
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [message('a')]},
+    ])
+    updates = []
+    for update in longpoll:
+        updates.append(update)
+        longpoll.stop()
+    assert updates == [message('a')]
+
+
+def test_longpoll_run_dispatch(api):
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [message('a'), {'type': 'group_join'},
+                                  message('b')]},
+        {'ts': '102', 'updates': [message('c')]},
+    ])
+    messages, all_updates = [], []
+    lock = threading.Lock()
+
+    @longpoll.on('message_new')
+    def handle_message(update):
+        with lock:
+            messages.append(update['object']['text'])
+        if len(messages) == 3:
+            longpoll.stop()
+
+    @longpoll.on()
+    def handle_all(update):
+        with lock:
+            all_updates.append(update)
+
+    @longpoll.on('group_join')
+    def handle_join(update):
+        raise ValueError('Handler error')
+
+    longpoll.run(workers=2)
+
+    assert sorted(messages) == ['a', 'b', 'c']
+    assert len(all_updates) == 4
+    stats = longpoll.stats()
+    assert stats['updates'] == 4
+    assert stats['lag']['count'] == 4
+    assert stats['metrics']['longpoll.dispatched.message_new'] == 3
+    assert stats['metrics']['longpoll.handler_errors'] == 1
+
+
+def test_longpoll_async_iteration(api):
+    longpoll, server = get_longpoll(api, [
+        {'ts': '101', 'updates': [message('a'), message('b')]},
+        {'ts': '102', 'updates': [message('c')]},
+    ])
+
+    async def consume():
+        texts = []
+        async for update in longpoll:
+            texts.append(update['object']['text'])
+            if len(texts) == 3:
+                longpoll.stop()
+        return texts
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(consume()) == ['a', 'b', 'c']
+    finally:
+        loop.close()
+
+
+def test_network_errors(api):
+    longpoll, server = get_longpoll(api, [
+        requests.ConnectionError('Connection reset'),
+        requests.Timeout(),
+        502,
+        {'ts': '101', 'updates': [message('a')]},
+    ], retry_delay=0.01)
+    assert [longpoll.poll() for _ in range(3)] == [[], [], []]
+    assert longpoll.poll() == [message('a')]
+    # The server is requested again after every error, ts is kept
+    assert server.servers_given == 4
+    assert [params['ts'] for _, params in server.requests] == ['100'] * 4
+    assert longpoll.metrics.counter('longpoll.network_errors').value == 3
+    assert longpoll._errors_in_row == 0
+
+    longpoll, server = get_longpoll(api, [404])
+    with pytest.raises(requests.HTTPError):
+        longpoll.poll()
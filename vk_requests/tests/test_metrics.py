@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from vk_requests.metrics import MetricsRegistry
+
+
+def test_metrics_registry():
+    metrics = MetricsRegistry()
+    metrics.counter('requests.sent').inc()
+    metrics.counter('requests.sent').inc(2)
+    metrics.gauge('queue.size').set(5)
+    assert metrics.snapshot() == {'requests.sent': 3, 'queue.size': 5}
+    assert metrics.snapshot(prefix='queue') == {'queue.size': 5}
+
+    with pytest.raises(ValueError):
+        metrics.gauge('requests.sent')
+
+
+def test_histogram():
+    metrics = MetricsRegistry()
+    histogram = metrics.histogram('latency', buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value)
+
+    snapshot = metrics.snapshot()['latency']
+    assert snapshot['count'] == 4
+    assert snapshot['min'] == 0.05
+    assert snapshot['max'] == 3
+    assert snapshot['mean'] == pytest.approx(1.0625)
+    assert snapshot['buckets'] == {0.1: 1, 1: 3}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkAPIError
+from vk_requests.pagination import paginate, Paginator, get_execute_script
+from vk_requests.tests.test_base import FakePaginatedVK
+
+
+@pytest.fixture
+def api():
+    return API(session=VKSession())
+
+
+def test_client_pagination(api):
+    fake_vk = FakePaginatedVK(total=250)
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        items = list(paginate(api.wall.get, owner_id=1))
+
+    assert items == list(range(250))
+    assert len(fake_vk.requests) == 3
+    assert fake_vk.requests[0][1] == {'owner_id': 1, 'offset': 0,
+                                      'count': 100}
+
+
+def test_client_pagination_offset_and_limit(api):
+    fake_vk = FakePaginatedVK(total=250)
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        items = list(paginate(api.wall.get, owner_id=1, offset=20, limit=90,
+                              page_size=50))
+    assert items == list(range(20, 110))
+    assert [r[1]['count'] for r in fake_vk.requests] == [50, 40]
+
+
+def test_execute_pagination(api):
+    fake_vk = FakePaginatedVK(total=2500 * 10 + 7)
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        paginator = Paginator(api.groups.getMembers,
+                              method_args={'group_id': 1, 'fields': ['sex']},
+                              mode='execute')
+        items = list(paginator)
+
+    assert items == fake_vk.items
+    # 26 pages of 1000 items, 25 pages per request
+    assert paginator.calls == 2
+    method_name, args, _ = fake_vk.requests[0]
+    assert method_name == 'execute'
+    assert args['p_group_id'] == 1
+    assert args['p_fields'] == 'sex'
+    assert args['code'] == get_execute_script('groups.getMembers',
+                                              ['fields', 'group_id'])
+    assert 'API.groups.getMembers({"fields":Args.p_fields,' \
+           '"group_id":Args.p_group_id,' in args['code']
+    assert fake_vk.requests[1][1]['offset'] == 25000
+
+
+def test_execute_pagination_partial_errors(api):
+    fake_vk = FakePaginatedVK(total=1000, fail_offsets=[0, 300])
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        paginator = paginate(api.wall.get, owner_id=1, mode='execute')
+        items = list(paginator)
+
+    assert items == fake_vk.items
+    # First request fails at once, the second one stops at offset 300,
+    # the third one resumes from it
+    assert [int(r[1]['offset']) for r in fake_vk.requests] == [0, 0, 300]
+
+
+def test_execute_pagination_persistent_error(api):
+    fake_vk = FakePaginatedVK(total=1000)
+    fake_vk.fail_offsets = mock.MagicMock()
+    fake_vk.fail_offsets.__contains__.return_value = True
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        paginator = Paginator(api.wall.get, mode='execute', max_retries=2)
+        with pytest.raises(VkAPIError) as err:
+            list(paginator)
+    assert err.value.code == 10
+    assert paginator.calls == 3
+
+
+def test_paginator_wrong_args(api):
+    with pytest.raises(ValueError):
+        Paginator(api.wall.get, method_args={'offset': 10})
+    with pytest.raises(ValueError):
+        Paginator(api.wall.get, mode='server')
+    with pytest.raises(ValueError):
+        Paginator(api.wall.get, mode='execute', pages_per_call=26)
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import time
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkAPIError, VkDeadlineExceeded
+from vk_requests.ratelimit import AdaptiveRateLimiter, \
+    TokenBucketRateLimiter, MemoryBackend, FileLockBackend, gcra_reserve
+from vk_requests.utils import Deadline
+
+
+KEY = ('-', 'users.get')
+
+
+def test_additive_increase_up_to_ceiling():
+    limiter = AdaptiveRateLimiter(initial_rate=3, max_rate=4, increase=0.25)
+    for _ in range(3):
+        limiter.on_response(KEY, limiter.acquire(KEY), latency=0.01)
+    assert limiter.rate(KEY) == 3.75
+
+    for _ in range(10):
+        limiter.on_response(KEY, time.time(), latency=0.01)
+    assert limiter.rate(KEY) == 4
+    assert limiter.metrics.snapshot()['ratelimit.-.users.get.rate'] == 4
+
+
+def test_multiplicative_decrease_once_per_burst():
+    limiter = AdaptiveRateLimiter(initial_rate=8, min_rate=1)
+    sent_at = [time.time() for _ in range(3)]
+
+    for t in sent_at:
+        limiter.on_response(KEY, t, latency=0.01, throttled=True)
+    assert limiter.rate(KEY) == 4
+
+    # Request sent after the cut decreases the rate again
+    limiter.on_response(KEY, time.time(), latency=0.01, throttled=True)
+    assert limiter.rate(KEY) == 2
+    limiter.on_response(KEY, time.time(), latency=0.01, throttled=True)
+    assert limiter.rate(KEY) == 1  # min_rate
+
+
+def test_latency_spike_decreases_rate():
+    limiter = AdaptiveRateLimiter(initial_rate=5, increase=0,
+                                  latency_min_samples=5)
+    for _ in range(5):
+        limiter.on_response(KEY, time.time(), latency=0.1)
+    limiter.on_response(KEY, time.time(), latency=0.3)
+    assert limiter.rate(KEY) == 5
+    limiter.on_response(KEY, time.time(), latency=1.0)
+    assert limiter.rate(KEY) == 2.5
+
+
+def test_pacing():
+    limiter = AdaptiveRateLimiter(initial_rate=100, max_rate=100)
+    started_at = time.time()
+    for _ in range(10):
+        limiter.acquire(KEY)
+    assert time.time() - started_at >= 0.09
+
+    # Other keys have own rates
+    started_at = time.time()
+    limiter.acquire(('-', 'wall.get'))
+    assert time.time() - started_at < 0.01
+
+
+def test_pacing_deadline():
+    limiter = AdaptiveRateLimiter(initial_rate=1, max_rate=1)
+    limiter.acquire(KEY, deadline=Deadline(1))
+    started_at = time.time()
+    with pytest.raises(VkDeadlineExceeded) as err:
+        limiter.acquire(KEY, deadline=Deadline(0.5))
+    assert err.value.phase == 'wait'
+    assert time.time() - started_at < 0.1
+
+
+def test_invalid_params():
+    with pytest.raises(ValueError):
+        AdaptiveRateLimiter(initial_rate=30, max_rate=20)
+    with pytest.raises(ValueError):
+        AdaptiveRateLimiter(decrease_factor=1)
+
+
+def test_get_key_hides_token():
+    token = 'secret_token'
+    key = AdaptiveRateLimiter.get_key(token, 'users.get')
+    assert token not in key[0]
+    assert key == AdaptiveRateLimiter.get_key(token, 'users.get')
+    assert AdaptiveRateLimiter.get_key(None, 'users.get') == KEY
+
+
+def test_session_feedback():
+    limiter = AdaptiveRateLimiter(initial_rate=10, max_rate=20, increase=1)
+    api = API(session=VKSession(rate_limiter=limiter))
+    ok_response = mock.Mock(content=b'{"response": 1}')
+    error_response = mock.Mock(
+        content=b'{"error": {"error_code": 6, "error_msg": "Too many requests"}}')
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=ok_response):
+        api.users.get(user_ids=1)
+        api.users.get(user_ids=1)
+    assert limiter.rate(KEY) == 12
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=error_response):
+        with pytest.raises(VkAPIError) as err:
+            api.users.get(user_ids=1)
+    assert err.value.is_rate_limited()
+    assert limiter.rate(KEY) == 6
+    assert limiter.rates() == {KEY: 6}
+
+
+def test_gcra_reserve():
+    # burst of 3 at 10 req/s: 3 requests go at once, then every 0.1 sec
+    tat, waits = None, []
+    for _ in range(5):
+        wait_time, tat = gcra_reserve(tat, 100.0, rate=10, burst=3)
+        waits.append(round(wait_time, 6))
+    assert waits == [0, 0, 0, 0.1, 0.2]
+
+
+@pytest.mark.parametrize('backend_cls', [MemoryBackend, FileLockBackend])
+def test_token_bucket_limiter(tmpdir, backend_cls):
+    backend = MemoryBackend() if backend_cls is MemoryBackend \
+        else FileLockBackend(str(tmpdir.join('ratelimit')))
+    limiter = TokenBucketRateLimiter(rate=100, backend=backend)
+    key = limiter.get_key('token', 'users.get')
+    assert key == limiter.get_key('token', 'wall.get')
+    assert 'token' not in key
+
+    started_at = time.time()
+    for _ in range(10):
+        limiter.acquire(key)
+    assert time.time() - started_at >= 0.09
+    # Other tokens have own limits
+    started_at = time.time()
+    limiter.acquire(limiter.get_key('other', 'users.get'))
+    assert time.time() - started_at < 0.01
+
+    # The wait is not longer than the remaining budget
+    deadline = Deadline(0.015)
+    with pytest.raises(VkDeadlineExceeded):
+        for _ in range(10):
+            limiter.acquire(key, deadline=deadline)
+    assert time.time() - started_at < 0.1
+    backend.close()
+
+
+def acquire_in_process(path, times, queue):
+    limiter = TokenBucketRateLimiter(rate=100,
+                                     backend=FileLockBackend(path))
+    queue.put([limiter.acquire('-') for _ in range(times)])
+
+
+def test_file_lock_backend_is_shared_by_processes(tmpdir):
+    path = str(tmpdir.join('ratelimit'))
+    # Backend opened before fork must not share the lock with children
+    FileLockBackend(path).reserve('-', rate=100)
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=acquire_in_process,
+                                         args=(path, 10, queue))
+                 for _ in range(4)]
+    for p in processes:
+        p.start()
+    sent_at = sorted(t for _ in processes for t in queue.get(timeout=10))
+    for p in processes:
+        p.join()
+
+    assert len(sent_at) == 40
+    # 40 requests at 100 req/s in total
+    assert sent_at[-1] - sent_at[0] >= 0.37
+    gaps = [b - a for a, b in zip(sent_at, sent_at[1:])]
+    assert sum(gaps) / len(gaps) >= 0.0095
+
+
+def test_file_lock_backend_slots(tmpdir):
+    backend = FileLockBackend(str(tmpdir.join('ratelimit')))
+    keys = ['token%d' % i for i in range(100)]
+    for key in keys:
+        assert backend.reserve(key, rate=1) == 0
+    for key in keys:
+        assert backend.reserve(key, rate=1) > 0.9
+
+
+def test_file_lock_backend_reuses_expired_slots(tmpdir):
+    path = str(tmpdir.join('ratelimit'))
+    backend = FileLockBackend(path, slots=8)
+    # More keys than slots, the buckets are full again after 1 ms
+    for i in range(100):
+        if i % 8 == 0:
+            time.sleep(0.002)
+        assert backend.reserve('token%d' % i, rate=1000) == 0
+    assert os.path.getsize(path) == 8 * FileLockBackend._SLOT.size
+
+    # Keys with waiting requests keep their slots
+    time.sleep(0.002)
+    for i in range(8):
+        backend.reserve('slow%d' % i, rate=0.1)
+    assert backend.reserve('slow3', rate=0.1) > 9
+    with pytest.raises(RuntimeError):
+        backend.reserve('slow8', rate=0.1)
+
+    # The size of the existing file is used
+    assert FileLockBackend(path, slots=1024).reserve('slow3', rate=0.1) > 19
+
+
+def test_file_lock_backend_requires_fcntl(tmpdir):
+    with mock.patch('vk_requests.ratelimit.fcntl', None):
+        with pytest.raises(RuntimeError):
+            FileLockBackend(str(tmpdir.join('ratelimit')))
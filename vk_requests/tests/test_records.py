@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import copy
+import json
+import pickle
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkAPIError
+from vk_requests import records
+from vk_requests.records import Record, DictRecord, loads, materialize
+
+
+USERS = [
+    {'id': 1, 'first_name': u'Павел', 'city': {'id': 2, 'title': 'SPb'},
+     'counters': {'friends': 10}, 'photos': [{'id': 1, 'sizes': []}]},
+    {'id': 2, 'first_name': 'Ivan'},
+]
+
+
+def get_body(payload):
+    return json.dumps(payload).encode('utf-8')
+
+
+def test_records():
+    users = loads(get_body({'response': USERS}))['response']
+    user = users[0]
+    assert isinstance(user, Record)
+    assert not hasattr(user, '__dict__')
+    assert user.first_name == u'Павел'
+    assert user.city.title == 'SPb'
+    assert user['counters']['friends'] == 10
+    assert user.photos[0].sizes == []
+    assert 'city' in user and 'city' not in users[1]
+    assert list(user) == ['id', 'first_name', 'city', 'counters', 'photos']
+    assert len(users[1]) == 2
+    with pytest.raises(AttributeError):
+        users[1].city
+    with pytest.raises(KeyError):
+        users[1]['city']
+    assert getattr(users[1], 'city', None) is None
+
+    # Objects of the same shape share the class
+    assert type(user.city) is type(loads(get_body(
+        {'response': {'id': 3, 'title': 'Moscow'}}))['response'])
+    assert [u._asdict() for u in users] == USERS
+    assert user == USERS[0] and user != USERS[1]
+
+
+def test_fields_clashing_with_record_attributes():
+    response = loads(get_body({'response': {
+        'count': 1, 'items': [{'id': 1, 'from': 2}]}}))['response']
+    assert response.items[0]['from'] == 2
+    assert response._fields == ('count', 'items')
+
+
+def test_dict_records():
+    obj = {'1': {'id': 1}, '': 2, '__class__': 3, '_data': 4, 'id': 5}
+    response = loads(get_body({'response': obj}))['response']
+    assert isinstance(response, DictRecord)
+    assert isinstance(response['1'], Record)
+    assert response['_data'] == 4 and response['__class__'] == 3
+    assert response.id == 5 and getattr(response, '1').id == 1
+    assert getattr(response, 'city', None) is None
+    with pytest.raises(KeyError):
+        response['city']
+    assert '' in response and len(response) == 5
+    assert sorted(response) == sorted(obj)
+    assert response == obj and response._asdict() == obj
+    assert pickle.loads(pickle.dumps(response)) == obj
+    assert copy.deepcopy(response) == obj
+
+    wide = loads(get_body({'response': {'f%d' % i: i for i in
+                                        range(300)}}))['response']
+    assert isinstance(wide, DictRecord) and wide.f299 == 299
+
+
+def test_shapes_are_evicted():
+    with mock.patch('vk_requests.records.MAX_SHAPES', 2):
+        response = loads(get_body({'response': [
+            {'evicted_%d' % i: i} for i in range(5)]}))['response']
+        assert all(type(item) is not DictRecord for item in response)
+        assert len(records._shapes) == 2
+        assert ('evicted_4',) in records._shapes
+    assert response[0].evicted_0 == 0
+
+
+def test_copy_and_pickle():
+    users = loads(get_body({'response': USERS}))['response']
+    copied = copy.deepcopy(users)
+    assert copied == users and copied[0] is not users[0]
+    assert pickle.loads(pickle.dumps(users)) == users
+
+
+def test_payload_keys():
+    payload = loads(get_body({'response': [False, {'id': 1}],
+                              'execute_errors': [{'error_code': 15}]}))
+    assert isinstance(payload['response'][1], Record)
+    assert payload['execute_errors'] == [{'error_code': 15}]
+    assert type(payload['execute_errors'][0]) is dict
+    assert materialize(payload['response']) == [False, {'id': 1}]
+
+
+def test_compact_response_mode():
+    session = VKSession(service_token='token')
+    api = API(session=session)
+    response = mock.Mock(status_code=200,
+                         content=get_body({'response': USERS}))
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=response):
+        users = api.users.get(user_ids=[1, 2], response_mode='compact')
+        assert users[0].city.title == 'SPb'
+        assert isinstance(api.users.get(user_ids=[1, 2])[0], dict)
+
+        api = API(session=session, response_mode='compact')
+        assert isinstance(api.users.get(user_ids=[1, 2])[0], Record)
+
+    error = mock.Mock(status_code=200, content=get_body(
+        {'error': {'error_code': 15, 'error_msg': 'Access denied'}}))
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=error):
+        with pytest.raises(VkAPIError) as exc_info:
+            api.users.get(user_ids=1)
+    assert exc_info.value.code == 15
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkDeadlineExceeded
+from vk_requests.scheduler import PriorityScheduler
+from vk_requests.utils import Deadline
+
+
+def run_queued(scheduler, priorities):
+    """Queue requests of the given classes while the only slot is busy,
+    then release the slot and return the order in which they were served
+    """
+    order = []
+    blocker = scheduler.acquire('normal')
+
+    def worker(priority):
+        with scheduler.slot(priority):
+            order.append(priority)
+
+    threads = [threading.Thread(target=worker, args=(p,)) for p in priorities]
+    for t in threads:
+        t.start()
+    while sum(scheduler.stats()['queued'].values()) < len(priorities):
+        time.sleep(0.001)
+
+    scheduler.release(blocker)
+    for t in threads:
+        t.join()
+    return order
+
+
+def test_weighted_fair_sharing():
+    scheduler = PriorityScheduler(weights={'high': 3, 'normal': 1, 'low': 1},
+                                  max_concurrency=1)
+    order = run_queued(scheduler, ['high'] * 20 + ['low'] * 20)
+
+    assert len(order) == 40
+    # High priority gets 3 of every 4 slots while both classes are queued
+    assert order[:8].count('high') == 6
+    assert order[:8].count('low') == 2
+
+    metrics = scheduler.metrics.snapshot()
+    assert metrics['scheduler.high.granted'] == 20
+    assert metrics['scheduler.low.queue_time']['count'] == 20
+    assert metrics['scheduler.low.queued'] == 0
+
+
+def test_starvation_protection():
+    scheduler = PriorityScheduler(weights={'high': 1000, 'normal': 1,
+                                           'low': 1},
+                                  max_concurrency=1, max_queue_time=0.05)
+    order = []
+    # Low priority class has just been served, so by weights its next turn
+    # comes only after 1000 high priority requests
+    scheduler.release(scheduler.acquire('low'))
+
+    def worker(priority, delay, times):
+        for _ in range(times):
+            with scheduler.slot(priority):
+                order.append(priority)
+                time.sleep(delay)
+
+    # Two producers keep the high priority queue busy all the time
+    threads = [threading.Thread(target=worker, args=('high', 0.01, 15))
+               for _ in range(2)]
+    threads.append(threading.Thread(target=worker, args=('low', 0, 1)))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Low priority request was not left to the end
+    assert order.index('low') < 25
+    assert scheduler.metrics.snapshot()['scheduler.low.starvation_promoted']
+
+
+def test_rate_limit():
+    scheduler = PriorityScheduler(rate_limit=100)
+    started_at = time.time()
+    for _ in range(10):
+        scheduler.release(scheduler.acquire())
+    assert time.time() - started_at >= 0.09
+
+
+def test_unknown_priority():
+    scheduler = PriorityScheduler()
+    with pytest.raises(ValueError):
+        scheduler.acquire('urgent')
+    with pytest.raises(ValueError):
+        PriorityScheduler(default_priority='urgent')
+
+
+def test_request_priority_option():
+    scheduler = PriorityScheduler()
+    session = VKSession(scheduler=scheduler)
+    api = API(session=session, priority='low')
+    http_resp_mock = mock.Mock()
+    http_resp_mock.configure_mock(content=b'{"response": 1}')
+
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=http_resp_mock) as request:
+        api.users.get(user_ids=1)
+        api.users.get(user_ids=1, priority='high')
+        for call in request.call_args_list:
+            assert 'priority' not in call[1]['data']
+
+    metrics = scheduler.metrics.snapshot()
+    assert metrics['scheduler.low.granted'] == 1
+    assert metrics['scheduler.high.granted'] == 1
+
+
+def test_deadline():
+    scheduler = PriorityScheduler(max_concurrency=1)
+    blocker = scheduler.acquire()
+    started_at = time.time()
+    with pytest.raises(VkDeadlineExceeded) as err:
+        scheduler.acquire('low', deadline=Deadline(0.05))
+    assert err.value.phase == 'wait'
+    assert 0.04 < time.time() - started_at < 1
+    # The request has left the queue
+    assert scheduler.stats()['queued']['low'] == 0
+
+    scheduler.release(blocker)
+    scheduler.release(scheduler.acquire('low', deadline=Deadline(1)))
+
+
+def test_call_deadline_bounds_the_queue_time():
+    scheduler = PriorityScheduler(max_concurrency=1)
+    api = API(session=VKSession(scheduler=scheduler))
+    blocker = scheduler.acquire()
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request') as \
+            request:
+        with pytest.raises(VkDeadlineExceeded) as err:
+            api.users.get(user_ids=1, deadline=0.05)
+    assert err.value.phase == 'wait'
+    assert not request.called
+    scheduler.release(blocker)
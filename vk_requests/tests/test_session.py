@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+import json
+import threading
+import time
 import unittest
+
+import requests
 import six
 try:
     from unittest import mock
@@ -7,8 +12,9 @@ except ImportError:
     import mock
 
 from vk_requests import settings
-from vk_requests.exceptions import VkPageWarningsError, VkParseError
-from vk_requests import VKSession
+from vk_requests.exceptions import VkPageWarningsError, VkParseError, \
+    VkAuthError, VkDeadlineExceeded
+from vk_requests import VKSession, API
 from vk_requests.tests.test_base import get_fixture
 from vk_requests.utils import VerboseHTTPSession
 
@@ -214,4 +220,390 @@ class VKSessionTest(unittest.TestCase):
 
             self.assertEqual(call_require_captcha['url'], 'https://oauth.vk.com/token')
             self.assertEqual(call_require_captcha['data']['captcha_sid'], '854844498568')
-            self.assertEqual(call_require_captcha['data']['captcha_key'], 'hzzk')
\ No newline at end of file
+            self.assertEqual(call_require_captcha['data']['captcha_key'], 'hzzk')
+
+
+class VKSessionConcurrencyTest(unittest.TestCase):
+    THREADS_NUM = 32
+
+    @staticmethod
+    def get_api_response(text):
+        response = mock.Mock()
+        response.configure_mock(content=text.encode('utf-8'))
+        return response
+
+    @staticmethod
+    def get_request(**kwargs):
+        request = mock.Mock(**kwargs)
+        # No call options
+        request.get_option.return_value = None
+        return request
+
+    def run_in_threads(self, fn):
+        # Threads start fn at once (threading.Barrier is python 3 only)
+        ready = []
+        ready_cond = threading.Condition()
+        errors = []
+
+        def target():
+            with ready_cond:
+                ready.append(True)
+                ready_cond.notify_all()
+                while len(ready) < self.THREADS_NUM:
+                    ready_cond.wait()
+            try:
+                fn()
+            except Exception as err:  # pragma: no cover
+                errors.append(err)
+
+        threads = [threading.Thread(target=target)
+                   for _ in range(self.THREADS_NUM)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+    def test_access_token_is_acquired_once(self):
+        vk_session = VKSession(app_id=1, user_password='test')
+        vk_session._login = 'test'
+
+        def get_access_token():
+            time.sleep(0.05)
+            return 'token'
+
+        with mock.patch.object(vk_session, '_get_access_token',
+                               side_effect=get_access_token) as get_token:
+            self.run_in_threads(lambda: vk_session.access_token)
+            self.assertEqual(get_token.call_count, 1)
+        self.assertEqual(vk_session.access_token, 'token')
+
+    def test_incorrect_token_is_renewed_once(self):
+        vk_session = VKSession(app_id=1, user_password='test')
+        vk_session._login = 'test'
+        vk_session._access_token = 'bad_token'
+        bad_token_resp = json.dumps({'error': {
+            'error_code': 15, 'error_msg': 'invalid access_token'}})
+        ok_resp = json.dumps({'response': [{'id': 1}]})
+        tokens_sent = []
+
+        def send_api_request(request, captcha_response=None,
+                             access_token=None, deadline=None):
+            tokens_sent.append(access_token)
+            if access_token == 'bad_token':
+                return self.get_api_response(bad_token_resp)
+            return self.get_api_response(ok_resp)
+
+        def get_access_token():
+            time.sleep(0.05)
+            return 'new_token'
+
+        request = self.get_request(method_name='users.get', method_args={})
+        with mock.patch.object(vk_session, '_get_access_token',
+                               side_effect=get_access_token) as get_token, \
+                mock.patch.object(vk_session, '_send_api_request',
+                                  side_effect=send_api_request):
+            self.run_in_threads(
+                lambda: self.assertEqual(vk_session.make_request(request),
+                                         [{'id': 1}]))
+            self.assertEqual(get_token.call_count, 1)
+
+        self.assertEqual(vk_session.access_token, 'new_token')
+        self.assertEqual(tokens_sent.count('new_token'), self.THREADS_NUM)
+
+    def test_failed_token_acquisition_is_shared(self):
+        vk_session = VKSession(app_id=1, user_password='test')
+        vk_session._login = 'test'
+        errors = []
+
+        def get_access_token():
+            time.sleep(0.05)
+            raise VkAuthError('Authorization error')
+
+        def get_token():
+            try:
+                return vk_session.access_token
+            except VkAuthError as err:
+                errors.append(err)
+
+        with mock.patch.object(vk_session, '_get_access_token',
+                               side_effect=get_access_token) as get_token_mock:
+            self.run_in_threads(get_token)
+            # Waiting callers get the leader's error instead of logging in
+            self.assertLess(get_token_mock.call_count, self.THREADS_NUM)
+        self.assertEqual(len(errors), self.THREADS_NUM)
+
+    def test_http_session_per_thread(self):
+        vk_session = VKSession()
+        sessions = []
+        self.run_in_threads(lambda: sessions.append(vk_session.http_session))
+
+        # Every thread has own session, but they share one connection pool
+        self.assertEqual(len(set(map(id, sessions))), self.THREADS_NUM)
+        adapters = {s.get_adapter(VKSession.API_URL) for s in sessions}
+        self.assertEqual(adapters, {vk_session.http_adapter})
+        for s in sessions:
+            self.assertEqual(s.headers['Accept'], 'application/json')
+
+        # The same thread gets the same session
+        self.assertIs(vk_session.http_session, vk_session.http_session)
+
+    def test_concurrent_requests_share_pool(self):
+        vk_session = VKSession()
+        request = self.get_request(method_name='users.get', method_args={},
+                                   http_params={})
+
+        def send(adapter, prepared_request, **kwargs):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b'{"response": 1}'
+            response.request = prepared_request
+            return response
+
+        with mock.patch('requests.adapters.HTTPAdapter.send', autospec=True,
+                        side_effect=send) as send:
+            self.run_in_threads(
+                lambda: self.assertEqual(vk_session.make_request(request), 1))
+        self.assertEqual(send.call_count, self.THREADS_NUM)
+        self.assertEqual({c[0][0] for c in send.call_args_list},
+                         {vk_session.http_adapter})
+
+    def test_auth_flow_uses_isolated_session(self):
+        vk_session = VKSession(app_id=1, user_password='test')
+        vk_session._login = 'test'
+        auth_sessions = []
+
+        def do_login(http_session):
+            auth_sessions.append(http_session)
+
+        with mock.patch.object(vk_session, 'do_login',
+                               side_effect=do_login), \
+                mock.patch.object(vk_session, 'do_implicit_flow_authorization',
+                                  return_value={'access_token': 'token'}):
+            self.run_in_threads(lambda: vk_session.access_token)
+
+        self.assertEqual(len(auth_sessions), 1)
+        self.assertIsNot(auth_sessions[0], vk_session.http_session)
+        self.assertIsNot(auth_sessions[0].get_adapter(VKSession.API_URL),
+                         vk_session.http_adapter)
+
+    def test_identical_read_requests_are_collapsed(self):
+        vk_session = VKSession(deduplicate_requests=True)
+        request = self.get_request(method_name='groups.getById',
+                                   method_args={'group_ids': [1, 2]})
+        results = []
+
+        def send_api_request(*args, **kwargs):
+            time.sleep(0.1)
+            return self.get_api_response('{"response": [{"id": 1}]}')
+
+        with mock.patch.object(vk_session, '_send_api_request',
+                               side_effect=send_api_request) as send:
+            self.run_in_threads(
+                lambda: results.append(vk_session.make_request(request)))
+
+        self.assertEqual(results, [[{'id': 1}]] * self.THREADS_NUM)
+        # Callers get own copies of the result
+        self.assertEqual(len(set(map(id, results))), self.THREADS_NUM)
+        collapsed = vk_session.metrics.counter('requests.collapsed').value
+        self.assertGreater(collapsed, 0)
+        self.assertEqual(send.call_count + collapsed, self.THREADS_NUM)
+
+    def test_write_requests_are_not_collapsed(self):
+        vk_session = VKSession(deduplicate_requests=True)
+        request = self.get_request(method_name='wall.post',
+                                   method_args={'message': 'test'})
+        self.assertFalse(vk_session.is_deduplicated(request))
+
+        request = self.get_request(method_name='users.get', method_args={})
+        self.assertTrue(vk_session.is_deduplicated(request))
+        self.assertFalse(VKSession().is_deduplicated(request))
+
+    def test_request_key_normalization(self):
+        vk_session = VKSession(deduplicate_requests=True)
+        key_1 = vk_session._get_request_key(self.get_request(
+            method_name='users.get',
+            method_args={'user_ids': [1, 2], 'fields': 'city'}))
+        key_2 = vk_session._get_request_key(self.get_request(
+            method_name='users.get',
+            method_args={'fields': ['city'], 'user_ids': '1,2'}))
+        self.assertEqual(key_1, key_2)
+
+    def test_request_key_includes_result_options(self):
+        vk_session = VKSession(deduplicate_requests=True)
+        api = API(session=vk_session)
+        keys = []
+        with mock.patch.object(vk_session, 'make_request',
+                               side_effect=lambda request: keys.append(
+                                   vk_session._get_request_key(request))):
+            api.users.get(user_ids=1)
+            api.users.get(user_ids=1, priority='bulk', deadline=5)
+            api.users.get(user_ids=1, response_mode='compact')
+            api.users.get(user_ids=1, execute_mode='raw')
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(len(set(keys)), 3)
+
+
+class VKSessionDeadlineTest(unittest.TestCase):
+    OK_RESPONSE = mock.Mock(content=b'{"response": 1}')
+    CAPTCHA_RESPONSE = mock.Mock(content=(
+        b'{"error": {"error_code": 14, "error_msg": "Captcha needed", '
+        b'"captcha_sid": "1", "captcha_img": "https://vk.com/captcha.php"}}'))
+
+    def patch_request(self, **kwargs):
+        return mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                          **kwargs)
+
+    def test_http_timeout_is_clamped(self):
+        api = API(session=VKSession(), deadline=2)
+        with self.patch_request(return_value=self.OK_RESPONSE) as request:
+            api.users.get(user_ids=1)
+            timeout = request.call_args[1]['timeout']
+            self.assertTrue(1.9 < timeout <= 2)
+
+            # Call option overrides the API default
+            api.users.get(user_ids=1, deadline=0.5)
+            self.assertLessEqual(request.call_args[1]['timeout'], 0.5)
+
+        api = API(session=VKSession(), http_params={'timeout': (1, 5)})
+        with self.patch_request(return_value=self.OK_RESPONSE) as request:
+            api.users.get(user_ids=1, deadline=3)
+            connect_timeout, read_timeout = request.call_args[1]['timeout']
+            self.assertEqual(connect_timeout, 1)
+            self.assertTrue(2.9 < read_timeout <= 3)
+
+    def test_retries_share_budget(self):
+        api = API(session=VKSession())
+
+        def get_captcha_key(captcha_image_url):
+            time.sleep(0.15)
+            return 'key'
+
+        with self.patch_request(return_value=self.CAPTCHA_RESPONSE) as \
+                request, mock.patch.object(api.session, 'get_captcha_key',
+                                           side_effect=get_captcha_key):
+            with self.assertRaises(VkDeadlineExceeded) as err:
+                api.users.get(user_ids=1, deadline=0.1)
+        self.assertEqual(err.exception.deadline, 0.1)
+        self.assertEqual(request.call_count, 1)
+
+    def test_timeout_after_deadline(self):
+        api = API(session=VKSession())
+
+        def send(*args, **kwargs):
+            time.sleep(kwargs['timeout'])
+            raise requests.Timeout()
+
+        with self.patch_request(side_effect=send):
+            with self.assertRaises(VkDeadlineExceeded) as err:
+                api.users.get(user_ids=1, deadline=0.05)
+            self.assertEqual(err.exception.phase, 'send')
+            # Timeout within the budget is raised as is
+            with self.assertRaises(requests.Timeout):
+                API(session=VKSession(), http_params={'timeout': 0.01}) \
+                    .users.get(user_ids=1, deadline=5)
+
+    def test_auth_session_is_bounded(self):
+        with mock.patch('vk_requests.VKSession.renew_access_token'):
+            vk_session = VKSession(app_id=1, user_login='login',
+                                   user_password='pass')
+        deadlines = []
+
+        def get_access_token():
+            deadlines.append(vk_session.create_auth_session().deadline)
+            return 'token'
+
+        with mock.patch.object(vk_session, '_get_access_token',
+                               side_effect=get_access_token), \
+                self.patch_request(return_value=self.OK_RESPONSE):
+            API(session=vk_session).users.get(user_ids=1, deadline=5)
+        self.assertEqual(deadlines[0].timeout, 5)
+        # Deadline doesn't leak to the auth flows of other calls
+        self.assertIsNone(vk_session.create_auth_session().deadline)
+
+    @staticmethod
+    def start_thread(target):
+        errors = []
+
+        def run():
+            try:
+                target()
+            except Exception as err:
+                errors.append(err)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, errors
+
+    def test_deduplicated_calls_keep_own_deadlines(self):
+        api = API(session=VKSession(deduplicate_requests=True))
+        started = threading.Event()
+
+        def send(*args, **kwargs):
+            if not started.is_set():
+                started.set()
+                time.sleep(0.2)
+                raise requests.Timeout()
+            return self.OK_RESPONSE
+
+        with self.patch_request(side_effect=send) as request:
+            thread, errors = self.start_thread(
+                lambda: api.users.get(user_ids=1, deadline=0.1))
+            started.wait(5)
+            # Deadline of the leader doesn't fail the call without one
+            self.assertEqual(api.users.get(user_ids=1), 1)
+            thread.join()
+        self.assertEqual(errors[0].phase, 'send')
+        self.assertEqual(request.call_count, 2)
+
+        def slow_send(*args, **kwargs):
+            started.set()
+            time.sleep(0.3)
+            return self.OK_RESPONSE
+
+        started.clear()
+        with self.patch_request(side_effect=slow_send):
+            thread, errors = self.start_thread(
+                lambda: api.users.get(user_ids=1))
+            started.wait(5)
+            # Waiting for the leader is bounded by the own deadline
+            start = time.time()
+            with self.assertRaises(VkDeadlineExceeded) as err:
+                api.users.get(user_ids=1, deadline=0.05)
+            self.assertLess(time.time() - start, 0.2)
+            self.assertEqual(err.exception.phase, 'wait')
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_token_waiters_keep_own_deadlines(self):
+        with mock.patch('vk_requests.VKSession.renew_access_token'):
+            vk_session = VKSession(app_id=1, user_login='login',
+                                   user_password='pass')
+        api = API(session=vk_session)
+        started = threading.Event()
+        calls = []
+
+        def get_access_token():
+            calls.append(vk_session.create_auth_session().deadline)
+            started.set()
+            time.sleep(0.2)
+            if calls[-1] is not None:
+                raise VkDeadlineExceeded(calls[-1].timeout, 'auth')
+            return 'token'
+
+        with mock.patch.object(vk_session, '_get_access_token',
+                               side_effect=get_access_token), \
+                self.patch_request(return_value=self.OK_RESPONSE):
+            thread, errors = self.start_thread(
+                lambda: api.users.get(user_ids=1, deadline=0.1))
+            started.wait(5)
+            start = time.time()
+            with self.assertRaises(VkDeadlineExceeded) as err:
+                api.users.get(user_ids=1, deadline=0.05)
+            self.assertLess(time.time() - start, 0.15)
+            self.assertEqual(err.exception.phase, 'wait')
+            # Auth timeout of the leader is not shared with the waiters
+            self.assertEqual(api.users.get(user_ids=1), 1)
+            thread.join()
+        self.assertEqual(errors[0].phase, 'auth')
+        self.assertEqual(len(calls), 2)
+        self.assertIsNone(calls[1])
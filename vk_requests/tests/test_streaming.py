@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import time
+
 import pytest
 import asyncio
-from vk_requests.streaming import StreamingAPI
+import websockets
+from unittest import mock
+from vk_requests.checkpoint import Checkpointer, MemoryCheckpointStore
+from vk_requests.streaming import StreamingAPI, Stream, StreamGroup, \
+    StreamStats
+from vk_requests.transport import Transport, RecordingTransport, \
+    ReplayTransport, _connection_closed
 
 SERVICE_TOKEN = os.getenv('VK_SERVICE_TOKEN')
 
@@ -41,8 +49,7 @@ def test_stream_consumer(api):
     api.add_rule(value='Привет', tag='test_hello')
     stream = api.get_stream()
 
-    @asyncio.coroutine
-    def handle_event(payload):
+    async def handle_event(payload):
         print(payload)
 
     stream.consumer(handle_event)
@@ -50,3 +57,351 @@ def test_stream_consumer(api):
     assert stream._consumer_fn is handle_event
     stream.consume(timeout=5)
     api.remove_rule(tag='test_hello')
+
+
+class FakeWebSocket(object):
+    def __init__(self, messages):
+        self.messages = messages
+        self.closed = False
+
+    async def recv(self):
+        await asyncio.sleep(0.01)
+        # None closes the connection, the next one gets the rest
+        if not self.messages or self.messages[0] is None:
+            if self.messages:
+                self.messages.pop(0)
+            raise _connection_closed()
+        return self.messages.pop(0)
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeWebSocketTransport(Transport):
+    def __init__(self, messages, failures=0, empty_connects=0):
+        self.messages = messages
+        self.failures = failures
+        # Number of the connects without a connection
+        self.empty_connects = empty_connects
+
+    async def _connect(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionRefusedError()
+        if self.empty_connects:
+            self.empty_connects -= 1
+            return None
+        self.ws = FakeWebSocket(self.messages)
+        return self.ws
+
+    def connect(self, url, **kwargs):
+        return self._connect()
+
+
+def test_stream_record_and_replay(tmpdir):
+    path = str(tmpdir.join('stream.jsonl'))
+    url = 'wss://streaming.vk.com/stream?key=secret'
+    messages = ['{"code": 100, "event": {"event_id": 1}}', b'\x00\xff']
+
+    async def record():
+        with RecordingTransport(FakeWebSocketTransport(messages[:]),
+                                path) as transport:
+            ws = await transport.connect(url)
+            return [await ws.recv(), await ws.recv()]
+
+    async def replay(speed):
+        ws = await ReplayTransport(path, speed=speed).connect(url)
+        received = [await ws.recv(), await ws.recv()]
+        with pytest.raises(websockets.ConnectionClosedOK):
+            await ws.recv()
+        await ws.close()
+        return received
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(record()) == messages
+        with open(path) as fd:
+            assert 'secret' not in fd.read()
+
+        started_at = time.time()
+        assert loop.run_until_complete(replay(None)) == messages
+        replay_time = time.time() - started_at
+        started_at = time.time()
+        assert loop.run_until_complete(replay(0.5)) == messages
+        # Recorded delays are ~0.01s between the messages
+        assert replay_time < 0.02 <= time.time() - started_at
+    finally:
+        loop.close()
+
+
+def get_event(event_id, tag='tag'):
+    return '{"code": 100, "event": {"event_id": "%s", "tags": ["%s"]}}' % (
+        event_id, tag)
+
+
+def test_stream_group():
+    checkpoint = Checkpointer(MemoryCheckpointStore(), key='app1')
+    streams = {
+        'app1': Stream('wss://app1', checkpoint=checkpoint,
+                       transport=FakeWebSocketTransport(
+                           [get_event(i, tag='тег') for i in range(3)])),
+        'app2': Stream('wss://app2', transport=FakeWebSocketTransport(
+            [get_event(i) for i in range(5)], failures=2)),
+    }
+    group = StreamGroup(streams, reconnect_delay=0.01,
+                        reconnect_on_close=False)
+    received = []
+
+    @group.consumer
+    async def handle_event(source, payload):
+        received.append((source, payload))
+
+    group.consume(timeout=5)
+
+    assert sorted(source for source, _ in received) == ['app1'] * 3 + \
+        ['app2'] * 5
+    assert [p for s, p in received if s == 'app2'] == \
+        [get_event(i) for i in range(5)]
+    assert checkpoint.position == '2'
+
+    stats = group.stats()
+    assert stats['app1']['messages'] == 3
+    # Sizes are counted in bytes, not characters
+    size = sum(len(get_event(i, tag='тег').encode('utf-8')) for i in range(3))
+    assert stats['app1']['bytes'] == size
+    assert group.metrics.snapshot()['stream.app1.bytes'] == size
+    assert stats['app2']['reconnects'] == 2
+    assert stats['app2']['errors'] == 2
+    assert not stats['app2']['connected']
+    assert stats['app2']['messages_per_sec'] > 0
+
+
+def test_stream_group_reconnects():
+    stream = Stream('wss://app', transport=FakeWebSocketTransport(
+        [get_event(1), None, get_event(2), None, get_event(3)],
+        empty_connects=1))
+    group = StreamGroup({'app': stream}, reconnect_delay=0.01)
+    received, reports = [], []
+
+    @stream.on_stats(interval=0.005)
+    def report(stats):
+        reports.append(stats)
+
+    @group.consumer
+    async def handle_event(source, payload):
+        received.append(payload)
+
+    group.consume(timeout=0.5)
+    # Closed by the server and not connected streams are reopened
+    assert received == [get_event(i) for i in (1, 2, 3)]
+    stats = group.stats()['app']
+    assert stats['reconnects'] >= 3
+    assert stats['errors'] == 1
+    assert reports and not stream._reporters
+
+
+def test_stream_group_timeout():
+    group = StreamGroup([Stream('wss://app', transport=FakeWebSocketTransport(
+        [get_event(i) for i in range(1000)]))])
+
+    @group.consumer
+    async def handle_event(source, payload):
+        pass
+
+    started_at = time.time()
+    group.consume(timeout=0.1)
+    assert time.time() - started_at < 0.5
+    assert 0 < group.stats()['0']['messages'] < 1000
+
+
+def test_stream_async_iteration():
+    checkpoint = Checkpointer(MemoryCheckpointStore(), key='stream')
+    transport = FakeWebSocketTransport([get_event(i) for i in range(3)])
+    stream = Stream('wss://app', checkpoint=checkpoint, transport=transport)
+    received = []
+
+    async def main():
+        async with stream:
+            async for payload in stream:
+                # The message is acked after it's processed
+                assert checkpoint.position == (
+                    str(len(received) - 1) if received else None)
+                received.append(payload)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    assert received == [get_event(i) for i in range(3)]
+    assert checkpoint.position == '2'
+    assert transport.ws.closed
+
+
+def test_stream_message_size():
+    messages = [get_event(1, tag='привет'), b'\x00\xff']
+    stream = Stream('wss://app',
+                    transport=FakeWebSocketTransport(messages[:]))
+
+    async def main():
+        async with stream:
+            return [payload async for payload in stream]
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(main()) == messages
+    finally:
+        loop.close()
+    assert stream.stats.snapshot()['bytes'] == \
+        len(messages[0].encode('utf-8')) + 2
+
+
+def test_stream_run_cancellation():
+    store = MemoryCheckpointStore()
+    checkpoint = Checkpointer(store, key='stream', flush_every=1000)
+    transport = FakeWebSocketTransport([get_event(i) for i in range(1000)])
+    stream = Stream('wss://app', checkpoint=checkpoint, transport=transport)
+    received = []
+
+    async def handle_event(payload):
+        received.append(payload)
+
+    async def main():
+        task = asyncio.ensure_future(stream.run(handle_event))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    assert 0 < len(received) < 1000
+    assert transport.ws.closed
+    # Checkpoint is saved on close
+    assert store.load('stream') == str(len(received) - 1)
+
+
+def test_stream_consume():
+    transport = FakeWebSocketTransport([get_event(i) for i in range(3)])
+    stream = Stream('wss://app', transport=transport)
+    received = []
+
+    @stream.consumer
+    async def handle_event(payload):
+        received.append(payload)
+
+    loop = asyncio.new_event_loop()
+    try:
+        stream.consume(loop=loop)
+        # The caller's loop stays open
+        assert not loop.is_closed()
+    finally:
+        loop.close()
+    assert len(received) == 3
+    assert handle_event is not None
+
+
+def test_stream_stats():
+    stats = StreamStats(window=10)
+    stats.started_at = 1000.0
+    for second in range(10):
+        stats.on_message(100, {'event_id': second, 'tags': ['a', 'b'],
+                               'creation_time': 999 + second},
+                         now=1001.5 + second)
+    stats.on_message(50, now=1010.5)
+    stats.on_processed(0.01)
+    stats.on_ping(0.05)
+
+    with mock.patch('time.time', return_value=1010.9):
+        snapshot = stats.snapshot()
+    # The service message is counted in bytes only
+    assert snapshot['events'] == 10
+    assert snapshot['bytes'] == 1050
+    assert snapshot['events_per_sec'] == 1.0
+    assert snapshot['bytes_per_sec'] == 105.0
+    assert snapshot['tags'] == {'a': 10, 'b': 10}
+    assert snapshot['lag']['count'] == 10
+    assert snapshot['last_lag'] == 2.5
+    assert snapshot['process_time']['count'] == 1
+    assert snapshot['ping_rtt'] == 0.05
+    # Old buckets are expired
+    assert stats.rates(now=1030.0) == (0.0, 0.0)
+
+
+def get_stream_stats(events_per_sec, now):
+    stats = StreamStats(window=10)
+    stats.started_at = 0
+    for i in range(events_per_sec * 10):
+        stats.on_message(10, {'event_id': i},
+                         now=now - 9.9 + float(i) / events_per_sec)
+    return stats
+
+
+def test_quota_forecast():
+    now = 1546300800.0  # 2019-01-01 00:00 UTC
+    stats = get_stream_stats(10, now)
+    forecast = stats.forecast_quota(1000000, 900000, now=now)
+    assert forecast['left'] == 100000
+    assert forecast['events_per_sec'] == 10.0
+    assert forecast['exhausted_at'] == now + 10000
+    assert forecast['will_exceed']
+    assert stats.forecast_quota(None, 10 ** 9, now=now)['left'] is None
+
+    # The limit is reached next month
+    now = 1548892800.0  # 2019-01-31 00:00 UTC
+    stats = get_stream_stats(10, now)
+    assert not stats.forecast_quota(1000000, 0, now=now)['will_exceed']
+
+
+def test_streaming_api_quota():
+    with mock.patch('vk_requests.create_api') as create_api:
+        api = StreamingAPI(service_token='token')
+    create_api.return_value.streaming.getSettings.return_value = {
+        'monthly_limit': 'tier_2'}
+    create_api.return_value.streaming.getStats.return_value = [
+        {'event_type': 'post', 'stats': [{'timestamp': 1, 'value': 100},
+                                         {'timestamp': 2, 'value': 50}]},
+        {'event_type': 'comment', 'stats': [{'timestamp': 1, 'value': 5}]}]
+
+    assert api.get_monthly_limit() == 1000000
+    assert api.get_monthly_usage(now=1547000000) == 155
+    create_api.return_value.streaming.getStats.assert_called_with(
+        type='prepared', interval='24h', start_time=1546300800)
+    assert api.get_quota_forecast(StreamStats())['left'] == 999845
+
+    create_api.return_value.streaming.getSettings.return_value = {
+        'monthly_limit': 'tier_100'}
+    with pytest.raises(ValueError):
+        api.get_monthly_limit()
+
+
+def test_stream_telemetry():
+    transport = FakeWebSocketTransport(
+        [get_event(i, tag='tag%s' % (i % 2)) for i in range(5)])
+    stream = Stream('wss://app', transport=transport)
+    reports = []
+
+    @stream.on_stats(interval=0.02)
+    async def report(stats):
+        reports.append(stats)
+
+    async def main():
+        async with stream:
+            async for payload in stream:
+                await asyncio.sleep(0.01)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(main())
+    finally:
+        loop.close()
+    snapshot = stream.stats.snapshot()
+    assert snapshot['events'] == 5
+    assert snapshot['tags'] == {'tag0': 3, 'tag1': 2}
+    assert snapshot['process_time']['count'] == 5
+    assert snapshot['process_time']['min'] >= 0.01
+    assert reports and reports[-1]['events'] <= 5
+    assert not stream._reporters
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+from vk_requests.checkpoint import FileCheckpointStore, MemoryCheckpointStore
+from vk_requests.sync import SyncIndex, WallSync, FeedSync
+
+
+class FakeWall(object):
+    """wall.get emulation: posts are returned the newest first, the pinned
+    one goes before them"""
+
+    method_name = 'wall.get'
+
+    def __init__(self, posts_num):
+        self.posts = []
+        self.pinned = None
+        self.requests = []
+        self.publish(posts_num)
+
+    def publish(self, posts_num):
+        last_id = self.posts[0]['id'] if self.posts else 0
+        for post_id in range(last_id + 1, last_id + posts_num + 1):
+            self.posts.insert(0, {'id': post_id, 'date': 1000 + post_id})
+
+    def pin(self, post_id):
+        self.pinned = dict([p for p in self.posts if p['id'] == post_id][0],
+                           is_pinned=1)
+
+    def __call__(self, owner_id, offset, count):
+        self.requests.append((offset, count))
+        posts = list(self.posts)
+        if self.pinned is not None:
+            posts = [self.pinned] + [p for p in posts
+                                     if p['id'] != self.pinned['id']]
+        return {'count': len(posts), 'items': posts[offset:offset + count]}
+
+
+def get_ids(items):
+    return [item['id'] for item in items]
+
+
+def test_wall_sync_fetches_delta():
+    wall = FakeWall(posts_num=500)
+    index = SyncIndex(MemoryCheckpointStore())
+    wall_sync = WallSync(wall, index, page_size=100, initial_limit=250)
+
+    assert get_ids(wall_sync.sync(1)) == list(range(500, 250, -1))
+    assert index.get(1) == {'id': 500, 'date': 1500}
+
+    wall.publish(30)
+    wall.requests = []
+    assert get_ids(wall_sync.sync(1)) == list(range(530, 500, -1))
+    # One page with the delta and the first seen post
+    assert wall.requests == [(0, 100)]
+    assert index.get(1)['id'] == 530
+
+    wall.requests = []
+    assert list(wall_sync.sync(1)) == []
+    assert len(wall.requests) == 1
+
+
+def test_pinned_posts():
+    wall = FakeWall(posts_num=300)
+    wall.pin(10)
+    index = SyncIndex(MemoryCheckpointStore())
+    wall_sync = WallSync(wall, index, page_size=100)
+    ids = get_ids(wall_sync.sync(1))
+    assert sorted(ids) == list(range(1, 301))
+    assert index.get(1)['id'] == 300
+
+    # Old pinned post doesn't stop the sync and isn't synced again
+    wall.publish(120)
+    wall.requests = []
+    assert get_ids(wall_sync.sync(1)) == list(range(420, 300, -1))
+    assert len(wall.requests) == 2
+
+    # New post is pinned
+    wall.publish(1)
+    wall.pin(421)
+    assert get_ids(wall_sync.sync(1)) == [421]
+
+
+def test_out_of_order_posts_on_the_page():
+    wall = FakeWall(posts_num=100)
+    index = SyncIndex(MemoryCheckpointStore())
+    wall_sync = WallSync(wall, index)
+    list(wall_sync.sync(1))
+
+    wall.publish(2)
+    # Post 101 is shown after the old post 100
+    wall.posts[1], wall.posts[2] = wall.posts[2], wall.posts[1]
+    assert sorted(get_ids(wall_sync.sync(1))) == [101, 102]
+
+
+def test_interrupted_sync_is_repeated():
+    wall = FakeWall(posts_num=10)
+    index = SyncIndex(MemoryCheckpointStore())
+    wall_sync = WallSync(wall, index)
+    posts = wall_sync.sync(1)
+    next(posts)
+    posts.close()
+    assert index.get(1) is None
+    assert len(list(wall_sync.sync(1))) == 10
+
+
+def test_index_is_saved(tmpdir):
+    store = FileCheckpointStore(str(tmpdir.join('index.json')))
+    walls = {1: FakeWall(posts_num=5), 2: FakeWall(posts_num=7)}
+
+    def wall_get(owner_id, **kwargs):
+        return walls[owner_id](owner_id, **kwargs)
+    wall_get.method_name = 'wall.get'
+
+    with SyncIndex(store, flush_every=10) as index:
+        synced = list(WallSync(wall_get, index).sync_all([1, 2]))
+    assert len(synced) == 12
+
+    index = SyncIndex(FileCheckpointStore(str(tmpdir.join('index.json'))))
+    assert len(index) == 2
+    assert index.get(2) == {'id': 7, 'date': 1007}
+
+
+def test_feed_sync():
+    feed = [{'type': 'post', 'source_id': -1, 'post_id': i,
+             'date': 2000 - i} for i in range(5)]
+    requests = []
+
+    def newsfeed_get(**kwargs):
+        requests.append(kwargs)
+        start_time = kwargs.get('start_time', 0)
+        items = [item for item in feed if item['date'] >= start_time]
+        offset = int(kwargs.get('start_from', 0))
+        page = items[offset:offset + kwargs['count']]
+        next_from = str(offset + len(page)) \
+            if offset + len(page) < len(items) else ''
+        return {'items': page, 'next_from': next_from}
+
+    index = SyncIndex(MemoryCheckpointStore())
+    feed_sync = FeedSync(newsfeed_get, index, page_size=2)
+    assert len(list(feed_sync.sync())) == 5
+    assert feed_sync.calls == 3
+    assert index.get('newsfeed')['date'] == 2000
+
+    feed.insert(0, {'type': 'post', 'source_id': -1, 'post_id': 10,
+                    'date': 2010})
+    assert [item['post_id'] for item in feed_sync.sync()] == [10]
+    assert requests[-1]['start_time'] == 2000
+
+    # Items of the same second published after the sync, items of other
+    # types don't have post_id
+    feed[:0] = [
+        {'type': 'post', 'source_id': -2, 'post_id': 10, 'date': 2010},
+        {'type': 'photo', 'source_id': -1, 'date': 2010,
+         'photos': {'count': 1, 'items': [{'id': 5}]}},
+        {'type': 'photo', 'source_id': -1, 'date': 2010,
+         'photos': {'count': 1, 'items': [{'id': 6}]}},
+    ]
+    items = list(feed_sync.sync())
+    assert requests[-1]['start_time'] == 2010
+    assert [(item['type'], item['source_id']) for item in items] == [
+        ('post', -2), ('photo', -1), ('photo', -1)]
+    assert list(feed_sync.sync()) == []
+    assert len(index.get('newsfeed')['id']) == 4
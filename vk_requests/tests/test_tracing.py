@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkAPIError
+from vk_requests.ratelimit import TokenBucketRateLimiter
+from vk_requests.tracing import Tracer, MemorySpanExporter, \
+    FileSpanExporter, NOOP_TRACER, STATUS_ERROR, STATUS_UNSET, read_spans
+
+
+OK_RESPONSE = mock.Mock(status_code=200, content=b'{"response": 1}')
+CAPTCHA_RESPONSE = mock.Mock(status_code=200, content=(
+    b'{"error": {"error_code": 14, "error_msg": "Captcha needed", '
+    b'"captcha_sid": "1", "captcha_img": "https://vk.com/captcha.php"}}'))
+
+
+def get_api(**kwargs):
+    exporter = MemorySpanExporter()
+    session = VKSession(service_token='token', tracer=Tracer(exporter),
+                        **kwargs)
+    return API(session=session), exporter
+
+
+def test_request_spans():
+    api, exporter = get_api(
+        rate_limiter=TokenBucketRateLimiter(rate=100))
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=OK_RESPONSE):
+        assert api.users.get(user_ids=1) == 1
+
+    spans = {span.name: span for span in exporter.spans}
+    assert [span.name for span in exporter.spans] == [
+        'vk.ratelimit.wait', 'vk.encode', 'vk.send', 'vk.decode',
+        'vk.request']
+    root = spans['vk.request']
+    assert root.parent_id is None
+    assert root.attributes == {'vk.method': 'users.get'}
+    for span in exporter.spans[:-1]:
+        assert span.parent_id == root.span_id
+        assert span.trace_id == root.trace_id
+        assert root.start_time <= span.start_time <= span.end_time <= \
+            root.end_time
+    assert spans['vk.send'].attributes['http.status_code'] == 200
+    assert spans['vk.decode'].attributes['vk.response.size'] == 15
+    assert root.status == STATUS_UNSET
+
+
+def test_retry_spans():
+    api, exporter = get_api()
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    side_effect=[CAPTCHA_RESPONSE, OK_RESPONSE]), \
+            mock.patch('vk_requests.VKSession.get_captcha_key',
+                       return_value='key'):
+        api.users.get(user_ids=1)
+
+    spans = {span.name: span for span in exporter.spans}
+    assert spans['vk.retry'].attributes == {'vk.retry.reason': 'captcha'}
+    assert spans['vk.retry'].parent_id == spans['vk.request'].span_id
+    assert spans['vk.captcha'].parent_id == spans['vk.request'].span_id
+    retried = [span for span in exporter.spans
+               if span.parent_id == spans['vk.retry'].span_id]
+    assert [span.name for span in retried] == [
+        'vk.encode', 'vk.send', 'vk.decode']
+
+
+def test_error_is_recorded():
+    api, exporter = get_api()
+    error_response = mock.Mock(status_code=200, content=(
+        b'{"error": {"error_code": 15, "error_msg": "Access denied"}}'))
+    with mock.patch('vk_requests.utils.VerboseHTTPSession.request',
+                    return_value=error_response):
+        with pytest.raises(VkAPIError):
+            api.users.get(user_ids=1)
+
+    root = exporter.spans[-1]
+    assert root.name == 'vk.request'
+    assert root.status == STATUS_ERROR
+    assert root.events[0]['attributes']['exception.type'] == 'VkAPIError'
+
+
+def test_auth_span():
+    exporter = MemorySpanExporter()
+    with mock.patch('vk_requests.VKSession.renew_access_token'):
+        session = VKSession(app_id=1, user_login='login',
+                            user_password='pass', tracer=Tracer(exporter))
+    with mock.patch('vk_requests.VKSession.do_login'), \
+            mock.patch('vk_requests.VKSession.do_implicit_flow_authorization',
+                       return_value={'access_token': 'token'}):
+        assert session.access_token == 'token'
+    assert [span.name for span in exporter.spans] == ['vk.auth']
+    assert exporter.spans[0].attributes == {'vk.auth.flow': 'implicit'}
+
+
+def test_threads_have_own_traces():
+    tracer = Tracer(MemorySpanExporter())
+    spans = []
+
+    def worker():
+        with tracer.start_as_current_span('child') as span:
+            spans.append(span)
+
+    with tracer.start_as_current_span('parent') as parent:
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        with tracer.start_as_current_span('child') as child:
+            pass
+    assert child.parent_id == parent.span_id
+    assert spans[0].parent_id is None
+    assert spans[0].trace_id != parent.trace_id
+    assert tracer.get_current_span() is None
+
+
+def test_file_exporter(tmpdir):
+    path = str(tmpdir.join('spans.jsonl'))
+    tracer = Tracer(FileSpanExporter(path))
+    with tracer.start_as_current_span('parent', attributes={'a': 1}):
+        with tracer.start_as_current_span('child'):
+            pass
+    tracer.shutdown()
+
+    child, parent = list(read_spans(path))
+    assert (child['name'], parent['name']) == ('child', 'parent')
+    assert child['parent_id'] == parent['span_id']
+    assert parent['attributes'] == {'a': 1}
+    assert parent['duration'] >= child['duration'] >= 0
+
+
+def test_tracing_is_disabled_by_default():
+    assert VKSession().tracer is NOOP_TRACER
+    with NOOP_TRACER.start_as_current_span('span') as span:
+        span.set_attribute('a', 1)
+        assert not span.is_recording()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import time
+
+import pytest
+import requests
+from six.moves.urllib.parse import urlencode
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkReplayError
+from vk_requests.transport import Transport, HTTPTransport, \
+    RecordingTransport, ReplayTransport, redact_url, gzip_compress, REDACTED
+
+
+class FakeTransport(Transport):
+    """Transport which answers with the method name and args"""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        time.sleep(self.delay)
+        data = dict(kwargs.get('data') or {})
+        data.pop('access_token', None)
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(
+            {'response': [url.rsplit('/', 1)[-1], data]}).encode('utf-8')
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+
+def get_api(transport):
+    return API(session=VKSession(service_token='secret_token',
+                                 api_version='5.92', transport=transport))
+
+
+@pytest.mark.parametrize('name', ['cassette.jsonl', 'cassette.jsonl.gz'])
+def test_record_and_replay(tmpdir, name):
+    path = str(tmpdir.join(name))
+    with RecordingTransport(FakeTransport(), path) as transport:
+        api = get_api(transport)
+        recorded = [api.users.get(user_ids=1), api.users.get(user_ids=2),
+                    api.users.get(user_ids=1)]
+
+    opener = gzip.open if name.endswith('.gz') else open
+    with opener(path, 'rb') as fd:
+        content = fd.read().decode('utf-8')
+    assert 'secret_token' not in content
+    assert len(content.splitlines()) == 3
+
+    api = get_api(ReplayTransport(path))
+    # Argument order doesn't matter, identical requests are served in order
+    assert api.users.get(user_ids=2) == recorded[1]
+    assert api.users.get(user_ids=1) == recorded[0]
+    assert api.users.get(user_ids=1) == recorded[2]
+
+    with pytest.raises(VkReplayError):
+        api.users.get(user_ids=1)
+    with pytest.raises(VkReplayError):
+        api.wall.get(owner_id=1)
+
+
+def test_replay_speed(tmpdir):
+    path = str(tmpdir.join('cassette.jsonl'))
+    with RecordingTransport(FakeTransport(delay=0.1), path) as transport:
+        get_api(transport).users.get(user_ids=1)
+
+    for speed, min_time, max_time in [(None, 0, 0.05), (2.0, 0.05, 0.1)]:
+        api = get_api(ReplayTransport(path, speed=speed))
+        started_at = time.time()
+        api.users.get(user_ids=1)
+        assert min_time <= time.time() - started_at < max_time
+
+
+def test_binary_body(tmpdir):
+    path = str(tmpdir.join('cassette.jsonl'))
+    transport = FakeTransport()
+    body = b'\x89PNG\xff\x00'
+
+    def request(method, url, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = body
+        return response
+
+    transport.request = request
+    with RecordingTransport(transport, path) as recorder:
+        recorder.request('GET', 'https://vk.com/image.png')
+
+    response = ReplayTransport(path).request('GET', 'https://vk.com/image.png')
+    assert response.content == body
+
+
+def test_redact_url():
+    url = redact_url('wss://streaming.vk.com/stream?key=abc&x=1')
+    assert 'abc' not in url
+    assert url == 'wss://streaming.vk.com/stream?key=%s&x=1' % \
+        requests.utils.quote(REDACTED)
+    assert redact_url('https://vk.com/') == 'https://vk.com/'
+
+
+def test_request_body_compression():
+    sessions = mock.Mock()
+    transport = HTTPTransport(sessions, compression_threshold=100)
+    transport.request('POST', 'https://api.vk.com/method/execute',
+                      data={'code': 'return 1;'})
+    args, kwargs = sessions.session.request.call_args
+    assert kwargs['data'] == {'code': 'return 1;'}
+    assert 'headers' not in kwargs
+
+    code = 'return [%s];' % ','.join(['API.users.get()'] * 25)
+    transport.request('POST', 'https://api.vk.com/method/execute',
+                      data={'code': code}, headers={'X-Test': '1'})
+    args, kwargs = sessions.session.request.call_args
+    assert kwargs['headers'] == {'X-Test': '1', 'Content-Encoding': 'gzip'}
+    assert gzip.decompress(kwargs['data']) == \
+        urlencode({'code': code}).encode('utf-8')
+    # Output is deterministic
+    assert gzip_compress(b'data') == gzip_compress(b'data')
+
+
+def test_session_compression_settings():
+    session = VKSession(compression='gzip', request_compression_threshold=10)
+    assert session.http_session.headers['Accept-Encoding'] == 'gzip'
+    assert session.transport.compression_threshold == 10
+    assert VKSession(compression=None).http_session.headers[
+        'Accept-Encoding'] == 'identity'
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import re
+import threading
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.upload import MultipartFileStream, Uploader
+
+
+CALL_RE = re.compile(r'API\.([\w.]+)\(\{(.*?)\}\)')
+ARG_RE = re.compile(r'"(\w+)":Args\.(\w+)')
+
+
+@pytest.fixture
+def files(tmpdir):
+    paths = []
+    for i in range(7):
+        path = tmpdir.join('photo%d.jpg' % i)
+        path.write_binary(b'x' * (1000 + i))
+        paths.append(str(path))
+    return paths
+
+
+def read_body(body, chunk_size=100):
+    chunks = []
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def parse_multipart(body, boundary):
+    parts = {}
+    for part in body.split(b'--' + boundary.encode())[1:-1]:
+        headers, content = part.split(b'\r\n\r\n', 1)
+        name = re.search(b'name="([^"]+)"', headers).group(1).decode()
+        parts[name] = content[:-2]  # trailing \r\n
+    return parts
+
+
+@pytest.mark.parametrize('mmap_threshold', [0, 1])
+def test_multipart_file_stream(files, mmap_threshold):
+    progress = []
+    body = MultipartFileStream(
+        [('file1', files[0]), ('file2', files[1])],
+        mmap_threshold=mmap_threshold,
+        progress_callback=lambda *args: progress.append(args))
+
+    data = read_body(body)
+    assert len(data) == len(body)
+    parts = parse_multipart(data, body.boundary)
+    assert parts == {'file1': b'x' * 1000, 'file2': b'x' * 1001}
+    assert progress[-1] == (files[1], 1001, 1001)
+    assert (files[0], 1000, 1000) in progress
+    assert body.content_type.startswith('multipart/form-data; boundary=')
+
+
+class FakeVK(object):
+    def __init__(self, fail_save_of=(), max_results=None):
+        self.lock = threading.Lock()
+        self.api_calls = []
+        self.uploads = []
+        self.fail_save_of = fail_save_of
+        # Number of the calls run by the execute script
+        self.max_results = max_results
+
+    def make_request(self, request, captcha_response=None):
+        with self.lock:
+            self.api_calls.append((request.method_name,
+                                   dict(request.method_args)))
+        if request.method_name.endswith('UploadServer'):
+            return {'upload_url': 'https://pu.vk.com/upload'}
+        if request.method_name == 'execute':
+            args = request.method_args
+            response, errors = [], []
+            for method_name, call_args in CALL_RE.findall(args['code']):
+                call_args = {name: args[arg_name]
+                             for name, arg_name in ARG_RE.findall(call_args)}
+                file_arg = call_args.get('file') or \
+                    call_args.get('photos_list')
+                if file_arg in self.fail_save_of:
+                    response.append(False)
+                    errors.append({'method': method_name, 'error_code': 1,
+                                   'error_msg': 'Unknown error'})
+                else:
+                    response.append([{'saved': file_arg}])
+            payload = {'response': response[:self.max_results]}
+            if errors:
+                payload['execute_errors'] = errors
+            return payload
+        args = request.method_args
+        return [{'saved': args.get('file') or args.get('photos_list')}]
+
+    def post(self, url, data=None, headers=None, **kwargs):
+        boundary = headers['Content-Type'].split('boundary=')[1]
+        parts = parse_multipart(read_body(data, 8192), boundary)
+        with self.lock:
+            self.uploads.append(parts)
+        response = mock.Mock()
+        uploaded = ','.join(sorted(parts))
+        response.json.return_value = {
+            'server': 1, 'hash': 'h', 'photo': uploaded, 'file': uploaded,
+            'photos_list': ','.join('%s:%d' % (k, len(v))
+                                    for k, v in sorted(parts.items()))}
+        return response
+
+
+def get_uploader(fake_vk, **kwargs):
+    api = API(session=VKSession())
+    api.session.make_request = fake_vk.make_request
+    uploader = Uploader(api, **kwargs)
+    http_session = api.session.http_session
+    return uploader, mock.patch.object(type(http_session), 'post',
+                                       side_effect=fake_vk.post)
+
+
+def test_upload_photos(files):
+    fake_vk = FakeVK()
+    uploader, patch_post = get_uploader(fake_vk, save_batch_size=1)
+    with patch_post:
+        results = uploader.upload_photos(files, album_id=10)
+
+    # 7 photos are uploaded by 5 + 2
+    assert [len(r.paths) for r in results] == [5, 2]
+    assert all(r.ok for r in results)
+    assert sorted(len(u) for u in fake_vk.uploads) == [2, 5]
+    methods = [name for name, _ in fake_vk.api_calls]
+    # Upload url is requested once and reused
+    assert methods.count('photos.getUploadServer') == 1
+    assert methods.count('photos.save') == 2
+    save_args = [args for name, args in fake_vk.api_calls
+                 if name == 'photos.save'][0]
+    assert save_args['album_id'] == 10
+    assert save_args['hash'] == 'h'
+
+    stats = uploader.stats()
+    assert stats['files'] == 7
+    assert stats['bytes'] > 7000
+    assert uploader.progress[files[6]] == (1006, 1006)
+
+
+def test_upload_docs_batched_saves(files):
+    fake_vk = FakeVK(fail_save_of=['file'])
+    uploader, patch_post = get_uploader(fake_vk, max_workers=3)
+    with patch_post:
+        results = uploader.upload_docs(files[:2])
+    # Both saves are failed
+    assert [r.ok for r in results] == [False, False]
+
+    fake_vk = FakeVK()
+    uploader, patch_post = get_uploader(fake_vk, max_workers=3,
+                                        save_batch_size=3)
+    with patch_post:
+        results = uploader.upload_docs(files)
+
+    assert [r.paths for r in results] == [[path] for path in files]
+    assert all(r.ok for r in results)
+    methods = [name for name, _ in fake_vk.api_calls]
+    assert methods.count('docs.getUploadServer') == 1
+    # 7 saves by 3 per execute, the last one is called directly
+    assert methods.count('execute') == 2
+    assert methods.count('docs.save') == 1
+    code = [args['code'] for name, args in fake_vk.api_calls
+            if name == 'execute'][0]
+    assert code == 'return [API.docs.save({"file":Args.a0,' \
+                   '"title":Args.a1}),API.docs.save({' \
+                   '"file":Args.a2,"title":Args.a3}),' \
+                   'API.docs.save({"file":Args.a4,"title":Args.a5})];'
+
+
+def test_missing_save_results(files):
+    fake_vk = FakeVK(max_results=1)
+    uploader, patch_post = get_uploader(fake_vk, max_workers=3,
+                                        save_batch_size=3)
+    with patch_post:
+        results = uploader.upload_docs(files[:3])
+    # Jobs are saved in the order of the upload completion
+    failed = [r for r in results if not r.ok]
+    assert len(failed) == 2
+    assert all('No result' in r.error.message for r in failed)
+
+
+def test_upload_error(files):
+    fake_vk = FakeVK()
+    uploader, patch_post = get_uploader(fake_vk)
+    error_response = mock.Mock()
+    error_response.json.return_value = {'error': 'Upload url expired'}
+    with mock.patch.object(type(uploader.api.session.http_session), 'post',
+                           return_value=error_response):
+        results = uploader.upload_wall_photos(files[:1])
+    assert not results[0].ok
+    assert uploader.stats()['errors'] == 1
+    # Failed url is not reused
+    assert uploader.upload_servers._urls == {}
@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
+import copy
+import threading
+import time
+
+import pytest
+
 from vk_requests import utils
+from vk_requests.exceptions import VkDeadlineExceeded
 from vk_requests.tests.test_base import get_fixture
 
 
@@ -10,3 +17,114 @@ def test_parse_captcha_html():
     )
     assert captcha_sid == '600885884'
     assert captcha_url == 'http://test/captcha.php?s=0&sid=600885885'
+
+
+def test_get_accept_encoding():
+    supported = utils.get_supported_encodings()
+    assert 'gzip' in supported and 'deflate' in supported
+    assert utils.get_accept_encoding() == ', '.join(supported)
+    assert utils.get_accept_encoding(None) == 'identity'
+    assert utils.get_accept_encoding('gzip') == 'gzip'
+    assert utils.get_accept_encoding(['deflate', 'gzip']) == 'deflate, gzip'
+    with pytest.raises(ValueError):
+        utils.get_accept_encoding(['gzip', 'lzma'])
+
+
+def test_deadline():
+    deadline = utils.Deadline(10)
+    assert 9.9 < deadline.clamp_timeout(None) <= 10
+    assert deadline.clamp_timeout(3) == 3
+    connect_timeout, read_timeout = deadline.clamp_timeout((3, 30))
+    assert connect_timeout == 3 and 9.9 < read_timeout <= 10
+    deadline.check()
+
+    deadline = utils.Deadline(0)
+    assert deadline.expired()
+    with pytest.raises(VkDeadlineExceeded) as err:
+        deadline.check('send')
+    assert err.value.phase == 'send'
+    # Zero timeout is not passed to requests
+    with pytest.raises(VkDeadlineExceeded) as err:
+        deadline.clamp_timeout(3, 'auth')
+    assert err.value.phase == 'auth'
+
+
+def test_single_flight_copies_result_before_release():
+    flight = utils.SingleFlight(copy_result=copy.deepcopy)
+    followers_num = 3
+    results = []
+
+    def fn():
+        # Wait for the followers to join the call
+        while flight._calls['key'].waiters < followers_num:
+            time.sleep(0.001)
+        return {'items': list(range(1000))}
+
+    def follower():
+        results.append(flight.do('key', fn)[0])
+
+    def slow_copy(result):
+        time.sleep(0.05)
+        return copy.deepcopy(result)
+
+    threads = [threading.Thread(target=follower)
+               for _ in range(followers_num)]
+    leader_results = []
+    leader_thread = threading.Thread(target=lambda: leader_results.append(
+        flight.do('key', fn)))
+    leader_thread.start()
+    while not flight.in_flight():
+        time.sleep(0.001)
+    flight.copy_result = slow_copy
+    for thread in threads:
+        thread.start()
+    leader_thread.join()
+
+    # The leader changes its result while the followers copy it
+    result, shared = leader_results[0]
+    assert not shared
+    for i in range(1000):
+        result['items%s' % i] = i
+    del result['items'][:]
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == followers_num
+    for follower_result in results:
+        assert follower_result == {'items': list(range(1000))}
+        assert follower_result is not result
+    assert len(set(map(id, results))) == followers_num
+
+
+def test_single_flight_releases_waiters_if_copy_fails():
+    def failing_copy(result):
+        raise TypeError('cannot copy')
+
+    flight = utils.SingleFlight(copy_result=failing_copy)
+    errors = []
+
+    def fn():
+        while flight._calls['key'].waiters < 1:
+            time.sleep(0.001)
+        return 'result'
+
+    def follower():
+        try:
+            flight.do('key', fn)
+        except TypeError as err:
+            errors.append(err)
+
+    leader_results = []
+    leader_thread = threading.Thread(target=lambda: leader_results.append(
+        flight.do('key', fn)))
+    leader_thread.start()
+    while not flight.in_flight():
+        time.sleep(0.001)
+    follower_thread = threading.Thread(target=follower)
+    follower_thread.start()
+    leader_thread.join(5)
+    follower_thread.join(5)
+
+    assert not follower_thread.is_alive()
+    assert leader_results == [('result', False)]
+    assert len(errors) == 1
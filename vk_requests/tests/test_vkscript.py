@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import re
+
+import pytest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from vk_requests import VKSession, API
+from vk_requests.exceptions import VkAPIError
+from vk_requests.vkscript import VKScript, Param, ScriptCache, \
+    ExecuteResult, MAX_CALLS
+
+
+CALL_RE = re.compile(r'API\.([\w.]+)\(\{(.*?)\}\)')
+ARG_RE = re.compile(r'"(\w+)":Args\.(\w+)')
+
+
+class FakeVK(object):
+    """Runs the calls of the generated 'execute' code, every method returns
+    its name and arguments"""
+
+    def __init__(self, fail_owner_ids=()):
+        self.requests = []
+        # owner_id -> number of failures
+        self.fail_owner_ids = dict(fail_owner_ids)
+
+    def make_request(self, request, captcha_response=None):
+        args = dict(request.method_args)
+        self.requests.append(args)
+        assert request.method_name == 'execute'
+        assert args['code'].startswith('return [')
+        response, errors = [], []
+        for method_name, call_args in CALL_RE.findall(args['code']):
+            call_args = {name: args[arg_name]
+                         for name, arg_name in ARG_RE.findall(call_args)}
+            if self.fail_owner_ids.get(call_args.get('owner_id')):
+                self.fail_owner_ids[call_args['owner_id']] -= 1
+                response.append(False)
+                errors.append({'method': method_name, 'error_code': 18,
+                               'error_msg': 'User was deleted or banned'})
+            else:
+                response.append({'method': method_name, 'args': call_args})
+        if request.call_options.get('execute_mode') != 'raw':
+            if errors:
+                raise VkAPIError(errors[0])
+            return response
+        payload = {'response': response}
+        if errors:
+            payload['execute_errors'] = errors
+        return payload
+
+
+@pytest.fixture
+def api():
+    return API(session=VKSession())
+
+
+def execute(api, script, **params):
+    fake_vk = FakeVK()
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        return script.execute(api, **params), fake_vk.requests
+
+
+def test_partial_results(api):
+    script = VKScript(cache=ScriptCache())
+    script.api.users.get(user_ids=1)
+    for owner_id in range(30):
+        script.api.wall.get(owner_id=owner_id)
+    # Two calls fail twice, one call fails once
+    fake_vk = FakeVK(fail_owner_ids={3: 2, 27: 2, 10: 1})
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=fake_vk.make_request):
+        with pytest.raises(VkAPIError):
+            script.execute(api)
+        fake_vk.fail_owner_ids = {3: 2, 27: 2, 10: 1}
+        fake_vk.requests = []
+
+        result = script.execute(api, partial=True)
+        assert len(result) == 31
+        assert result.failed == [4, 11, 28]
+        assert not result.ok
+        assert result[0]['method'] == 'users.get'
+        assert result[5]['args']['owner_id'] == 4
+        with pytest.raises(VkAPIError) as exc_info:
+            result[28]
+        assert exc_info.value.is_user_deleted_or_banned()
+        assert result.get_error(4).error_data['method'] == 'wall.get'
+
+        # Only the failed calls are sent
+        result = script.retry(api, result)
+        assert fake_vk.requests[-1]['code'].count('API.') == 3
+        assert result.failed == [4, 28]
+        assert result[11]['args']['owner_id'] == 10
+
+        result = script.retry(api, result)
+        assert result.ok and result.failed == []
+        assert [r['args']['owner_id'] for r in list(result)[1:]] == \
+            list(range(30))
+        assert script.retry(api, result) is result
+    assert len(fake_vk.requests) == 4
+
+
+def test_interrupted_script(api):
+    script = VKScript(max_calls=2, cache=ScriptCache())
+    for owner_id in range(3):
+        script.api.wall.get(owner_id=owner_id)
+    payloads = [{'response': [1]}, {'response': [3]}]
+    with mock.patch.object(api._session, 'make_request',
+                           side_effect=lambda *args, **kw: payloads.pop(0)):
+        result = script.execute(api, partial=True)
+    # Results of the next requests keep their indexes
+    assert result.failed == [1]
+    assert result[2] == 3
+    assert 'No result' in result.get_error(1).message
+
+
+def test_execute_errors_mapping():
+    errors = [{'method': 'wall.get', 'error_code': 18},
+              {'method': 'users.get', 'error_code': 30}]
+    # false is a valid result of the first call
+    result = ExecuteResult([False, False, 1, False], errors,
+                           ['users.get', 'wall.get', 'wall.get',
+                            'users.get'])
+    assert result.failed == [1, 3]
+    assert result.get_error(3).code == 30
+    with pytest.raises(VkAPIError):
+        result.raise_for_errors()
+
+    # Errors are mapped in order without the method names
+    result = ExecuteResult([1, False, False], errors)
+    assert result.failed == [1, 2]
+    assert result[-3] == 1
+    assert result[:1] == [1]
+    with pytest.raises(VkAPIError):
+        result[1:]
+    assert ExecuteResult(5).failed == []
+
+    # More errors than failed sub-calls
+    result = ExecuteResult([1, False], errors, ['wall.get', 'wall.get'])
+    assert result.failed == [1]
+    assert [e.code for e in result.unmatched_errors] == [30]
+    assert not result.ok
+    merged = result.merge([1], ExecuteResult([2]))
+    assert merged.failed == [] and merged[:] == [1, 2]
+    assert merged.unmatched_errors == result.unmatched_errors
+    assert not merged.ok
+    with pytest.raises(VkAPIError) as exc_info:
+        merged.raise_for_errors()
+    assert exc_info.value.code == 30
+
+
+def test_script(api):
+    script = VKScript(cache=ScriptCache())
+    assert script.api.users.get(user_ids=Param('ids'), fields='city') == 0
+    assert script.add(api.wall.get, owner_id=1, count=10) == 1
+    results, requests = execute(api, script, ids=[1, 2])
+
+    assert results == [
+        {'method': 'users.get', 'args': {'user_ids': '1,2',
+                                         'fields': 'city'}},
+        {'method': 'wall.get', 'args': {'owner_id': 1, 'count': 10}}]
+    assert requests[0]['code'] == (
+        'return [API.users.get({"fields":Args.a0,"user_ids":Args.ids}),'
+        'API.wall.get({"count":Args.a1,"owner_id":Args.a2})];')
+
+
+def test_code_is_compiled_once_per_shape(api):
+    cache = ScriptCache()
+
+    def get_script(owner_id, count):
+        script = VKScript(cache=cache)
+        script.api.wall.get(owner_id=owner_id, count=count)
+        return script
+
+    first = get_script(1, 10).compile()
+    assert get_script(2, 20).compile() is first
+    assert cache.hits == 1 and cache.misses == 1
+
+    script = VKScript(cache=cache)
+    script.api.wall.get(owner_id=1)
+    assert script.compile() is not first
+    assert len(cache) == 2
+
+
+def test_lru_cache():
+    cache = ScriptCache(maxsize=2)
+    cache.get('a', lambda: 1)
+    cache.get('b', lambda: 2)
+    cache.get('a', lambda: 3)
+    cache.get('c', lambda: 4)
+    assert cache.get('a', lambda: 5) == 1
+    assert cache.get('b', lambda: 6) == 6
+    assert len(cache) == 2
+
+
+def test_split_into_requests(api):
+    script = VKScript(cache=ScriptCache())
+    for owner_id in range(60):
+        script.api.wall.get(owner_id=owner_id, filter=Param('filter'))
+    results, requests = execute(api, script, filter='owner')
+    assert [r['args']['owner_id'] for r in results] == list(range(60))
+    assert [r['code'].count('API.') for r in requests] == [MAX_CALLS,
+                                                           MAX_CALLS, 10]
+    # Value names are numbered in every request
+    assert requests[1]['a0'] == MAX_CALLS
+
+    script = VKScript(max_code_size=200, cache=ScriptCache())
+    for owner_id in range(10):
+        script.api.wall.get(owner_id=owner_id)
+    results, requests = execute(api, script)
+    assert len(results) == 10
+    assert all(len(r['code']) <= 200 for r in requests)
+    assert len(requests) == 2
+
+
+def test_invalid_params():
+    for name in ('code', 'a1', '1x', 'user-id', 'deadline', 'priority'):
+        with pytest.raises(ValueError):
+            Param(name)
+    with pytest.raises(ValueError):
+        VKScript(max_calls=26)
+
+    script = VKScript(max_code_size=20, cache=ScriptCache())
+    script.api.users.get(user_ids=1)
+    with pytest.raises(ValueError):
+        script.compile()
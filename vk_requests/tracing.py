@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""Tracing of the API calls: every call is a tree of spans for its phases
+(auth, rate limit wait, encode, send, decode, retries).
+
+The tracer API is a subset of the OpenTelemetry one, so an OpenTelemetry
+tracer can be passed to the session as is:
+
+>>> from opentelemetry import trace
+>>> session = VKSession(tracer=trace.get_tracer('vk_requests'))
+
+Without OpenTelemetry, the built-in Tracer writes the spans to a file of
+JSON lines for offline analysis:
+
+>>> tracer = Tracer(FileSpanExporter('spans.jsonl'))
+>>> session = VKSession(service_token='...', tracer=tracer)
+
+Tracing is disabled by default (NoopTracer).
+"""
+import contextlib
+import json
+import random
+import threading
+import time
+
+
+STATUS_UNSET = 'UNSET'
+STATUS_OK = 'OK'
+STATUS_ERROR = 'ERROR'
+
+
+class _NoopSpan(object):
+    """Span and its context manager at once, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def record_exception(self, exception, attributes=None):
+        pass
+
+    def set_status(self, status, description=None):
+        pass
+
+    def is_recording(self):
+        return False
+
+    def end(self, end_time=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class NoopTracer(object):
+    """Default tracer, spans are not recorded"""
+
+    def start_span(self, name, attributes=None):
+        return NOOP_SPAN
+
+    def start_as_current_span(self, name, attributes=None):
+        return NOOP_SPAN
+
+
+NOOP_TRACER = NoopTracer()
+
+
+class Span(object):
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_time',
+                 'end_time', 'attributes', 'events', 'status',
+                 'status_description', '_tracer')
+
+    def __init__(self, tracer, name, trace_id, span_id, parent_id=None,
+                 attributes=None):
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = STATUS_UNSET
+        self.status_description = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_attributes(self, attributes):
+        self.attributes.update(attributes)
+
+    def add_event(self, name, attributes=None):
+        self.events.append({'name': name, 'time': time.time(),
+                            'attributes': dict(attributes or {})})
+
+    def record_exception(self, exception, attributes=None):
+        event_attributes = {
+            'exception.type': exception.__class__.__name__,
+            'exception.message': str(exception),
+        }
+        event_attributes.update(attributes or {})
+        self.add_event('exception', event_attributes)
+
+    def set_status(self, status, description=None):
+        self.status = status
+        self.status_description = description
+
+    def is_recording(self):
+        return self.end_time is None
+
+    def end(self, end_time=None):
+        if self.end_time is not None:
+            return
+        self.end_time = end_time or time.time()
+        self._tracer.on_end(self)
+
+    @property
+    def duration(self):
+        if self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'events': self.events,
+            'status': self.status,
+            'status_description': self.status_description,
+        }
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(name=%s, duration=%s)' % (
+            self.__class__.__name__, self.name, self.duration)
+
+
+class Tracer(object):
+    """Records the spans and passes the finished ones to the exporter.
+    The current span is tracked per thread, spans started in it become its
+    children."""
+
+    def __init__(self, exporter=None):
+        """
+        :param exporter: span exporter (export(spans) and shutdown()),
+        e.g. FileSpanExporter. Finished spans are dropped if it's None
+        """
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def get_current_span(self):
+        stack = self._get_stack()
+        return stack[-1] if stack else None
+
+    def start_span(self, name, attributes=None):
+        """Start the span as a child of the current one. The caller has to
+        end() it
+
+        :param name: str
+        :param attributes: dict
+        :return: Span instance
+        """
+        parent = self.get_current_span()
+        if parent is None:
+            trace_id, parent_id = '%032x' % random.getrandbits(128), None
+        else:
+            trace_id, parent_id = parent.trace_id, parent.span_id
+        return Span(self, name, trace_id=trace_id,
+                    span_id='%016x' % random.getrandbits(64),
+                    parent_id=parent_id, attributes=attributes)
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        """Start the span and make it the current one in the block.
+        Exceptions raised in the block are recorded in the span
+
+        :param name: str
+        :param attributes: dict
+        :return: context manager of Span instance
+        """
+        span = self.start_span(name, attributes=attributes)
+        stack = self._get_stack()
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.record_exception(err)
+            span.set_status(STATUS_ERROR, '%s: %s' % (
+                err.__class__.__name__, err))
+            raise
+        finally:
+            stack.pop()
+            span.end()
+
+    def on_end(self, span):
+        if self.exporter is not None:
+            self.exporter.export([span])
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+
+class MemorySpanExporter(object):
+    """Keeps the finished spans in a list"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = []
+
+    def export(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+
+    def shutdown(self):
+        pass
+
+
+class FileSpanExporter(object):
+    """Appends the finished spans to a file, one JSON object per line"""
+
+    def __init__(self, path):
+        """
+        :param path: str: file path
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.to_dict(), default=str) + '\n'
+                        for span in spans)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(lines)
+                self._file.flush()
+
+    def shutdown(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_spans(path):
+    """Read the spans written by FileSpanExporter
+
+    :param path: str: file path
+    :return: generator of span dicts
+    """
+    with open(path) as fd:
+        for line in fd:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,413 @@
+# -*- coding: utf-8 -*-
+"""Pluggable transport of API requests and Streaming API connections
+
+HTTPTransport sends the requests over the network. RecordingTransport wraps
+another transport and saves request/response pairs and websocket frames to
+a cassette file, ReplayTransport serves them back offline:
+
+>>> with RecordingTransport(HTTPTransport(), 'workload.jsonl.gz') as t:
+>>>     api = vk_requests.create_api(service_token='...', transport=t)
+>>>     api.users.get(user_ids=1)
+
+>>> transport = ReplayTransport('workload.jsonl.gz', speed=2.0)
+>>> api = vk_requests.create_api(service_token='...', transport=transport)
+>>> api.users.get(user_ids=1)  # served from the cassette
+
+Cassette is a (gzipped if the name ends with .gz) file of JSON lines, one
+line per HTTP exchange or websocket frame. Secrets (access tokens,
+streaming keys) are never written to the cassette.
+"""
+import base64
+import collections
+import gzip
+import io
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from six.moves.urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+from vk_requests.exceptions import VkReplayError
+from vk_requests.utils import SharedPoolSessions
+
+
+logger = logging.getLogger('vk-requests')
+
+
+# Parameters which values are replaced in the cassettes
+SECRET_PARAMS = frozenset(['access_token', 'key', 'client_secret',
+                           'password', 'captcha_key'])
+REDACTED = '<redacted>'
+
+HTTP_ENTRY = 'http'
+WS_ENTRY = 'ws'
+
+
+class Transport(object):
+    """Transport interface"""
+
+    def request(self, method, url, **kwargs):
+        """Send HTTP request
+
+        :param method: str: HTTP method
+        :param url: str
+        :param kwargs: requests parameters (data, json, timeout, etc)
+        :return: requests.Response instance
+        """
+        raise NotImplementedError
+
+    def connect(self, url, **kwargs):
+        """Open websocket connection
+
+        :param url: str
+        :param kwargs: websockets.connect parameters
+        :return: awaitable of the connection with recv() and close()
+        coroutines
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HTTPTransport(Transport):
+    """Network transport: HTTP requests go through thread-local sessions
+    over the shared connection pool, websockets are opened with the
+    websockets library"""
+
+    def __init__(self, sessions=None, compression_threshold=None):
+        """
+        :param sessions: vk_requests.utils.SharedPoolSessions instance
+        :param compression_threshold: int: gzip form bodies bigger than
+        this number of bytes, None to send them uncompressed
+        """
+        self.sessions = sessions or SharedPoolSessions()
+        self.compression_threshold = compression_threshold
+
+    def request(self, method, url, **kwargs):
+        if self.compression_threshold is not None and \
+                isinstance(kwargs.get('data'), dict):
+            self._compress_body(kwargs)
+        return self.sessions.session.request(method, url, **kwargs)
+
+    def _compress_body(self, kwargs):
+        body = urlencode(kwargs['data']).encode('utf-8')
+        if len(body) < self.compression_threshold:
+            return
+        kwargs['data'] = gzip_compress(body)
+        kwargs['headers'] = dict(kwargs.get('headers') or {},
+                                 **{'Content-Encoding': 'gzip'})
+
+    def connect(self, url, **kwargs):
+        import inspect
+        import websockets
+
+        # websockets 14+ client takes additional_headers
+        if 'extra_headers' in kwargs and 'additional_headers' in \
+                inspect.signature(websockets.connect).parameters:
+            kwargs['additional_headers'] = kwargs.pop('extra_headers')
+        return websockets.connect(url, **kwargs)
+
+    def close(self):
+        self.sessions.close()
+
+
+def gzip_compress(data):
+    """Gzip the bytes, the output is the same for the same input"""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz_file:
+        gz_file.write(data)
+    return buf.getvalue()
+
+
+def redact_url(url):
+    """Replace secret query parameters of the url"""
+    parts = urlparse(url)
+    if not parts.query:
+        return url
+    query = [(name, REDACTED if name in SECRET_PARAMS else value)
+             for name, value in parse_qsl(parts.query,
+                                          keep_blank_values=True)]
+    return urlunparse(parts._replace(query=urlencode(query)))
+
+
+def redact_params(params):
+    """Replace secret values of the request parameters"""
+    if not isinstance(params, dict):
+        return params
+    return {name: REDACTED if name in SECRET_PARAMS else value
+            for name, value in params.items()}
+
+
+def _open_cassette(path, mode):
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf-8')
+    return io.open(path, mode, encoding='utf-8')
+
+
+class Cassette(object):
+    """Recorded HTTP exchanges and websocket frames"""
+
+    def __init__(self, entries=None):
+        self.entries = list(entries or [])
+
+    @classmethod
+    def load(cls, path):
+        with _open_cassette(path, 'r') as fd:
+            return cls(json.loads(line) for line in fd if line.strip())
+
+    @staticmethod
+    def get_request_key(method, url, data=None, json_data=None):
+        """Key the recorded response is found by on replay"""
+        params = data if data is not None else json_data
+        if isinstance(params, dict):
+            params = sorted((name, str(value)) for name, value in
+                            redact_params(params).items())
+        elif params is not None:
+            params = str(params)
+        return json.dumps([method.upper(), redact_url(url), params])
+
+
+def _encode_body(content):
+    try:
+        return {'body': content.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'body_b64': base64.b64encode(content).decode('ascii')}
+
+
+def _decode_body(entry):
+    if 'body_b64' in entry:
+        return base64.b64decode(entry['body_b64'])
+    return entry.get('body', '').encode('utf-8')
+
+
+class RecordingTransport(Transport):
+    """Transport which saves the traffic of another transport to a cassette
+    """
+
+    def __init__(self, transport, path):
+        """
+        :param transport: Transport instance doing the real work
+        :param path: str: cassette path, gzipped if it ends with .gz
+        """
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = _open_cassette(path, 'w')
+        self._started_at = time.time()
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(path=%s)' % (self.__class__.__name__, self.path)
+
+    def write(self, entry):
+        entry['t'] = round(time.time() - self._started_at, 4)
+        line = json.dumps(entry, ensure_ascii=False, sort_keys=True)
+        with self._lock:
+            self._file.write(line + u'\n')
+            self._file.flush()
+
+    def request(self, method, url, **kwargs):
+        started_at = time.time()
+        response = self.transport.request(method, url, **kwargs)
+        entry = {
+            'type': HTTP_ENTRY,
+            'method': method.upper(),
+            'url': redact_url(url),
+            'data': redact_params(kwargs.get('data')),
+            'json': redact_params(kwargs.get('json')),
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'elapsed': round(time.time() - started_at, 4),
+        }
+        entry.update(_encode_body(response.content))
+        self.write(entry)
+        return response
+
+    def connect(self, url, **kwargs):
+        import asyncio
+
+        result = asyncio.Future()
+
+        def on_connected(future):
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(
+                    _RecordingWebSocket(future.result(), self, url))
+
+        connecting = asyncio.ensure_future(
+            self.transport.connect(url, **kwargs))
+        connecting.add_done_callback(on_connected)
+        return result
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        self.transport.close()
+
+
+class _RecordingWebSocket(object):
+    def __init__(self, ws, recorder, url):
+        self._ws = ws
+        self._recorder = recorder
+        self._url = redact_url(url)
+
+    def recv(self):
+        import asyncio
+
+        future = asyncio.ensure_future(self._ws.recv())
+        future.add_done_callback(self._record)
+        return future
+
+    def _record(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        entry = {'type': WS_ENTRY, 'url': self._url}
+        message = future.result()
+        if isinstance(message, bytes):
+            entry.update(_encode_body(message))
+        else:
+            entry['body'] = message
+        self._recorder.write(entry)
+
+    def close(self):
+        return self._ws.close()
+
+
+class ReplayTransport(Transport):
+    """Transport which serves the responses and websocket frames from a
+    cassette, no network access is needed.
+
+    Requests are matched by method, url and parameters (secrets are not
+    compared), identical requests get the recorded responses in order.
+    """
+
+    def __init__(self, path, speed=None):
+        """
+        :param path: str: cassette path
+        :param speed: float: replay speed relative to the recorded one
+        (1.0 - recorded latencies and gaps between frames, 2.0 - twice as
+        fast), None to replay without delays
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive')
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._responses = collections.defaultdict(collections.deque)
+        self._frames = collections.defaultdict(list)
+        self.load(Cassette.load(path))
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(path=%s, speed=%s)' % (
+            self.__class__.__name__, self.path, self.speed)
+
+    def load(self, cassette):
+        for entry in cassette.entries:
+            if entry['type'] == HTTP_ENTRY:
+                key = Cassette.get_request_key(
+                    entry['method'], entry['url'], entry.get('data'),
+                    entry.get('json'))
+                self._responses[key].append(entry)
+            elif entry['type'] == WS_ENTRY:
+                self._frames[entry['url']].append(entry)
+
+    def get_delay(self, seconds):
+        if self.speed is None:
+            return 0
+        return max(0.0, seconds / self.speed)
+
+    def request(self, method, url, **kwargs):
+        key = Cassette.get_request_key(method, url, kwargs.get('data'),
+                                       kwargs.get('json'))
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise VkReplayError('Request is not found in the cassette %s:'
+                                    ' %s' % (self.path, key))
+            entry = responses.popleft()
+
+        delay = self.get_delay(entry.get('elapsed', 0))
+        if delay:
+            time.sleep(delay)
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response._content = _decode_body(entry)
+        response.headers = CaseInsensitiveDict()
+        if entry.get('content_type'):
+            response.headers['Content-Type'] = entry['content_type']
+        response.encoding = 'utf-8'
+        response.url = url
+        return response
+
+    def connect(self, url, **kwargs):
+        import asyncio
+
+        with self._lock:
+            frames = self._frames.pop(redact_url(url), [])
+        future = asyncio.Future()
+        future.set_result(_ReplayWebSocket(frames, self))
+        return future
+
+
+class _ReplayWebSocket(object):
+    def __init__(self, frames, transport):
+        self._frames = collections.deque(frames)
+        self._transport = transport
+        self._last_t = frames[0]['t'] if frames else 0
+
+    def recv(self):
+        import asyncio
+
+        future = asyncio.Future()
+        if not self._frames:
+            future.set_exception(_connection_closed())
+            return future
+
+        entry = self._frames.popleft()
+        message = entry['body'] if 'body' in entry else _decode_body(entry)
+        delay = self._transport.get_delay(entry['t'] - self._last_t)
+        self._last_t = entry['t']
+        if delay:
+            asyncio.get_event_loop().call_later(
+                delay, _set_result, future, message)
+        else:
+            future.set_result(message)
+        return future
+
+    def close(self):
+        import asyncio
+
+        future = asyncio.Future()
+        future.set_result(None)
+        return future
+
+
+def _set_result(future, result):
+    # The waiting side might have been cancelled (e.g. consume timeout)
+    if not future.done():
+        future.set_result(result)
+
+
+def _connection_closed():
+    """Error raised by websockets when the server closes the connection"""
+    from websockets.exceptions import ConnectionClosedOK
+    try:
+        from websockets.frames import Close
+    except ImportError:  # pragma: no cover
+        # websockets < 10
+        return ConnectionClosedOK(1000, 'End of the cassette')
+    return ConnectionClosedOK(Close(1000, 'End of the cassette'), None)
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""Media upload pipeline: get upload server -> multipart POST -> save
+
+Files are streamed from disk, upload server urls are reused while they're
+valid, uploads run in parallel and the save calls are batched with
+'execute' (up to 25 per request).
+
+Example:
+
+>>> uploader = Uploader(api, max_workers=4)
+>>> results = uploader.upload_photos(['1.jpg', '2.jpg'], album_id=123)
+>>> [r.response for r in results]
+"""
+import logging
+import mmap
+import os
+import threading
+import time
+import uuid
+
+from vk_requests.exceptions import VkAPIError
+from vk_requests.metrics import MetricsRegistry
+from vk_requests.utils import stringify_values, SingleFlight
+from vk_requests.vkscript import VKScript
+
+
+logger = logging.getLogger('vk-requests')
+
+
+class MultipartFileStream(object):
+    """File-like multipart/form-data body which reads the files lazily.
+
+    requests sends objects with read() and __len__ chunk by chunk, so the
+    body is never kept in memory completely. Files bigger than
+    mmap_threshold are memory-mapped instead of being read with syscalls.
+    """
+
+    def __init__(self, files, boundary=None, mmap_threshold=8 * 1024 * 1024,
+                 progress_callback=None):
+        """
+
+        :param files: list of (field name, file path) tuples
+        :param boundary: str: multipart boundary, random if not given
+        :param mmap_threshold: int: min file size to be memory-mapped
+        :param progress_callback: callable(path, bytes_sent, bytes_total)
+        """
+        self.boundary = boundary or uuid.uuid4().hex
+        self.mmap_threshold = mmap_threshold
+        self.progress_callback = progress_callback
+
+        # Body parts: bytes or (path, size) of a file
+        self._parts = []
+        for field_name, path in files:
+            filename = os.path.basename(path)
+            header = (
+                '--%s\r\nContent-Disposition: form-data; name="%s"; '
+                'filename="%s"\r\nContent-Type: application/octet-stream'
+                '\r\n\r\n' % (self.boundary, field_name, filename))
+            self._parts.append(header.encode('utf-8'))
+            self._parts.append((path, os.path.getsize(path)))
+            self._parts.append(b'\r\n')
+        self._parts.append(('--%s--\r\n' % self.boundary).encode('utf-8'))
+
+        self._length = sum(len(p) if isinstance(p, bytes) else p[1]
+                           for p in self._parts)
+        self._part_index = 0
+        self._part_pos = 0
+        self._file = None
+        self._mmap = None
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._length
+        chunks = []
+        while size > 0 and self._part_index < len(self._parts):
+            chunk = self._read_part(size)
+            if not chunk:
+                self._next_part()
+                continue
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _read_part(self, size):
+        part = self._parts[self._part_index]
+        if isinstance(part, bytes):
+            chunk = part[self._part_pos:self._part_pos + size]
+        else:
+            path, total = part
+            chunk = self._read_file(path, total, size)
+            if chunk and self.progress_callback is not None:
+                self.progress_callback(path, self._part_pos + len(chunk),
+                                       total)
+        self._part_pos += len(chunk)
+        return chunk
+
+    def _read_file(self, path, total, size):
+        if self._file is None:
+            self._file = open(path, 'rb')
+            if total >= self.mmap_threshold > 0:
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+        if self._mmap is not None:
+            return self._mmap[self._part_pos:self._part_pos + size]
+        return self._file.read(size)
+
+    def _next_part(self):
+        self.close()
+        self._part_index += 1
+        self._part_pos = 0
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class UploadServerCache(object):
+    """Upload server urls cache, an url is reused until it's expired"""
+
+    def __init__(self, ttl=300):
+        """
+        :param ttl: float: seconds the upload url is considered as valid
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._urls = {}
+        # Concurrent uploads wait for one upload server request
+        self._flight = SingleFlight()
+
+    def get(self, request, **method_args):
+        """Get cached upload url or request the new one
+
+        :param request: vk_requests.api.Request, e.g api.photos.getUploadServer
+        :return: str: upload url
+        """
+        key = (request.method_name,
+               tuple(sorted(stringify_values(method_args).items())))
+        url = self._get_cached(key)
+        if url is None:
+            url, _ = self._flight.do(key, self._fetch, key, request,
+                                     method_args)
+        return url
+
+    def _get_cached(self, key):
+        with self._lock:
+            url, received_at = self._urls.get(key, (None, 0))
+            if url is not None and time.time() - received_at < self.ttl:
+                return url
+
+    def _fetch(self, key, request, method_args):
+        # The url might have been fetched by the flight which has just ended
+        url = self._get_cached(key)
+        if url is None:
+            url = request(**method_args)['upload_url']
+            with self._lock:
+                self._urls[key] = (url, time.time())
+        return url
+
+    def invalidate(self, url):
+        with self._lock:
+            for key, (cached_url, _) in list(self._urls.items()):
+                if cached_url == url:
+                    del self._urls[key]
+
+
+class UploadResult(object):
+    __slots__ = ('paths', 'response', 'error')
+
+    def __init__(self, paths, response=None, error=None):
+        """
+        :param paths: list of uploaded file paths
+        :param response: save method response
+        :param error: exception if the upload or save is failed
+        """
+        self.paths = paths
+        self.response = response
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(paths=%s, ok=%s)' % (
+            self.__class__.__name__, self.paths, self.ok)
+
+
+class _UploadJob(object):
+    __slots__ = ('index', 'paths', 'fields', 'server_method', 'server_args',
+                 'save_method', 'save_args')
+
+    def __init__(self, index, paths, fields, server_method, server_args,
+                 save_method, save_args):
+        self.index = index
+        self.paths = paths
+        self.fields = fields
+        self.server_method = server_method
+        self.server_args = server_args
+        self.save_method = save_method
+        # callable(upload response) -> save method args
+        self.save_args = save_args
+
+
+class Uploader(object):
+    """Parallel media uploader"""
+
+    # VK accepts up to 5 photos per album upload request
+    PHOTOS_PER_UPLOAD = 5
+    # Max number of save calls in one 'execute' request
+    MAX_SAVE_BATCH = 25
+
+    def __init__(self, api, max_workers=4, save_batch_size=MAX_SAVE_BATCH,
+                 upload_url_ttl=300, mmap_threshold=8 * 1024 * 1024,
+                 http_params=None, progress_callback=None):
+        """
+
+        :param api: vk_requests.api.API instance (user or group token)
+        :param max_workers: int: max number of parallel uploads
+        :param save_batch_size: int: save calls per 'execute' request,
+        1 to call save methods directly
+        :param upload_url_ttl: float: seconds an upload url is reused
+        :param mmap_threshold: int: min file size to be memory-mapped
+        :param http_params: dict: requests http parameters of the uploads
+        :param progress_callback: callable(path, bytes_sent, bytes_total)
+        """
+        if not 0 < save_batch_size <= self.MAX_SAVE_BATCH:
+            raise ValueError('save_batch_size must be in range 1..%d'
+                             % self.MAX_SAVE_BATCH)
+        self.api = api
+        self.max_workers = max_workers
+        self.save_batch_size = save_batch_size
+        self.mmap_threshold = mmap_threshold
+        self.http_params = dict(http_params or {'timeout': 60})
+        self.progress_callback = progress_callback
+        self.upload_servers = UploadServerCache(ttl=upload_url_ttl)
+        self.metrics = MetricsRegistry()
+
+        # path -> (bytes sent, bytes total)
+        self.progress = {}
+        self._started_at = None
+
+    def upload_photos(self, paths, album_id, group_id=None, **save_args):
+        """Upload photos to the album, up to 5 photos per upload request
+        and save call
+
+        :return: list of UploadResult, one per 5 files
+        """
+        server_args = {'album_id': album_id}
+        if group_id is not None:
+            server_args['group_id'] = group_id
+
+        def get_save_args(response):
+            return dict(save_args, server=response['server'],
+                        photos_list=response['photos_list'],
+                        hash=response['hash'], **server_args)
+
+        batches = [paths[i:i + self.PHOTOS_PER_UPLOAD]
+                   for i in range(0, len(paths), self.PHOTOS_PER_UPLOAD)]
+        jobs = [_UploadJob(index=i, paths=batch,
+                           fields=['file%d' % (n + 1)
+                                   for n in range(len(batch))],
+                           server_method='photos.getUploadServer',
+                           server_args=server_args,
+                           save_method='photos.save',
+                           save_args=get_save_args)
+                for i, batch in enumerate(batches)]
+        return self.run(jobs)
+
+    def upload_wall_photos(self, paths, group_id=None, **save_args):
+        """Upload photos to be attached to wall posts
+
+        :return: list of UploadResult, one per file
+        """
+        server_args = {}
+        if group_id is not None:
+            server_args['group_id'] = group_id
+
+        def get_save_args(response):
+            return dict(save_args, server=response['server'],
+                        photo=response['photo'], hash=response['hash'],
+                        **server_args)
+
+        jobs = [_UploadJob(index=i, paths=[path], fields=['photo'],
+                           server_method='photos.getWallUploadServer',
+                           server_args=server_args,
+                           save_method='photos.saveWallPhoto',
+                           save_args=get_save_args)
+                for i, path in enumerate(paths)]
+        return self.run(jobs)
+
+    def upload_docs(self, paths, group_id=None, **save_args):
+        """Upload documents
+
+        :return: list of UploadResult, one per file
+        """
+        server_args = {}
+        if group_id is not None:
+            server_args['group_id'] = group_id
+
+        jobs = []
+        for i, path in enumerate(paths):
+            def get_save_args(response, path=path):
+                args = dict(save_args, file=response['file'])
+                args.setdefault('title', os.path.basename(path))
+                return args
+
+            jobs.append(_UploadJob(index=i, paths=[path], fields=['file'],
+                                   server_method='docs.getUploadServer',
+                                   server_args=server_args,
+                                   save_method='docs.save',
+                                   save_args=get_save_args))
+        return self.run(jobs)
+
+    def run(self, jobs):
+        """Upload the files of the jobs in parallel and save them in batches
+
+        :return: list of UploadResult in the order of the jobs
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        if self._started_at is None:
+            self._started_at = time.time()
+        results = [None] * len(jobs)
+        pending_saves = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._upload, job): job
+                       for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    response = future.result()
+                except Exception as err:
+                    logger.warning('Upload of %s failed: %r', job.paths, err)
+                    self.metrics.counter('upload.errors').inc()
+                    results[job.index] = UploadResult(job.paths, error=err)
+                    continue
+                pending_saves.append((job, job.save_args(response)))
+                if len(pending_saves) >= self.save_batch_size:
+                    self._save(pending_saves, results)
+                    pending_saves = []
+        if pending_saves:
+            self._save(pending_saves, results)
+        return results
+
+    def _request(self, method_name):
+        request = self.api
+        for name in method_name.split('.'):
+            request = getattr(request, name)
+        return request
+
+    def _upload(self, job):
+        """Upload the files of the job
+
+        :return: dict: upload server response
+        """
+        url = self.upload_servers.get(self._request(job.server_method),
+                                      **job.server_args)
+        body = MultipartFileStream(list(zip(job.fields, job.paths)),
+                                   mmap_threshold=self.mmap_threshold,
+                                   progress_callback=self._on_progress)
+        started_at = time.time()
+        try:
+            response = self.api.session.http_session.post(
+                url, data=body, headers={'Content-Type': body.content_type},
+                **self.http_params)
+        finally:
+            body.close()
+        response.raise_for_status()
+        payload = response.json()
+        if 'error' in payload:
+            # Upload url might be expired, don't reuse it
+            self.upload_servers.invalidate(url)
+            raise VkAPIError({'error_msg': payload['error']})
+
+        self.metrics.counter('upload.files').inc(len(job.paths))
+        self.metrics.counter('upload.bytes').inc(len(body))
+        self.metrics.histogram('upload.time').observe(
+            time.time() - started_at)
+        return payload
+
+    def _on_progress(self, path, sent, total):
+        self.progress[path] = (sent, total)
+        if self.progress_callback is not None:
+            self.progress_callback(path, sent, total)
+
+    def _save(self, saves, results):
+        """Call save methods, with 'execute' if there are more than one
+
+        :param saves: list of (job, save method args)
+        :param results: list of results to fill in
+        """
+        if len(saves) == 1:
+            job, args = saves[0]
+            try:
+                response = self._request(job.save_method)(**args)
+            except VkAPIError as err:
+                results[job.index] = UploadResult(job.paths, error=err)
+            else:
+                results[job.index] = UploadResult(job.paths, response)
+            return
+
+        script = VKScript(max_calls=self.save_batch_size)
+        for job, args in saves:
+            script.add(job.save_method, **args)
+        try:
+            # Errors are matched with the save calls, calls without
+            # results (the script is interrupted) are failed too
+            result = script.execute(self.api, partial=True)
+        except VkAPIError as err:
+            for job, _ in saves:
+                results[job.index] = UploadResult(job.paths, error=err)
+            return
+        self.metrics.counter('upload.save_requests').inc(
+            len(script.compile()))
+        for n, (job, _) in enumerate(saves):
+            try:
+                results[job.index] = UploadResult(job.paths, result[n])
+            except VkAPIError as err:
+                results[job.index] = UploadResult(job.paths, error=err)
+
+    def stats(self):
+        """Upload throughput stats
+
+        :return: dict
+        """
+        metrics = self.metrics.snapshot()
+        uploaded = metrics.get('upload.bytes', 0)
+        elapsed = time.time() - self._started_at if self._started_at else 0
+        return {
+            'files': metrics.get('upload.files', 0),
+            'bytes': uploaded,
+            'bytes_per_sec': uploaded / elapsed if elapsed else 0.0,
+            'errors': metrics.get('upload.errors', 0),
+            'metrics': metrics,
+        }
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
+import threading
+import time
+
 import bs4
 import requests
 import six
+from requests.adapters import HTTPAdapter
 
-from vk_requests.exceptions import VkParseError, VkPageWarningsError
+from vk_requests.exceptions import VkParseError, VkPageWarningsError, \
+    VkDeadlineExceeded
 
 logger = logging.getLogger('vk-requests')
 
@@ -134,14 +140,115 @@ def check_html_warnings(html, parser=None):
     return True
 
 
+def get_token_id(access_token):
+    """Short non-secret id of the token, safe to be used in metric names
+    and logs
+
+    :param access_token: str or None
+    :return: str: '-' if there is no token
+    """
+    if not access_token:
+        return '-'
+    return hashlib.sha1(access_token.encode('utf-8')).hexdigest()[:8]
+
+
+AUTO_COMPRESSION = 'auto'
+
+
+def get_supported_encodings():
+    """Content encodings which can be decoded: gzip and deflate, br and
+    zstd if urllib3 has the decoders (brotli and zstandard packages)
+
+    :return: list of str
+    """
+    try:
+        from urllib3.util.request import ACCEPT_ENCODING
+    except ImportError:  # pragma: no cover
+        # urllib3 bundled into old requests versions
+        from requests.packages.urllib3.util.request import ACCEPT_ENCODING
+    return [encoding.strip() for encoding in ACCEPT_ENCODING.split(',')]
+
+
+def get_accept_encoding(compression=AUTO_COMPRESSION):
+    """Get Accept-Encoding header value
+
+    :param compression: 'auto' - all supported encodings, str or list of
+    encodings in the order of preference, None or False - no compression
+    :return: str
+    """
+    if not compression:
+        return 'identity'
+    supported = get_supported_encodings()
+    if compression == AUTO_COMPRESSION:
+        return ', '.join(supported)
+
+    if isinstance(compression, six.string_types):
+        compression = [e.strip() for e in compression.split(',')]
+    unsupported = [e for e in compression if e not in supported]
+    if unsupported:
+        raise ValueError('Encodings %s are not supported, install brotli or '
+                         'zstandard package to enable br or zstd'
+                         % unsupported)
+    return ', '.join(compression)
+
+
+class Deadline(object):
+    """Time budget of a call shared by all its attempts"""
+    __slots__ = ('timeout', 'expires_at')
+
+    def __init__(self, timeout):
+        """
+        :param timeout: float: budget in seconds from now
+        """
+        self.timeout = timeout
+        self.expires_at = time.time() + timeout
+
+    def remaining(self):
+        return max(self.expires_at - time.time(), 0.0)
+
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def check(self, phase=None):
+        """
+        :raise VkDeadlineExceeded: if the budget is used up
+        """
+        if self.expired():
+            raise VkDeadlineExceeded(self.timeout, phase)
+
+    def clamp_timeout(self, timeout, phase=None):
+        """Limit the requests timeout by the remaining budget
+
+        :param timeout: requests timeout: None, float or (connect, read)
+        :param phase: str: phase of the call for the error
+        :return: timeout which is not longer than the remaining budget
+        :raise VkDeadlineExceeded: if the budget is used up, zero timeout
+        is not passed to requests
+        """
+        remaining = self.remaining()
+        if not remaining:
+            raise VkDeadlineExceeded(self.timeout, phase)
+        if timeout is None:
+            return remaining
+        if isinstance(timeout, tuple):
+            return tuple(remaining if value is None else min(value, remaining)
+                         for value in timeout)
+        return min(timeout, remaining)
+
+
 class VerboseHTTPSession(requests.Session):
     """HTTP session based on requests.Session with some extra logging
     """
     def __init__(self):
         super(VerboseHTTPSession, self).__init__()
         self.logger = logging.getLogger(self.__class__.__name__)
+        # Deadline instance which bounds the requests of the session
+        self.deadline = None
 
     def request(self, method, url, **kwargs):
+        if self.deadline is not None:
+            kwargs['timeout'] = self.deadline.clamp_timeout(
+                kwargs.get('timeout'), 'auth')
         self.logger.debug(
             'Request: %s %s, params=%r, data=%r',
             method, url, kwargs.get('params'), kwargs.get('data'))
@@ -150,3 +257,175 @@ class VerboseHTTPSession(requests.Session):
         self.logger.debug(
             'Response: %s %s', response.status_code, response.url)
         return response
+
+
+class SharedPoolSessions(object):
+    """Thread-local HTTP sessions sharing one connection pool.
+
+    requests.Session keeps cookies and headers which are not safe to share
+    between threads, the connection pool (adapter) is thread-safe.
+    """
+
+    def __init__(self, pool_size=10, headers=None):
+        """
+        :param pool_size: int: max number of kept-alive connections per host
+        :param headers: dict: default headers of the sessions
+        """
+        self.pool_size = pool_size
+        self.headers = headers or {}
+        self._adapter = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def adapter(self):
+        """Connection pool shared by the sessions of all threads
+
+        :return: requests.adapters.HTTPAdapter instance
+        """
+        if self._adapter is None:
+            with self._lock:
+                if self._adapter is None:
+                    self._adapter = HTTPAdapter(
+                        pool_connections=self.pool_size,
+                        pool_maxsize=self.pool_size)
+        return self._adapter
+
+    @property
+    def session(self):
+        """Session of the current thread
+
+        :return: VerboseHTTPSession instance
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = VerboseHTTPSession()
+            session.headers.update(self.headers)
+            adapter = self.adapter
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._local.session = session
+        return session
+
+    def close(self):
+        """Close the connection pool, threads get new sessions after it"""
+        with self._lock:
+            adapter, self._adapter = self._adapter, None
+            self._local = threading.local()
+        if adapter is not None:
+            adapter.close()
+
+
+class SingleFlight(object):
+    """Collapse concurrent calls sharing the same key into one execution.
+
+    The first caller (leader) runs the function, the other callers wait for
+    it to finish and get the same result or the same exception.
+    """
+
+    class _Call(object):
+        __slots__ = ('event', 'result', 'error', 'waiters')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.result = None
+            self.error = None
+            self.waiters = 0
+
+    def __init__(self, copy_result=None, share_error=None):
+        """
+        :param copy_result: callable(result) -> copy, e.g. copy.deepcopy.
+        If it's set, the waiting callers get own copies of the result taken
+        from a private copy made before they're released, so changes of
+        the leader's result don't affect them
+        :param share_error: callable(error) -> bool. If it returns False, the
+        error is raised to the leader only and the waiting callers run the
+        call again, e.g. for the errors caused by the leader's own deadline
+        """
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.copy_result = copy_result
+        self.share_error = share_error
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) once for all concurrent callers of the key
+
+        :param key: hashable call key
+        :param fn: callable
+        :return: tuple of (result, shared), where shared is True if the result
+        was produced by the call of another thread
+        """
+        return self.do_until(None, key, fn, *args, **kwargs)
+
+    def do_until(self, caller_deadline, key, fn, *args, **kwargs):
+        """Same as do, waiting for the call of another thread is bounded by
+        the deadline of the caller
+
+        :param caller_deadline: Deadline instance or None
+        :raise VkDeadlineExceeded: if the deadline expires while waiting
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                is_leader = call is None
+                if is_leader:
+                    call = self._Call()
+                    self._calls[key] = call
+                else:
+                    call.waiters += 1
+            if is_leader:
+                break
+
+            if not self._wait(call, caller_deadline):
+                with self._lock:
+                    call.waiters -= 1
+                raise VkDeadlineExceeded(caller_deadline.timeout, 'wait')
+            if call.error is not None:
+                if self.share_error is None or self.share_error(call.error):
+                    raise call.error
+                # Not shared error, the call is made again
+                continue
+            if self.copy_result is not None:
+                return self.copy_result(call.result), True
+            return call.result, True
+
+        result = None
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            # No new waiters can join the call after it's removed
+            try:
+                if call.error is None and call.waiters:
+                    call.result = result if self.copy_result is None \
+                        else self.copy_result(result)
+            except Exception as err:
+                call.error = err
+            finally:
+                call.event.set()
+        return result, False
+
+    @staticmethod
+    def _wait(call, deadline):
+        """
+        :return: bool: False if the deadline has expired before the call
+        finished
+        """
+        if deadline is None:
+            call.event.wait()
+            return True
+        while not call.event.is_set():
+            remaining = deadline.remaining()
+            if not remaining:
+                return False
+            call.event.wait(remaining)
+        return True
+
+    def in_flight(self):
+        """Number of calls being executed at the moment"""
+        with self._lock:
+            return len(self._calls)
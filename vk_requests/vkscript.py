@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""VKScript builder: API calls are composed into 'execute' code.
+
+Argument values are never a part of the code, they're passed to 'execute'
+as its arguments and referenced from the code as Args.<name>. So the code
+depends on the script shape only (methods and argument names) and is
+compiled once per shape:
+
+>>> script = VKScript()
+>>> script.api.users.get(user_ids=Param('user_ids'), fields='city')
+>>> script.api.wall.get(owner_id=Param('owner_id'), count=10)
+>>> users, wall = script.execute(api, user_ids=[1, 2], owner_id=1)
+
+Param is a named placeholder, its value is given on execution and may be
+used by many calls. Scripts with more than MAX_CALLS calls or longer code
+are split into several 'execute' requests.
+"""
+import collections
+import logging
+import re
+import threading
+
+from vk_requests.api import Request
+from vk_requests.exceptions import VkAPIError
+from vk_requests.utils import stringify_values
+
+
+logger = logging.getLogger('vk-requests')
+
+
+# VK allows up to 25 API calls per 'execute' request
+MAX_CALLS = 25
+
+# Max code length of one 'execute' request, the code is sent with every
+# request, so longer scripts are split
+MAX_CODE_SIZE = 16384
+
+# Arguments of 'execute' itself and the call options which are not sent
+# to vk, params can't have these names
+RESERVED_ARGS = frozenset(['code', 'v', 'lang', 'access_token', 'https',
+                           'test_mode', 'func_v', 'captcha_sid',
+                           'captcha_key'] + list(Request.CALL_OPTIONS))
+
+# Auto generated names of the argument values
+_VALUE_ARG_RE = re.compile(r'^a\d+$')
+PARAM_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class ScriptCache(object):
+    """Thread-safe LRU cache of compiled scripts"""
+
+    def __init__(self, maxsize=256):
+        """
+        :param maxsize: int: max number of kept scripts
+        """
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        self._scripts = collections.OrderedDict()
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(size=%s, hits=%s, misses=%s)' % (
+            self.__class__.__name__, len(self), self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._scripts)
+
+    def get(self, key, build):
+        """Get the script of the key, it's built by build() if it's not
+        cached
+
+        :param key: hashable script shape
+        :param build: callable() -> script
+        """
+        with self._lock:
+            script = self._scripts.pop(key, None)
+            if script is not None:
+                self._scripts[key] = script
+                self.hits += 1
+                return script
+            self.misses += 1
+
+        script = build()
+        with self._lock:
+            self._scripts[key] = script
+            while len(self._scripts) > self.maxsize:
+                self._scripts.popitem(last=False)
+        return script
+
+    def clear(self):
+        with self._lock:
+            self._scripts.clear()
+
+
+_script_cache = ScriptCache()
+
+
+class ExecuteResult(object):
+    """Result of 'execute' with the sub-call errors (execute_mode='partial').
+
+    Failed sub-calls return false in the response list, execute_errors are
+    mapped to them in order (and by the method name if it's known), so
+    the results of the succeeded sub-calls are kept:
+
+    >>> result = api.execute(code=code, execute_mode='partial')
+    >>> result.failed  # [1]
+    >>> result[0]  # sub-call result
+    >>> result[1]  # raises VkAPIError of the sub-call
+
+    Errors which can't be matched with a failed sub-call (e.g. there are
+    more errors than false results) are kept in unmatched_errors, the
+    result is not ok then.
+    """
+
+    def __init__(self, response, execute_errors=(), method_names=None):
+        """
+        :param response: 'response' value of the payload
+        :param execute_errors: list of error dicts
+        :param method_names: list of sub-call method names, used to match
+        the errors with the sub-calls
+        """
+        self.response = response
+        self.errors = [VkAPIError(error) for error in execute_errors or ()]
+        self.method_names = method_names
+        self._call_errors = self._map_errors()
+        matched = set(id(error) for error in self._call_errors.values())
+        self.unmatched_errors = [error for error in self.errors
+                                 if id(error) not in matched]
+        if self.unmatched_errors:
+            logger.warning('%s execute errors are not matched with the '
+                           'sub-calls: %s', len(self.unmatched_errors),
+                           self.unmatched_errors)
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(results=%s, failed=%s, unmatched_errors=%s)' % (
+            self.__class__.__name__, len(self), self.failed,
+            len(self.unmatched_errors))
+
+    @classmethod
+    def from_call_errors(cls, response, call_errors, method_names=None,
+                         unmatched_errors=()):
+        """
+        :param response: list of the sub-call results
+        :param call_errors: dict {sub-call index: VkAPIError}
+        :param unmatched_errors: list of VkAPIError
+        :return: ExecuteResult
+        """
+        result = cls(response, (), method_names)
+        result._call_errors = dict(call_errors)
+        result.unmatched_errors = list(unmatched_errors)
+        result.errors = [call_errors[index] for index in sorted(call_errors)]
+        result.errors.extend(result.unmatched_errors)
+        return result
+
+    def _map_errors(self):
+        call_errors = {}
+        if not isinstance(self.response, list):
+            return call_errors
+        index = 0
+        for error in self.errors:
+            method_name = error.error_data.get('method')
+            while index < len(self.response):
+                matched = self.response[index] is False and (
+                    not self.method_names or not method_name or
+                    self.method_names[index] == method_name)
+                index += 1
+                if matched:
+                    call_errors[index - 1] = error
+                    break
+        return call_errors
+
+    def __len__(self):
+        return len(self.response) if isinstance(self.response, list) else 0
+
+    def __iter__(self):
+        return iter(self.response if isinstance(self.response, list) else ())
+
+    def __getitem__(self, index):
+        """
+        :param index: int or slice
+        :return: result of the sub-call or list of the results
+        :raise: VkAPIError if the sub-call (any of the slice) is failed
+        """
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        error = self._call_errors.get(index)
+        if error is not None:
+            raise error
+        return self.response[index]
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    @property
+    def failed(self):
+        """
+        :return: list of indexes of the failed sub-calls, see also
+        unmatched_errors
+        """
+        return sorted(self._call_errors)
+
+    def get_error(self, index):
+        """
+        :return: VkAPIError of the sub-call or None
+        """
+        return self._call_errors.get(index)
+
+    def raise_for_errors(self):
+        """Raise the first error as the default execute mode does"""
+        if self.errors:
+            raise self.errors[0]
+
+    def merge(self, indexes, result):
+        """Get the result with the sub-calls replaced, e.g. by the results
+        of the retried ones
+
+        :param indexes: list of the sub-call indexes
+        :param result: ExecuteResult of the sub-calls
+        :return: ExecuteResult
+        """
+        response = list(self.response)
+        call_errors = dict(self._call_errors)
+        for sub_index, index in enumerate(indexes):
+            response[index] = result.response[sub_index]
+            call_errors.pop(index, None)
+            error = result.get_error(sub_index)
+            if error is not None:
+                call_errors[index] = error
+        return self.from_call_errors(
+            response, call_errors, self.method_names,
+            self.unmatched_errors + result.unmatched_errors)
+
+
+class Param(object):
+    """Named placeholder of an argument value, the value is passed to
+    VKScript.execute()"""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        if not PARAM_NAME_RE.match(name) or name in RESERVED_ARGS or \
+                _VALUE_ARG_RE.match(name):
+            raise ValueError('Invalid param name %r' % name)
+        self.name = name
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+
+class Call(object):
+    __slots__ = ('method_name', 'args')
+
+    def __init__(self, method_name, args):
+        """
+        :param method_name: str: e.g. 'users.get'
+        :param args: dict: argument values and Param placeholders
+        """
+        self.method_name = method_name
+        self.args = args
+
+    @property
+    def shape(self):
+        return self.method_name, tuple(sorted(
+            (name, value.name if isinstance(value, Param) else None)
+            for name, value in self.args.items()))
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(%s, %s)' % (self.__class__.__name__, self.method_name,
+                               self.args)
+
+
+class Chunk(object):
+    """Code of one 'execute' request and the sources of its arguments"""
+
+    __slots__ = ('code', 'start', 'end', 'bindings')
+
+    def __init__(self, code, start, end, bindings):
+        """
+        :param code: str: VKScript code
+        :param start: int: index of the first call of the chunk
+        :param end: int: index after the last call of the chunk
+        :param bindings: tuple of (execute argument name, call index,
+        method argument name, param name or None)
+        """
+        self.code = code
+        self.start = start
+        self.end = end
+        self.bindings = bindings
+
+    def get_args(self, calls, params):
+        """Argument values of the 'execute' request
+
+        :param calls: list of Call
+        :param params: dict: values of Param placeholders
+        :return: dict
+        """
+        args = {}
+        for arg_name, index, name, param_name in self.bindings:
+            if param_name is None:
+                args[arg_name] = calls[index].args[name]
+            else:
+                args[arg_name] = params[param_name]
+        return stringify_values(args)
+
+
+def compile_calls(shapes, max_calls=MAX_CALLS, max_code_size=MAX_CODE_SIZE):
+    """Build the code of the calls split into 'execute' requests
+
+    :param shapes: tuple of Call.shape
+    :return: tuple of Chunk
+    """
+    chunks = []
+    chunk = _ChunkBuilder(0)
+    for index, (method_name, args) in enumerate(shapes):
+        if chunk.parts and len(chunk.parts) >= max_calls:
+            chunks.append(chunk.build(index))
+            chunk = _ChunkBuilder(index)
+        part, bindings, params = chunk.make_call(index, method_name, args)
+        if chunk.parts and chunk.size + len(part) + 1 > max_code_size:
+            chunks.append(chunk.build(index))
+            chunk = _ChunkBuilder(index)
+            # Value names are numbered from 0 in every chunk
+            part, bindings, params = chunk.make_call(index, method_name, args)
+        if chunk.size + len(part) > max_code_size:
+            raise ValueError('Code of %s call is longer than %s'
+                             % (method_name, max_code_size))
+        chunk.add(part, bindings, params)
+    if chunk.parts:
+        chunks.append(chunk.build(len(shapes)))
+    return tuple(chunks)
+
+
+class _ChunkBuilder(object):
+    TEMPLATE = 'return [%s];'
+
+    def __init__(self, start):
+        self.start = start
+        self.parts = []
+        self.bindings = []
+        self.params = set()
+        self.size = len(self.TEMPLATE % '')
+
+    def make_call(self, index, method_name, args):
+        call_args, bindings, params = [], [], set()
+        for name, param_name in args:
+            if param_name is None:
+                arg_name = 'a%d' % (len(self.bindings) + len(bindings))
+                bindings.append((arg_name, index, name, None))
+            else:
+                arg_name = param_name
+                params.add(param_name)
+            call_args.append('"%s":Args.%s' % (name, arg_name))
+        part = 'API.%s({%s})' % (method_name, ','.join(call_args))
+        return part, bindings, params
+
+    def add(self, part, bindings, params):
+        if self.parts:
+            self.size += 1  # separator
+        self.size += len(part)
+        self.parts.append(part)
+        self.bindings.extend(bindings)
+        self.params.update(params)
+
+    def build(self, end):
+        bindings = self.bindings + [(name, None, None, name)
+                                    for name in sorted(self.params)]
+        return Chunk(self.TEMPLATE % ','.join(self.parts), self.start, end,
+                     tuple(bindings))
+
+
+class _CallBuilder(object):
+    """api-like object which adds the calls to the script"""
+
+    __slots__ = ('_script', '_method_name')
+
+    def __init__(self, script, method_name=None):
+        self._script = script
+        self._method_name = method_name
+
+    def __getattr__(self, name):
+        if self._method_name is not None:
+            name = '.'.join([self._method_name, name])
+        return _CallBuilder(self._script, name)
+
+    def __call__(self, **args):
+        return self._script.add(self._method_name, **args)
+
+
+class VKScript(object):
+    """Builder of 'execute' requests"""
+
+    def __init__(self, max_calls=MAX_CALLS, max_code_size=MAX_CODE_SIZE,
+                 cache=None):
+        """
+        :param max_calls: int: max API calls per 'execute' request
+        :param max_code_size: int: max code length per 'execute' request
+        :param cache: ScriptCache instance, the module cache by default
+        """
+        if not 0 < max_calls <= MAX_CALLS:
+            raise ValueError('max_calls must be in range 1..%d' % MAX_CALLS)
+        self.max_calls = max_calls
+        self.max_code_size = max_code_size
+        self.cache = cache if cache is not None else _script_cache
+        self.calls = []
+
+    def __repr__(self):  # pragma: no cover
+        return '%s(calls=%s)' % (self.__class__.__name__, len(self.calls))
+
+    def __len__(self):
+        return len(self.calls)
+
+    @property
+    def api(self):
+        """Add the calls as api calls, e.g. script.api.users.get(...)"""
+        return _CallBuilder(self)
+
+    def add(self, method, **args):
+        """Add the API call
+
+        :param method: str: method name or vk_requests.api.Request
+        instance, e.g. api.users.get
+        :param args: argument values or Param placeholders
+        :return: int: index of the call result
+        """
+        method_name = getattr(method, 'method_name', method)
+        self.calls.append(Call(method_name, args))
+        return len(self.calls) - 1
+
+    @property
+    def shape(self):
+        return tuple(call.shape for call in self.calls)
+
+    def compile(self):
+        """Get the code of the 'execute' requests, it's built once per
+        shape
+
+        :return: tuple of Chunk
+        """
+        shape = self.shape
+        return self.cache.get(
+            (shape, self.max_calls, self.max_code_size),
+            lambda: compile_calls(shape, self.max_calls, self.max_code_size))
+
+    def get_requests(self, **params):
+        """
+        :param params: values of the Param placeholders
+        :return: list of 'execute' arguments dicts (code included)
+        """
+        requests = []
+        for chunk in self.compile():
+            args = chunk.get_args(self.calls, params)
+            args['code'] = chunk.code
+            requests.append(args)
+        return requests
+
+    def execute(self, api, partial=False, **params):
+        """Run the script
+
+        :param api: vk_requests.api.API instance (user token)
+        :param partial: bool: return ExecuteResult with the results of the
+        succeeded calls instead of raising the first error
+        :param params: values of the Param placeholders
+        :return: list of the call results or ExecuteResult
+        """
+        if not partial:
+            results = []
+            for args in self.get_requests(**params):
+                results.extend(api.execute(**args))
+            return results
+
+        method_names = [call.method_name for call in self.calls]
+        response, call_errors, unmatched_errors = [], {}, []
+        for chunk, args in zip(self.compile(), self.get_requests(**params)):
+            payload = api.execute(execute_mode='raw', **args)
+            result = ExecuteResult(payload.get('response'),
+                                   payload.get('execute_errors'),
+                                   method_names[chunk.start:chunk.end])
+            for index in result.failed:
+                call_errors[chunk.start + index] = result.get_error(index)
+            unmatched_errors.extend(result.unmatched_errors)
+            response.extend(result)
+            # The script is interrupted (e.g. by the execute time limit),
+            # the calls without results are failed, so the results of the
+            # next chunks keep their indexes
+            for index in range(chunk.start + len(result), chunk.end):
+                response.append(False)
+                call_errors[index] = VkAPIError(
+                    {'method': method_names[index],
+                     'error_msg': 'No result of the call'})
+        return ExecuteResult.from_call_errors(response, call_errors,
+                                              method_names, unmatched_errors)
+
+    def retry(self, api, result, indexes=None, **params):
+        """Run the failed calls of the script again
+
+        :param api: vk_requests.api.API instance
+        :param result: ExecuteResult returned by execute(partial=True)
+        :param indexes: list of the call indexes to retry, all failed calls
+        by default
+        :param params: values of the Param placeholders
+        :return: ExecuteResult of all the calls
+        """
+        indexes = result.failed if indexes is None else list(indexes)
+        if not indexes:
+            return result
+        script = VKScript(max_calls=self.max_calls,
+                          max_code_size=self.max_code_size, cache=self.cache)
+        script.calls = [self.calls[index] for index in indexes]
+        logger.info('Retrying %s failed calls', len(indexes))
+        return result.merge(indexes,
+                            script.execute(api, partial=True, **params))